@@ -90,6 +90,25 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # One per process. To share it among the server processes use a file
+    # based cache:
+    #     'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    #     'LOCATION': '/var/tmp/cuchuflito_results',
+    # or memcached (needs python-memcached):
+    #     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    #     'LOCATION': '127.0.0.1:11211',
+    'polls_results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'polls_results',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -130,6 +149,57 @@ INSTALLED_APPS = (
 LOGIN_URL = '/polls/login/'
 LOGIN_REDIRECT_URL = '/polls/'
 
+# Number of counter shards per choice, to spread the votes of hot polls
+# among several rows (0 = no sharding). The shards are folded back into
+# Choice.votes by the compact_vote_shards command: run it periodically, and
+# before disabling the sharding.
+POLLS_VOTE_SHARDS = 0
+
+# Write-behind voting: buffer the votes in memory and write them in batches,
+# every POLLS_VOTE_FLUSH_MS milliseconds or POLLS_VOTE_FLUSH_MAX votes, which
+# also bounds the votes lost if a server process crashes (see polls.votebuffer).
+POLLS_VOTE_WRITE_BEHIND = False
+POLLS_VOTE_FLUSH_MS = 500
+POLLS_VOTE_FLUSH_MAX = 100
+
+# Paginate the archives with cursors instead of page numbers: every page is
+# as fast as the first one, but there are no page numbers nor page count.
+POLLS_KEYSET_PAGINATION = False
+
+# Cache alias (from CACHES) of the rendered results of the polls, by poll
+# version (see polls.views.PollResults). None disables the cache.
+POLLS_RESULTS_CACHE = 'polls_results'
+
+# Push the changes of the results to their pages (server-sent events): a
+# publisher per process reads the watched polls every POLLS_LIVE_RESULTS_MS
+# milliseconds, for all their watchers (see polls.liveresults). A stream is
+# held open POLLS_LIVE_RESULTS_MAX_SECONDS at most: with a server of a
+# thread (or process) per request, each watcher holds one, so a few viewers
+# can take all the workers of a small deployment. Enable it with an async
+# or threaded server sized for the watchers.
+POLLS_LIVE_RESULTS = False
+POLLS_LIVE_RESULTS_MS = 1000
+POLLS_LIVE_RESULTS_MAX_SECONDS = 300
+
+# One vote per voter and poll: the voters (users, or the sessions of the
+# anonymous ones) are recorded in a ledger (see polls.models.Voter). Either
+# way, a vote request is counted once per idempotency key (the form's, or
+# the Idempotency-Key header): the request keys are purged after
+# POLLS_VOTE_REQUEST_DAYS by the purge_vote_requests command.
+POLLS_ONE_VOTE_PER_VOTER = False
+POLLS_VOTE_REQUEST_DAYS = 2
+
+# Log the votes (polls.models.VoteEvent), for the trends of the polls and to
+# rebuild Choice.votes (rebuild_choice_votes command). It costs a write more:
+# the votes counted one by one are logged in batches, like the write-behind
+# votes (every POLLS_VOTE_FLUSH_MS or POLLS_VOTE_FLUSH_MAX votes), so a
+# crashed process loses their log, but not the votes. The log is rolled up
+# by minute, hour and day by the rollup_votes command: run it periodically.
+# It leaves the votes of the last POLLS_VOTE_ROLLUP_LAG seconds for the next
+# time (their transactions may still be committing).
+POLLS_VOTE_EVENTS = False
+POLLS_VOTE_ROLLUP_LAG = 10
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 # For the tests results highlighting
 NOSE_ARGS = ['--with-xtraceback'] #['--with-yanc']
@@ -162,3 +232,11 @@ LOGGING = {
         },
     }
 }
+
+
+# Machine specific settings (e.g. a local PostgreSQL, or a SQLite file as
+# test database to run the concurrency tests) go in local_settings.py.
+try:
+    from local_settings import *
+except ImportError:
+    pass
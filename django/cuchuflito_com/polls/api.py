@@ -0,0 +1,360 @@
+"""JSON API of the polls and their results, for the dashboards
+
+Read only, and lighter than the HTML pages: the rows are read with
+values() / values_list(), without making model instances, and serialized
+without templates.
+
+- api/polls/: the polls, newest first, in pages of 'limit' (keyset
+  pagination, with the 'cursor' of the 'next' and 'previous' URLs, see
+  polls.pagination). The page is streamed.
+- api/polls/<id>/results/: the results of a poll.
+- api/results/?ids=1,2,3: the results of up to MAX_BULK_IDS polls, in one
+  query.
+- api/votes/ (POST): votes in bulk, see ingest_votes.
+- api/polls/<id>/trend/: the votes of a poll over time, see poll_trend.
+
+The results are the poll's fields and its choices, most voted first. With
+sharded votes (settings.POLLS_VOTE_SHARDS), the votes still in the shards
+are read with one more query, and added.
+
+"""
+import datetime
+import json
+from collections import OrderedDict, defaultdict
+
+from django.contrib.auth.decorators import permission_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Sum
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from polls.models import (Poll, Choice, ChoiceVotesShard, VoteRollupState, ROLLUPS,
+                          vote_shards, batches)
+from polls.pagination import keyset_page
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+MAX_BULK_IDS = 100
+MAX_ID = 2 ** 63 - 1 # Of the DB's integers: a bigger one overflows the query.
+STREAM_BATCH = 100 # Polls per chunk of the streamed pages.
+POLL_FIELDS = ('id', 'question', 'pub_date', 'total_votes', 'max_votes')
+RESULTS_FIELDS = POLL_FIELDS + ('version',)
+CHOICE_FIELDS = ('choice__id', 'choice__choice', 'choice__votes')
+MAX_BULK_VOTES = 10000
+MAX_BULK_VOTES_SIZE = 2 * 1024 * 1024 # Bytes of the body.
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl')
+# The periods of the trends: their length, and how many of them by default.
+TREND_PERIODS = {
+        'minute': (datetime.timedelta(minutes=1), 60),
+        'hour': (datetime.timedelta(hours=1), 48),
+        'day': (datetime.timedelta(days=1), 30),
+    }
+MAX_TREND_PERIODS = 1500
+
+encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+
+def json_response(data, status=200):
+    return HttpResponse(encoder.encode(data), content_type='application/json', status=status)
+
+
+def error(status, message):
+    return json_response({'error': message}, status=status)
+
+
+def valid_id(pk):
+    return 0 < pk <= MAX_ID
+
+
+def read_results(poll_ids):
+    """The results of the polls (those that exist) by id, read with one
+    query: the polls LEFT JOINed with their choices.
+
+    """
+    rows = (Poll.objects.filter(pk__in=poll_ids)
+            .order_by('pk', '-choice__votes', 'choice__id')
+            .values_list(*(RESULTS_FIELDS + CHOICE_FIELDS)))
+    n = len(RESULTS_FIELDS)
+    results = {}
+    for row in rows:
+        poll = results.get(row[0])
+        if poll is None:
+            poll = results[row[0]] = dict(zip(RESULTS_FIELDS, row[:n]))
+            poll['choices'] = []
+        if row[n] is not None:
+            # Not a poll without choices.
+            poll['choices'].append(dict(zip(('id', 'choice', 'votes'), row[n:])))
+    if vote_shards() > 1 and results:
+        add_sharded_votes(results)
+    return results
+
+
+def add_sharded_votes(results):
+    """Add the votes in the counter shards to the 'results'."""
+    pending = (ChoiceVotesShard.objects.filter(choice__poll__in=results.keys()).order_by()
+               .values_list('choice__poll', 'choice').annotate(Sum('votes')))
+    pending_by_choice = {}
+    for poll_id, choice_id, votes in pending:
+        pending_by_choice[choice_id] = votes
+    for poll in results.values():
+        for choice in poll['choices']:
+            choice['votes'] += pending_by_choice.get(choice['id'], 0)
+        poll['choices'].sort(key=lambda c: (-c['votes'], c['id']))
+        poll['total_votes'] = sum(c['votes'] for c in poll['choices'])
+        poll['max_votes'] = poll['choices'][0]['votes'] if poll['choices'] else 0
+
+
+@require_GET
+def poll_list(request):
+    """A page of polls: {"polls": [...], "next": url, "previous": url}."""
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= MAX_LIMIT:
+        return error(400, u"'limit' must be from 1 to %i." % MAX_LIMIT)
+    try:
+        page = keyset_page(Poll.objects.values(*POLL_FIELDS), request.GET.get('cursor'),
+                           limit, params=request.GET)
+    except Http404 as e:
+        return error(404, unicode(e))
+    return StreamingHttpResponse(stream_page(page, request.path),
+                                 content_type='application/json')
+
+
+def stream_page(page, path):
+    """The JSON of the page, in chunks of STREAM_BATCH polls."""
+    polls = page.object_list
+    yield '{"polls":['
+    for i in xrange(0, len(polls), STREAM_BATCH):
+        yield (',' if i else '') + ','.join(encoder.encode(p) for p in polls[i:i + STREAM_BATCH])
+    yield '],"next":%s,"previous":%s}' % (
+            encoder.encode(path + page.next_url() if page.has_next() else None),
+            encoder.encode(path + page.previous_url() if page.has_previous() else None))
+
+
+@require_GET
+def poll_results(request, poll_id):
+    """The results of a poll."""
+    if not valid_id(int(poll_id)):
+        return error(400, u"Poll ids go from 1 to %i." % MAX_ID)
+    results = read_results([int(poll_id)])
+    if not results:
+        return error(404, u"No such poll.")
+    return json_response(results.values()[0])
+
+
+@require_GET
+def bulk_results(request):
+    """The results of the polls in 'ids' (comma separated):
+    {"results": [...], "missing": [the ids of no poll]}.
+
+    """
+    try:
+        ids = [int(i) for i in request.GET.get('ids', '').split(',') if i.strip()]
+        if not all(valid_id(pk) for pk in ids):
+            raise ValueError(ids)
+    except ValueError:
+        return error(400, u"'ids' must be poll ids (from 1 to %i), separated by commas." % MAX_ID)
+    # Unique, in the order given.
+    ids = list(OrderedDict.fromkeys(ids))
+    if not 0 < len(ids) <= MAX_BULK_IDS:
+        return error(400, u"From 1 to %i poll ids, please." % MAX_BULK_IDS)
+    results = read_results(ids)
+    return json_response({
+            'results': [results[pk] for pk in ids if pk in results],
+            'missing': [pk for pk in ids if pk not in results],
+        })
+
+
+class UnsupportedMediaType(Exception):
+    pass
+
+
+class IdOutOfRange(ValueError):
+    pass
+
+
+def vote_items(request):
+    """The (index, item) of the votes in the body: a JSON array, or a line
+    of JSON per vote (NDJSON, read line by line). An item is None if its
+    line is not JSON. Raise ValueError if the JSON array is not.
+
+    """
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    if content_type == 'application/json':
+        items = json.loads(request.body)
+        if not isinstance(items, list):
+            raise ValueError(u"Not a JSON array.")
+        return enumerate(items)
+    if content_type in NDJSON_TYPES:
+        return ndjson_items(request)
+    raise UnsupportedMediaType(content_type)
+
+
+def ndjson_items(request):
+    for index, line in enumerate(request):
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except ValueError:
+            yield index, None
+
+
+def parse_vote(item):
+    """The (poll id, choice id) of a vote item: {"poll": id, "choice": id}.
+    Raise ValueError, or IdOutOfRange if an id is not from 1 to MAX_ID.
+
+    """
+    if not isinstance(item, dict):
+        raise ValueError(item)
+    ids = item.get('poll'), item.get('choice')
+    if not all(type(i) in (int, long) for i in ids):
+        raise ValueError(item)
+    if not all(valid_id(i) for i in ids):
+        raise IdOutOfRange(item)
+    return ids
+
+
+@csrf_exempt
+@require_POST
+@permission_required('polls.can_ingest_votes', raise_exception=True)
+def ingest_votes(request):
+    """Add up to MAX_BULK_VOTES votes, each {"poll": id, "choice": id}, in a
+    JSON array or NDJSON (e.g. the votes collected offline by a kiosk).
+
+    The votes for a choice of another poll (or of no poll), or with ids out
+    of the DB's range, are rejected, the others are counted: the choices of the polls voted are read with one
+    query (per 500 polls), and the votes added up by choice in memory. Then
+    they are added with a single transaction, with one UPDATE of the choices
+    per poll (ChoiceManager.add_votes).
+
+    Answer {"accepted": n, "rejected": [{"index": i, "error": msg}, ...]},
+    with the index of the rejected items in the array (or their line).
+
+    Not CSRF protected: it takes no form, and a cross-site form can't send
+    JSON or NDJSON without the browser asking first (CORS).
+
+    """
+    try:
+        size = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        size = 0
+    if size > MAX_BULK_VOTES_SIZE:
+        return error(413, u"%i bytes of votes per request at most." % MAX_BULK_VOTES_SIZE)
+    votes = []
+    rejected = []
+    try:
+        for index, item in vote_items(request):
+            if len(votes) + len(rejected) >= MAX_BULK_VOTES:
+                return error(413, u"%i votes per request at most." % MAX_BULK_VOTES)
+            try:
+                poll_id, choice_id = parse_vote(item)
+            except IdOutOfRange:
+                rejected.append({'index': index, 'error': u"Ids go from 1 to %i." % MAX_ID})
+                continue
+            except ValueError:
+                rejected.append({'index': index, 'error': u'Not {"poll": id, "choice": id}.'})
+                continue
+            votes.append((index, poll_id, choice_id))
+    except UnsupportedMediaType:
+        return error(415, u"Send the votes as application/json or application/x-ndjson.")
+    except ValueError:
+        return error(400, u"The votes must be a JSON array.")
+
+    poll_of = {}
+    for poll_ids in batches(sorted(set(poll_id for index, poll_id, choice_id in votes)), 500):
+        poll_of.update(Choice.objects.filter(poll_id__in=poll_ids).values_list('pk', 'poll_id'))
+    counts = defaultdict(lambda: defaultdict(int))
+    for index, poll_id, choice_id in votes:
+        if poll_of.get(choice_id) != poll_id:
+            rejected.append({'index': index,
+                             'error': u"No choice %i in the poll %i." % (choice_id, poll_id)})
+        else:
+            counts[poll_id][choice_id] += 1
+    with transaction.atomic():
+        # Always in the same order: concurrent requests don't deadlock.
+        for poll_id in sorted(counts):
+            Choice.objects.add_votes(poll_id, dict(counts[poll_id]))
+    rejected.sort(key=lambda r: r['index'])
+    return json_response({
+            'accepted': sum(sum(c.values()) for c in counts.values()),
+            'rejected': rejected,
+        })
+
+
+def parse_time(value):
+    """The aware datetime of an ISO 8601 'value' (in the current time zone
+    if it has none), or None. Raise ValueError.
+
+    """
+    if not value:
+        return None
+    when = parse_datetime(value)
+    if when is None:
+        raise ValueError(value)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+@require_GET
+def poll_trend(request, poll_id):
+    """The votes of a poll by minute, hour or day ('period'), from 'since'
+    until 'until' (ISO 8601 times; by default, the last 60 minutes, 48
+    hours or 30 days):
+
+        {"poll": id, "period": "hour", "since": t, "until": t,
+         "rolled_up_to": t, "choices": [{"id": id, "choice": text}, ...],
+         "trend": [{"start": t, "total": n, "votes": {choice id: n}}, ...]}
+
+    Read from the rollups (see polls.models.VoteRollup), with a query: the
+    periods without votes are left out, and the votes after 'rolled_up_to'
+    (see the rollup_votes command) are not in yet.
+
+    """
+    if not valid_id(int(poll_id)):
+        return error(400, u"Poll ids go from 1 to %i." % MAX_ID)
+    period = request.GET.get('period', 'hour')
+    if period not in TREND_PERIODS:
+        return error(400, u"'period' must be one of: %s." % ", ".join(sorted(TREND_PERIODS)))
+    length, default_periods = TREND_PERIODS[period]
+    rollup = ROLLUPS[period]
+    try:
+        until = parse_time(request.GET.get('until')) or timezone.now()
+        since = parse_time(request.GET.get('since')) or until - length * default_periods
+    except ValueError:
+        return error(400, u"'since' and 'until' must be ISO 8601 times.")
+    if not since < until:
+        return error(400, u"'since' must be before 'until'.")
+    if until - since > length * MAX_TREND_PERIODS:
+        return error(400, u"%i periods at most." % MAX_TREND_PERIODS)
+    choices = list(Choice.objects.filter(poll_id=poll_id).order_by('_order')
+                   .values('id', 'choice'))
+    if not choices and not Poll.objects.filter(pk=poll_id).exists():
+        return error(404, u"No such poll.")
+
+    rows = (rollup.objects.filter(poll_id=poll_id, start__gte=rollup.truncate(since),
+                                  start__lt=until)
+            .order_by('start').values_list('start', 'choice_id', 'votes'))
+    trend = []
+    for start, choice_id, votes in rows:
+        if not trend or trend[-1]['start'] != start:
+            trend.append({'start': start, 'total': 0, 'votes': {}})
+        trend[-1]['votes'][choice_id] = votes
+        trend[-1]['total'] += votes
+    state = VoteRollupState.objects.filter(pk=VoteRollupState.SINGLETON).first()
+    return json_response({
+            'poll': int(poll_id),
+            'period': period,
+            'since': since,
+            'until': until,
+            'rolled_up_to': state.rolled_up_to if state else None,
+            'choices': choices,
+            'trend': trend,
+        })
@@ -1,25 +1,44 @@
 import datetime
+import uuid
 
 from django import forms
 from django.core import validators
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
 from django.forms.extras.widgets import SelectDateWidget
 from django.forms.models import BaseInlineFormSet, inlineformset_factory
 
 from polls.models import Poll, Choice
 
 class VoteForm(forms.Form):
-    choice = forms.ModelChoiceField(
-            queryset=Choice.objects.all(),
+    """The vote for one of the 'choices' of the poll (by default, its
+    choices, read once). The choices are in memory: validating the vote
+    doesn't query the DB. The cleaned 'choice' is a Choice instance.
+
+    """
+    choice = forms.TypedChoiceField(
+            coerce=int,
             widget=forms.RadioSelect,
-            empty_label=None,
             error_messages={'required': u"You must select a choice to vote."}
             )
+    # A new one for each form: submitting the form again doesn't vote again
+    # (see Choice.vote_once).
+    idempotency_key = forms.CharField(required=False, widget=forms.HiddenInput)
 
     def __init__(self, *args, **kwargs):
         poll = kwargs.pop('poll')
+        choices = kwargs.pop('choices', None)
         super(VoteForm, self).__init__(*args, **kwargs)
-        self.fields['choice'].queryset = poll.choice_set.all()
+        self.fields['idempotency_key'].initial = uuid.uuid4().hex
+        if choices is None:
+            choices = list(poll.choice_set.all())
+        self.choices_by_pk = dict((c.pk, c) for c in choices)
+        self.fields['choice'].choices = [(c.pk, c.choice) for c in choices]
+
+    def clean_choice(self):
+        return self.choices_by_pk[self.cleaned_data['choice']]
+
+
+ALREADY_VOTED_MSG = u"You already voted in this poll."
 
 
 EMPTY_QUESTION_MSG = u"Question can't be empty."
@@ -38,6 +57,7 @@ def validate_empty(value):
     if len(value) == 0 or len(value.strip()) == 0:
         raise ValidationError(u'Empty value')
 
+REPEATED_CHOICE_MSG = u"Repeated choice."
 class InlineChoiceForm(forms.ModelForm):
     class Meta:
         model = Choice
@@ -48,13 +68,40 @@ class InlineChoiceForm(forms.ModelForm):
             error_messages = {
                     'invalid': u'Enter a non-empty choice.',
                     'required': u'This choice is required.',
-                    '__all__': u"Repeated choice."},
+                    '__all__': REPEATED_CHOICE_MSG},
             max_length = 200,
         )
 
     def clean_choice(self):
         return self.cleaned_data['choice'].strip()
 
+    def validate_unique(self):
+        """Nothing: BaseChoiceFormSet.validate_unique finds the repeated
+        choices, without a query per form.
+
+        """
+
+
+class FormSetChoiceField(forms.ModelChoiceField):
+    """The id of one of the choices read by the formset (ModelChoiceField
+    would read each one again).
+
+    """
+    def __init__(self, formset, *args, **kwargs):
+        self.formset = formset
+        super(FormSetChoiceField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            choice = self.formset._existing_object(int(value))
+        except (ValueError, TypeError):
+            choice = None
+        if choice is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return choice
+
 
 class BaseChoiceFormSet(BaseInlineFormSet):
     def add_fields(self, form, index):
@@ -62,12 +109,55 @@ class BaseChoiceFormSet(BaseInlineFormSet):
         super(BaseChoiceFormSet, self).add_fields(form, index)
         form.fields['ORDER'] = forms.IntegerField(label=(u'Order'), initial=index+1, required=False)
         form.fields['ORDER'].widget = forms.HiddenInput()
+        pk = form.fields['id']
+        form.fields['id'] = FormSetChoiceField(self, pk.queryset,
+                initial=pk.initial, required=False, widget=pk.widget)
+
+    def validate_unique(self):
+        """The choices (but the deleted ones) are not repeated, even if the
+        poll is not saved yet. All the choices of the poll are in the
+        formset: the DB is not queried.
+
+        """
+        seen = set()
+        errors = []
+        for form in self.forms:
+            if not form.is_valid() or self.can_delete and self._should_delete_form(form):
+                continue
+            choice = form.cleaned_data.get('choice')
+            if choice is None:
+                continue
+            if choice in seen:
+                form._errors[NON_FIELD_ERRORS] = self.error_class([REPEATED_CHOICE_MSG])
+                del form.cleaned_data['choice']
+                errors.append(REPEATED_CHOICE_MSG)
+            seen.add(choice)
+        if errors:
+            raise ValidationError(errors)
 
     def save(self, commit=True):
-        super(BaseChoiceFormSet, self).save(commit=commit)
-        for choice, order in [(f.instance, f.cleaned_data['ORDER']) for f in self.ordered_forms]:
-            choice._order = order
-            choice.save()
+        """Save the choices in one transaction, with a statement for the new
+        ones, one for the changed ones and one for the deleted ones (see
+        ChoiceManager.edit_poll_choices), whatever their number.
+
+        """
+        if not commit:
+            return super(BaseChoiceFormSet, self).save(commit=False)
+        added, changed = [], []
+        for i, form in enumerate(self.ordered_forms):
+            choice = form.instance
+            order = form.cleaned_data['ORDER']
+            if order is None:
+                order = i + 1
+            if choice.pk is None:
+                choice._order = order
+                added.append(choice)
+            elif 'choice' in form.changed_data or choice._order != order:
+                choice._order = order
+                changed.append(choice)
+        deleted = [f.instance.pk for f in self.deleted_forms if f.instance.pk is not None]
+        Choice.objects.edit_poll_choices(self.instance, added, changed, deleted)
+        return added + changed
 
 
 ChoiceFormSet = inlineformset_factory(
@@ -0,0 +1,270 @@
+"""Live results: the changes of the votes of the polls, pushed to their
+watchers (server-sent events, see views.live_results).
+
+A single publisher per process reads the DB for all the watchers: every
+settings.POLLS_LIVE_RESULTS_MS milliseconds it reads the versions of the
+watched polls (one query), and the choices of those that changed (one query
+more, whatever the number of polls). Each watcher gets the changes of its
+poll in a queue: N watchers of a poll cost one read per change, not N.
+
+The messages are dicts, sent as JSON:
+
+- The first one of a watcher is a snapshot: the votes of all the choices
+  ('full' is True).
+- Then, the deltas: the choices whose votes changed.
+- 'reload' is True if the choices were added, deleted or renamed, or the
+  poll was deleted: the page must be reloaded.
+
+A watcher that doesn't keep up (MAX_PENDING messages waiting) is 'lagging':
+its stream ends, and the client reconnects, for a new snapshot.
+
+With sharded votes (settings.POLLS_VOTE_SHARDS) the version of the poll
+doesn't change with each vote, so the choices of all the watched polls are
+read every time.
+
+"""
+import Queue
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+
+from polls.models import Poll, Choice, ChoiceVotesShard, vote_shards
+
+MAX_PENDING = 100 # Messages per watcher.
+HEARTBEAT = 15 # Seconds between the comments that keep a quiet stream open.
+RETRY_MS = 2000 # Milliseconds before the browser reconnects.
+
+
+def check_interval():
+    """Seconds between the reads of the publisher."""
+    return getattr(settings, 'POLLS_LIVE_RESULTS_MS', 1000) / 1000.0
+
+
+class PollState(object):
+    """The results of a poll, as last published."""
+
+    def __init__(self, version, choices):
+        self.version = version
+        # Choice id: (text, votes).
+        self.choices = choices
+
+    def snapshot(self, poll_id):
+        message = self.message(poll_id, dict((pk, votes) for pk, (text, votes)
+                                             in self.choices.items()))
+        message['full'] = True
+        return message
+
+    def message(self, poll_id, votes):
+        all_votes = [v for text, v in self.choices.values()]
+        return {
+                'poll': poll_id,
+                'version': self.version,
+                'total_votes': sum(all_votes),
+                'max_votes': max(all_votes or [0]),
+                'choices': votes,
+            }
+
+    def delta(self, poll_id, new):
+        """The message from this state to the 'new' one (None if the votes
+        didn't change).
+
+        """
+        if new.choices.keys() != self.choices.keys() or any(
+                new.choices[pk][0] != text for pk, (text, votes) in self.choices.items()):
+            return {'poll': poll_id, 'version': new.version, 'reload': True}
+        votes = dict((pk, v) for pk, (text, v) in new.choices.items()
+                     if v != self.choices[pk][1])
+        return new.message(poll_id, votes) if votes else None
+
+
+class Watcher(object):
+    """The queue of messages of a watcher of a poll."""
+
+    def __init__(self, poll_id):
+        self.poll_id = poll_id
+        self.queue = Queue.Queue(MAX_PENDING)
+        self.lagging = False
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.lagging = True
+
+    def get(self, timeout):
+        """The next message, or None after 'timeout' seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class ResultsPublisher(object):
+    """Publishes the changes of the watched polls to their watchers, from a
+    thread of its own (while there are watchers). Thread safe.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watchers = {} # Poll id: set of Watchers.
+        self.states = {} # Poll id: PollState.
+        self.thread = None
+        self.reads = 0 # Queries, for the benchmarks.
+
+    def subscribe(self, poll_id):
+        """A new Watcher of the poll, whose first message is a snapshot.
+        Raise Poll.DoesNotExist.
+
+        """
+        with self.lock:
+            state = self.states.get(poll_id)
+        if state is None:
+            if not Poll.objects.filter(pk=poll_id).exists():
+                raise Poll.DoesNotExist("No poll %s to watch." % poll_id)
+            state = self.read_states([poll_id]).get(poll_id, PollState(None, {}))
+        watcher = Watcher(poll_id)
+        with self.lock:
+            # The publisher may have a newer one.
+            state = self.states.setdefault(poll_id, state)
+            watcher.put(state.snapshot(poll_id))
+            self.watchers.setdefault(poll_id, set()).add(watcher)
+            if self.thread is None:
+                self.start()
+        return watcher
+
+    def unsubscribe(self, watcher):
+        with self.lock:
+            self.discard(watcher)
+
+    def discard(self, watcher):
+        """Forget the watcher (and its poll, if it was the last one). With
+        the lock held.
+
+        """
+        watchers = self.watchers.get(watcher.poll_id, set())
+        watchers.discard(watcher)
+        if not watchers:
+            self.watchers.pop(watcher.poll_id, None)
+            self.states.pop(watcher.poll_id, None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                time.sleep(check_interval())
+                with self.lock:
+                    if not self.watchers:
+                        self.thread = None
+                        return
+                try:
+                    self.check()
+                except Exception:
+                    # The DB may be back by the next check.
+                    connection.close()
+        finally:
+            connection.close()
+
+    def read_states(self, poll_ids):
+        """The PollStates of the polls (those that exist), read at once."""
+        with self.lock:
+            self.reads += 1
+        rows = Choice.objects.filter(poll_id__in=poll_ids).order_by().values_list(
+                'poll_id', 'pk', 'choice', 'votes', 'poll__version')
+        states = {}
+        for poll_id, pk, text, votes, version in rows:
+            states.setdefault(poll_id, PollState(version, {})).choices[pk] = (text, votes)
+        if vote_shards() > 1 and states:
+            with self.lock:
+                self.reads += 1
+            pending = (ChoiceVotesShard.objects.filter(choice__poll__in=states.keys()).order_by()
+                       .values_list('choice__poll', 'choice').annotate(Sum('votes')))
+            for poll_id, pk, votes in pending:
+                text, v = states[poll_id].choices[pk]
+                states[poll_id].choices[pk] = (text, v + votes)
+        return states
+
+    def check(self):
+        """Read the changes of the watched polls, and publish them. Return
+        the number of messages published.
+
+        """
+        with self.lock:
+            poll_ids = list(self.watchers)
+            states = dict(self.states)
+            if not poll_ids:
+                return 0
+            self.reads += 1
+        versions = dict(Poll.objects.filter(pk__in=poll_ids).order_by().values_list('pk', 'version'))
+        if vote_shards() > 1:
+            changed = list(versions)
+        else:
+            changed = [pk for pk, version in versions.items()
+                       if states.get(pk) is None or states[pk].version != version]
+        new_states = self.read_states(changed) if changed else {}
+        for pk in changed:
+            # A poll without choices.
+            new_states.setdefault(pk, PollState(versions[pk], {}))
+        messages = {}
+        for pk in poll_ids:
+            if pk not in versions:
+                messages[pk] = {'poll': pk, 'reload': True}
+            elif pk in new_states and pk in states:
+                message = states[pk].delta(pk, new_states[pk])
+                if message is not None:
+                    messages[pk] = message
+        published = 0
+        with self.lock:
+            for pk, state in new_states.items():
+                if pk in self.states:
+                    self.states[pk] = state
+            for pk, message in messages.items():
+                for watcher in list(self.watchers.get(pk, ())):
+                    watcher.put(message)
+                    published += 1
+                    if watcher.lagging:
+                        # Its stream ends, if it's still read at all.
+                        self.discard(watcher)
+        return published
+
+    def stream(self, poll_id, duration):
+        """The messages of a new watcher of the poll, as server-sent events,
+        for 'duration' seconds at most (then the browser reconnects). The
+        stream ends too when the page must be reloaded, or the watcher is
+        lagging, and at once if there's no such poll.
+
+        The watcher is subscribed when the stream starts (not if it's closed
+        before), and unsubscribed when it's closed.
+
+        """
+        try:
+            watcher = self.subscribe(poll_id)
+        except Poll.DoesNotExist:
+            return
+        try:
+            yield "retry: %i\n\n" % RETRY_MS
+            deadline = time.time() + duration
+            while not watcher.lagging:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                message = watcher.get(timeout=min(HEARTBEAT, left))
+                if message is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "id: %s\ndata: %s\n\n" % (message.get('version'), json.dumps(message))
+                if message.get('reload'):
+                    break
+        finally:
+            self.unsubscribe(watcher)
+
+
+publisher = ResultsPublisher()
+
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db.models import Count
+from django.test.client import Client
+
+from polls.models import Poll
+from polls.views import NPOLLSINPAGE
+
+
+def read(response):
+    if response.streaming:
+        return ''.join(response.streaming_content)
+    return response.content
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the JSON API against the HTML pages the dashboards "
+            "scrape: the archive, the results of a poll, and the results of "
+            "many polls.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--polls', type=int, default=50,
+                help="Polls whose results are read at once.")
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        ids = list(Poll.objects.annotate(n=Count('choice')).filter(n__gt=0)
+                   .order_by('-n').values_list('pk', flat=True)[:options['polls']])
+        if not ids:
+            raise CommandError("No polls: load some with the load_polls command.")
+        # The HTML results, rendered every time (as for the scrapers, whose
+        # requests are seldom repeated for the same version).
+        settings.POLLS_RESULTS_CACHE = None
+        client = Client(SERVER_NAME='localhost')
+        results_urls = [reverse('polls:results', kwargs={'poll_id': pk}) for pk in ids]
+        api_urls = [reverse('polls:api_results', kwargs={'poll_id': pk}) for pk in ids]
+        bulk_url = "%s?ids=%s" % (reverse('polls:api_bulk_results'), ",".join(map(str, ids)))
+        runs = [
+                ("archive page (HTML)", [reverse('polls:archive')]),
+                ("polls page (JSON)", ["%s?limit=%i" % (reverse('polls:api_polls'), NPOLLSINPAGE)]),
+                ("1000 polls (JSON)", ["%s?limit=1000" % reverse('polls:api_polls')]),
+                ("results (HTML)", results_urls[:1]),
+                ("results (JSON)", api_urls[:1]),
+                ("%i results (HTML)" % len(ids), results_urls),
+                ("%i results (JSON)" % len(ids), api_urls),
+                ("%i results (JSON, bulk)" % len(ids), [bulk_url]),
+            ]
+        self.stdout.write("%-26s %12s %12s" % ("", "ms", "bytes"))
+        for name, urls in runs:
+            start = time.time()
+            for i in xrange(options['repeat']):
+                size = sum(len(read(client.get(url))) for url in urls)
+            elapsed = (time.time() - start) / options['repeat']
+            self.stdout.write("%-26s %12.2f %12i" % (name, elapsed * 1000, size))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+
+from polls.models import Poll
+from polls.pagination import encode_cursor
+from polls.views import PollsArchiveView, NPOLLSINPAGE
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks fetching the archive's first page vs. a deep page, "
+            "with offset and keyset pagination.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, default=10000,
+                help="The deep page (limited by the number of polls).")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        page = min(options['page'], Poll.objects.count() // NPOLLSINPAGE)
+        if page < 2:
+            raise CommandError("Not enough polls: load some with the load_polls command.")
+        # The keyset cursor leading to the same page.
+        last_before = Poll.objects.order_by('-pub_date', '-pk')[(page - 1) * NPOLLSINPAGE - 1]
+        cursor = encode_cursor(last_before)
+
+        runs = [
+                ("offset, page 1", False, {}),
+                ("offset, page %i" % page, False, {'page': page}),
+                ("keyset, page 1", True, {}),
+                ("keyset, page %i" % page, True, {'cursor': cursor}),
+            ]
+        factory = RequestFactory()
+        for name, keyset, params in runs:
+            settings.POLLS_KEYSET_PAGINATION = keyset
+            view = PollsArchiveView(request=factory.get('/polls/archive/', params),
+                                    args=(), kwargs={})
+            start = time.time()
+            for i in xrange(options['repeat']):
+                paginator, page_obj, polls, is_paginated = view.paginate_queryset(
+                        Poll.objects.all(), NPOLLSINPAGE)
+                list(polls)
+            elapsed = (time.time() - start) / options['repeat']
+            self.stdout.write("%-22s %8.2f ms/page" % (name, elapsed * 1000))
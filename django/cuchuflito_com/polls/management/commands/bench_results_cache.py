@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db.models import Count
+from django.test.client import Client
+
+from polls.models import Poll
+from polls.views import results_cache
+
+
+class Command(BaseCommand):
+    help = ("Load test of the results page: requests/sec without cache, with "
+            "the results cache, and with conditional requests (304).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=int,
+                help="Poll to show (default: the one with more choices).")
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['poll']:
+            poll = Poll.objects.filter(pk=options['poll']).first()
+        else:
+            poll = Poll.objects.annotate(n=Count('choice')).order_by('-n').first()
+        if poll is None:
+            raise CommandError("No poll: load some with the load_polls command.")
+        if not getattr(settings, 'POLLS_RESULTS_CACHE', None):
+            settings.POLLS_RESULTS_CACHE = 'polls_results'
+        cache_alias = settings.POLLS_RESULTS_CACHE
+        url = reverse('polls:results', kwargs={'poll_id': poll.pk})
+        client = Client(SERVER_NAME='localhost')
+        etag = client.get(url)['ETag']
+
+        runs = [
+                ("no cache", None, {}),
+                ("cache", cache_alias, {}),
+                ("cache, If-None-Match", cache_alias, {'HTTP_IF_NONE_MATCH': etag}),
+            ]
+        self.stdout.write("Poll %s, %s choices, %s requests per run." % (
+                poll.pk, poll.choice_set.count(), options['requests']))
+        for name, alias, headers in runs:
+            settings.POLLS_RESULTS_CACHE = alias
+            if alias:
+                results_cache().clear()
+                client.get(url)
+            start = time.time()
+            for i in xrange(options['requests']):
+                response = client.get(url, **headers)
+            elapsed = time.time() - start
+            self.stdout.write("%-22s %8.1f requests/s (%s)" % (
+                    name, options['requests'] / elapsed, response.status_code))
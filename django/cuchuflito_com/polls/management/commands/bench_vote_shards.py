@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Compare the votes per second on a single choice with and without
+counter shards, with concurrent writers.
+
+On SQLite the whole DB is locked by each write, so sharding can't help:
+run it against PostgreSQL to see the row-lock contention go away.
+
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from polls.models import ChoiceVotesShard
+from polls.management.commands.stress_votes import hammer_choice
+
+
+class Command(BaseCommand):
+    help = "Benchmarks votes/s for 1 vs. N counter shards per choice."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', default="1,4,16",
+                help="Comma separated numbers of shards to try.")
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--votes', type=int, default=200,
+                help="Votes emitted by each worker.")
+        parser.add_argument('--processes', action='store_true', default=False,
+                help="Use processes instead of threads.")
+
+    def handle(self, *args, **options):
+        user, created = User.objects.get_or_create(username='benchmarks')
+        poll = user.poll_set.create(question="Benchmark poll")
+        choice = poll.choice_set.create(choice="Benchmark choice")
+        try:
+            for nshards in [int(n) for n in options['shards'].split(',')]:
+                settings.POLLS_VOTE_SHARDS = nshards
+                done, elapsed = hammer_choice(
+                        choice.pk, options['workers'], options['votes'],
+                        use_processes=options['processes'])
+                self.stdout.write("%3i shards: %8.0f votes/s" % (nshards, done / elapsed))
+                ChoiceVotesShard.compact()
+        finally:
+            poll.delete()
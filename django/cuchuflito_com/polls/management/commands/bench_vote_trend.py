@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Log many votes of a poll over some days, roll them up, and compare
+reading the trend of the poll from the rollups (the api_trend view) with
+aggregating the events.
+
+    python manage.py bench_vote_trend --events 1000000 --days 30
+
+"""
+import datetime
+import random
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Count
+from django.test.client import Client
+from django.utils import timezone
+
+from polls.models import Poll, VoteEvent, VotesByHour
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the trends of a poll, from the rollups and from the vote events."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=100000)
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        poll = Poll.objects.annotate(n=Count('choice')).order_by('-n').first()
+        if poll is None or not poll.choice_set.exists():
+            raise CommandError("No poll: load some with the load_polls command.")
+        choices = list(poll.choice_set.values_list('pk', flat=True))
+        until = timezone.now()
+        since = until - datetime.timedelta(days=options['days'])
+        span = (until - since).total_seconds()
+
+        start = time.time()
+        step = span / options['events']
+        for i in xrange(0, options['events'], 50000):
+            # In the order they are voted, as logged.
+            with transaction.atomic():
+                VoteEvent.objects.bulk_create(
+                        VoteEvent(poll=poll, choice_id=random.choice(choices),
+                                  created=since + datetime.timedelta(seconds=j * step))
+                        for j in xrange(i, min(i + 50000, options['events'])))
+        self.stdout.write("%i events logged in %.2fs." % (options['events'], time.time() - start))
+        start = time.time()
+        rolled = VoteEvent.roll_up()
+        elapsed = time.time() - start
+        self.stdout.write("%i events rolled up in %.2fs (%i events/s), into %i hourly rows." % (
+                rolled, elapsed, rolled / elapsed, VotesByHour.objects.filter(poll=poll).count()))
+
+        client = Client(SERVER_NAME='localhost')
+        url = "%s?period=hour&since=%s&until=%s" % (
+                reverse('polls:api_trend', kwargs={'poll_id': poll.pk}),
+                since.strftime("%Y-%m-%dT%H:%M:%SZ"), until.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        start = time.time()
+        for i in xrange(options['repeat']):
+            client.get(url)
+        rollups = (time.time() - start) / options['repeat']
+
+        start = time.time()
+        for i in xrange(options['repeat']):
+            trend = defaultdict(lambda: defaultdict(int))
+            events = (VoteEvent.objects.filter(poll=poll, created__range=(since, until))
+                      .values_list('choice', 'created', 'votes').iterator())
+            for choice_id, created, votes in events:
+                trend[VotesByHour.truncate(created)][choice_id] += votes
+        scan = (time.time() - start) / options['repeat']
+        self.stdout.write("Hourly trend of %i days: %.1f ms from the rollups, %.1f ms "
+                          "from the events." % (options['days'], rollups * 1000, scan * 1000))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Latency of the votes with the voter ledger (Choice.vote_once), as the
+ledger grows: the ledger is filled up to each of the sizes, and then a
+choice is voted by new voters, by voters already in the ledger (refused),
+and with no ledger (vote_me).
+
+    python manage.py bench_voter_ledger --rows 10000,100000,1000000
+
+"""
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from polls.models import Poll, Choice, Voter, AlreadyVoted
+
+
+class Command(BaseCommand):
+    help = "Benchmarks voting with the voter ledger, as it grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', default="0,10000,100000,1000000",
+                help="Comma separated sizes of the ledger to measure at.")
+        parser.add_argument('--votes', type=int, default=500,
+                help="Votes of each kind per size.")
+
+    def handle(self, *args, **options):
+        choice = Choice.objects.order_by('pk').first()
+        poll_ids = list(Poll.objects.values_list('pk', flat=True))
+        if choice is None:
+            raise CommandError("No choice to vote for: load some polls with load_polls.")
+        sizes = sorted(int(n) for n in options['rows'].split(','))
+        n = options['votes']
+        self.stdout.write("%12s %14s %14s %14s" % (
+                "ledger rows", "new voter us", "repeated us", "no ledger us"))
+        for size in sizes:
+            self.fill(size, poll_ids)
+            voters = [Voter.key_of(uuid.uuid4().hex) for i in xrange(n)]
+            start = time.time()
+            for voter in voters:
+                choice.vote_once(voter=voter)
+            new = (time.time() - start) / n
+            start = time.time()
+            for voter in voters:
+                try:
+                    choice.vote_once(voter=voter)
+                except AlreadyVoted:
+                    pass
+            repeated = (time.time() - start) / n
+            start = time.time()
+            for i in xrange(n):
+                choice.vote_me()
+            plain = (time.time() - start) / n
+            self.stdout.write("%12i %14.1f %14.1f %14.1f" % (
+                    Voter.objects.count(), new * 1e6, repeated * 1e6, plain * 1e6))
+
+    def fill(self, size, poll_ids):
+        """Add made up voters to the ledger, up to 'size' rows."""
+        missing = size - Voter.objects.count()
+        while missing > 0:
+            batch = min(missing, 50000)
+            with transaction.atomic():
+                Voter.objects.bulk_create(
+                        Voter(poll_id=poll_ids[i % len(poll_ids)], key=uuid.uuid4().hex)
+                        for i in xrange(batch))
+            missing -= batch
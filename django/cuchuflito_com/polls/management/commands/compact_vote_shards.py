@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.models import ChoiceVotesShard
+
+
+class Command(BaseCommand):
+    help = "Adds the votes kept in counter shards to their choices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=None, metavar='SECONDS',
+                help="Keep running, compacting every SECONDS seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            moved = ChoiceVotesShard.compact()
+            self.stdout.write("%i votes compacted." % moved)
+            if options['every'] is None:
+                break
+            time.sleep(options['every'])
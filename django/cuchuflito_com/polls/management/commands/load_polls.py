@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Bulk loading of polls (and their choices).
+
+The input is read as a stream, and written in chunks of --batch polls, each
+one in its own transaction, with one INSERT for the polls and a few for the
+choices (bulk_create). The ids of the polls are assigned here (from the
+biggest one in the DB) so the choices can point to them: don't create polls
+while loading.
+
+Input formats (by the file's extension, or --format):
+
+  txt    One question per line. Each poll gets the --choices.
+  csv    question,pub_date,choice,choice,... (pub_date may be empty).
+  jsonl  One object per line: {"question": "...", "pub_date": "...",
+         "choices": ["Yes", {"choice": "No", "votes": 3}, ...]}.
+
+Polls without a pub_date are published one --step apart, backwards from now.
+
+"""
+import codecs
+import csv
+import datetime
+import io
+import json
+import random
+import sys
+import time
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from polls.models import Poll, Choice, PollStats
+
+FORMATS = ('txt', 'csv', 'jsonl')
+DEFAULT_CHOICES = u"Yes,No,WTF?"
+
+
+def read_txt(stream, choices):
+    for line in stream:
+        question = line.strip()
+        if question:
+            yield question, None, [(c, 0) for c in choices]
+
+
+def read_csv(stream, choices):
+    for row in csv.reader(stream):
+        row = [cell.decode('utf-8').strip() for cell in row]
+        if row and row[0]:
+            yield row[0], row[1] if len(row) > 1 else None, [(c, 0) for c in row[2:] if c]
+
+
+def read_jsonl(stream, choices):
+    for n, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            choices = [(c, 0) if isinstance(c, basestring) else (c['choice'], int(c.get('votes', 0)))
+                       for c in item.get('choices', ())]
+            yield item['question'], item.get('pub_date'), choices
+        except (ValueError, KeyError, TypeError) as e:
+            raise CommandError("Bad JSON poll in line %i: %s" % (n, e))
+
+
+def synthetic(count, choices_per_poll, max_votes, seed=None):
+    """'count' made up polls, with random votes."""
+    rnd = random.Random(seed)
+    for n in xrange(1, count + 1):
+        yield (u"Synthetic question #%i?" % n, None,
+               [(u"Answer %i" % i, rnd.randint(0, max_votes)) for i in range(1, choices_per_poll + 1)])
+
+
+class Command(BaseCommand):
+    help = "Loads polls in bulk, from a txt, CSV or JSONL file, or made up."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                help="File to load ('-' for the standard input).")
+        parser.add_argument('--format', choices=FORMATS,
+                help="Format of the input (default: by the file's extension).")
+        parser.add_argument('--synthetic', type=int, metavar='N',
+                help="Load N made up polls, with random votes.")
+        parser.add_argument('--synthetic-choices', type=int, default=3,
+                help="Choices per made up poll.")
+        parser.add_argument('--synthetic-votes', type=int, default=100,
+                help="Maximum votes per made up choice.")
+        parser.add_argument('--seed', type=int, help="Seed of the made up votes.")
+        parser.add_argument('--choices', default=DEFAULT_CHOICES,
+                help="Comma separated choices of the txt polls.")
+        parser.add_argument('--user',
+                help="Username of the creator of the polls (default: the first superuser).")
+        parser.add_argument('--batch', type=int, default=1000,
+                help="Polls per transaction.")
+        parser.add_argument('--step', type=int, default=60,
+                help="Seconds between the pub_date of polls without one.")
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['user'])
+        rows = self.get_rows(options)
+        self.verbosity = int(options.get('verbosity', 1))
+        self.step = datetime.timedelta(seconds=options['step'])
+        self.now = timezone.now()
+        self.loaded = 0
+
+        start = time.time()
+        polls = choices = 0
+        while True:
+            chunk = list(islice(rows, options['batch']))
+            if not chunk:
+                break
+            n_choices = self.load_chunk(chunk, user)
+            polls += len(chunk)
+            choices += n_choices
+            if self.verbosity > 1:
+                self.stdout.write("%i polls, %i choices: %.0f rows/s" % (
+                        polls, choices, (polls + choices) / (time.time() - start)))
+        self.reset_sequences()
+        PollStats.refresh()
+        elapsed = time.time() - start
+        self.stdout.write("Loaded %i polls and %i choices in %.2f s (%.0f rows/s)." % (
+                polls, choices, elapsed, (polls + choices) / elapsed if elapsed else 0))
+
+    def get_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError("There is no user %r." % username)
+        user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if user is None:
+            raise CommandError("There is no superuser: use --user.")
+        return user
+
+    def get_rows(self, options):
+        """The input, as (question, pub_date, [(choice, votes), ...])."""
+        if options['synthetic'] is not None:
+            return synthetic(options['synthetic'], options['synthetic_choices'],
+                             options['synthetic_votes'], options['seed'])
+        path = options['path']
+        if not path:
+            raise CommandError("Give a file to load, or --synthetic.")
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if format not in FORMATS:
+            raise CommandError("Unknown format %r: use --format." % format)
+        if path == '-':
+            stream = sys.stdin
+            if format != 'csv':
+                stream = codecs.getreader('utf-8')(stream)
+        elif format == 'csv':
+            stream = open(path, 'rb')
+        else:
+            stream = io.open(path, encoding='utf-8')
+        choices = [c.strip() for c in options['choices'].split(',') if c.strip()]
+        reader = {'txt': read_txt, 'csv': read_csv, 'jsonl': read_jsonl}[format]
+        return reader(stream, choices)
+
+    def pub_date(self, value):
+        if value:
+            date = parse_datetime(value) if isinstance(value, basestring) else None
+            if date is None:
+                raise CommandError("Bad pub_date: %r" % value)
+            if timezone.is_naive(date):
+                date = timezone.make_aware(date, timezone.get_default_timezone())
+            return date
+        self.loaded += 1
+        return self.now - self.step * (self.loaded - 1)
+
+    def load_chunk(self, chunk, user):
+        """Insert the polls of the chunk, and their choices, in a transaction.
+        Return the number of choices.
+
+        """
+        with transaction.atomic():
+            next_id = (Poll.objects.aggregate(max=Max('pk'))['max'] or 0) + 1
+            polls, choices = [], []
+            for poll_id, (question, pub_date, poll_choices) in enumerate(chunk, next_id):
+                seen = set()
+                votes = []
+                for text, n in poll_choices:
+                    if text in seen:
+                        continue
+                    seen.add(text)
+                    choices.append(Choice(poll_id=poll_id, choice=text[:200], votes=n,
+                                          _order=len(votes)))
+                    votes.append(n)
+                polls.append(Poll(pk=poll_id, question=question[:200], created_by=user,
+                                  pub_date=self.pub_date(pub_date),
+                                  total_votes=sum(votes), max_votes=max(votes or [0])))
+            Poll.objects.bulk_create(polls)
+            Choice.objects.bulk_create(choices)
+        return len(choices)
+
+    def reset_sequences(self):
+        """The ids were given explicitly: let the DB's sequences catch up."""
+        statements = connection.ops.sequence_reset_sql(no_style(), [Poll, Choice])
+        if statements:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                for sql in statements:
+                    cursor.execute(sql)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from polls.models import VoteRequest
+
+
+class Command(BaseCommand):
+    help = ("Deletes the idempotency keys of the vote requests older than "
+            "settings.POLLS_VOTE_REQUEST_DAYS: retrying them votes again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float,
+                default=getattr(settings, 'POLLS_VOTE_REQUEST_DAYS', 2))
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        old = VoteRequest.objects.filter(created__lt=before)
+        n = old.count()
+        old.delete()
+        self.stdout.write("%i vote requests purged." % n)
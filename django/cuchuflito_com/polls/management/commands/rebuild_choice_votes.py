@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.models import VoteEvent
+
+
+class Command(BaseCommand):
+    help = ("Recomputes Choice.votes from the log of the votes (and then the "
+            "totals of their polls).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', default=False,
+                help="Only report the choices whose votes drifted, and fail if any.")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            drifted = VoteEvent.drifted_choices()
+            self.stdout.write("%i choices with drifted votes." % len(drifted))
+            if drifted:
+                raise CommandError("Drifted choices: %s" % ", ".join(
+                        str(pk) for pk, poll_id, votes in drifted))
+            return
+        self.stdout.write("%i choices fixed." % VoteEvent.rebuild_votes())
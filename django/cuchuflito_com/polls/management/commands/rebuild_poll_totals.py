@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum, Max
+
+from polls.models import Poll, Choice
+
+
+class Command(BaseCommand):
+    help = "Recomputes Poll.total_votes and Poll.max_votes from the choices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', default=False,
+                help="Only report the polls whose totals drifted, and fail if any.")
+
+    def handle(self, *args, **options):
+        expected = dict(
+                (poll_id, (total or 0, top or 0)) for poll_id, total, top in
+                Choice.objects.order_by().values_list('poll').annotate(Sum('votes'), Max('votes'))
+            )
+        drifted = []
+        for poll_id, total, top in Poll.objects.values_list(
+                'pk', 'total_votes', 'max_votes').iterator():
+            if (total, top) != expected.get(poll_id, (0, 0)):
+                drifted.append(poll_id)
+        self.stdout.write("%i polls with drifted totals." % len(drifted))
+
+        if options['check']:
+            if drifted:
+                raise CommandError("Drifted polls: %s" % ", ".join(map(str, drifted)))
+            return
+        for poll in Poll.objects.filter(pk__in=drifted).iterator():
+            poll.refresh_totals()
+        self.stdout.write("%i polls fixed." % len(drifted))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.models import PollStats
+
+
+class Command(BaseCommand):
+    help = "Recomputes from scratch the statistics shown in the facts page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=None, metavar='SECONDS',
+                help="Keep running, refreshing every SECONDS seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            stats = PollStats.refresh()
+            self.stdout.write("%i votes in %i choices, updated at %s." % (
+                    stats.votes, stats.choices, stats.updated))
+            if options['every'] is None:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from polls.models import VoteEvent
+
+
+class Command(BaseCommand):
+    help = ("Adds the votes logged since the last time to the rollups by "
+            "minute, hour and day.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=None, metavar='SECONDS',
+                help="Keep running, rolling up every SECONDS seconds.")
+        parser.add_argument('--lag', type=float,
+                default=getattr(settings, 'POLLS_VOTE_ROLLUP_LAG', 0),
+                help="Leave the votes of the last LAG seconds for the next time.")
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                help="Delete the rollups first, and roll up the whole log.")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            VoteEvent.reset_rollups()
+        while True:
+            rolled = VoteEvent.roll_up(lag=options['lag'])
+            self.stdout.write("%i vote events rolled up." % rolled)
+            if options['every'] is None:
+                break
+            time.sleep(options['every'])
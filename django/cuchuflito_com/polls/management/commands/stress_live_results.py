@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Watch the live results of a poll from many simulated watchers while it's
+voted, and check that they all end with the votes in the DB.
+
+Each watcher is a thread reading the server-sent events of the publisher
+(as the live_results view streams them), and applying the messages as the
+browser does. Run it against a real (shared) database:
+
+    python manage.py stress_live_results --watchers 500 --votes 300
+
+"""
+import json
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+
+from polls.models import Poll, Choice
+from polls.liveresults import publisher
+
+
+def watch(poll_id, votes, done):
+    """Apply the events of a watcher of the poll to 'votes' (choice id:
+    votes), until 'done' is set.
+
+    """
+    for event in publisher.stream(poll_id, duration=3600):
+        if event.startswith("id: "):
+            message = json.loads(event.split("data: ", 1)[1])
+            if message.get('full'):
+                votes.clear()
+            votes.update((int(pk), n) for pk, n in message['choices'].items())
+        if done.is_set():
+            break
+
+
+class Command(BaseCommand):
+    help = ("Watches the live results of a poll from many threads while it's "
+            "voted, and checks they all get the final votes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=int,
+                help="Poll to watch (default: the one with more choices).")
+        parser.add_argument('--watchers', type=int, default=200)
+        parser.add_argument('--votes', type=int, default=200)
+        parser.add_argument('--interval', type=int, default=100,
+                help="Milliseconds between the checks of the publisher.")
+
+    def handle(self, *args, **options):
+        if options['poll']:
+            poll = Poll.objects.filter(pk=options['poll']).first()
+        else:
+            poll = Poll.objects.annotate(n=Count('choice')).order_by('-n').first()
+        if poll is None or not poll.choice_set.exists():
+            raise CommandError("No poll: load some with the load_polls command.")
+        settings.POLLS_LIVE_RESULTS_MS = options['interval']
+        choices = list(poll.choice_set.all())
+
+        done = threading.Event()
+        states = [{} for i in xrange(options['watchers'])]
+        threads = [threading.Thread(target=watch, args=(poll.pk, votes, done))
+                   for votes in states]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        reads = publisher.reads
+        start = time.time()
+        for i in xrange(options['votes']):
+            random.choice(choices).vote_me()
+        voting = time.time() - start
+
+        final = dict(Choice.objects.filter(poll=poll).values_list('pk', 'votes'))
+        deadline = time.time() + 10
+        while time.time() < deadline and any(votes != final for votes in states):
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        reads = publisher.reads - reads
+        behind = len([votes for votes in states if votes != final])
+        done.set()
+        connection.close()
+
+        self.stdout.write("%i watchers, %i votes in %.2fs: up to date %.2fs after "
+                          "the first vote, with %i reads of the DB (%.2f per watcher)." % (
+                len(states), options['votes'], voting, elapsed, reads,
+                float(reads) / len(states)))
+        if behind:
+            raise CommandError("%i watchers didn't get the final votes." % behind)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Hammer a single choice with concurrent votes and check none is lost.
+
+Run it against a real (shared) database, e.g. a SQLite file or a local
+PostgreSQL:
+
+    python manage.py stress_votes --workers 16 --votes 500 --processes
+
+"""
+import time
+import Queue
+import multiprocessing
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+
+from polls.models import Choice
+
+
+def vote_worker(choice_id, nvotes, results):
+    """Vote 'nvotes' times for the choice, putting the number of
+    successful votes in the 'results' queue.
+
+    A vote that fails because the DB is locked (SQLite) is retried: it
+    never reached the DB, so retrying can't count it twice.
+
+    """
+    done = 0
+    try:
+        choice = Choice.objects.get(pk=choice_id)
+        for i in xrange(nvotes):
+            while True:
+                try:
+                    choice.vote_me()
+                    break
+                except OperationalError:
+                    time.sleep(0.001)
+            done += 1
+    finally:
+        connection.close()
+        results.put(done)
+
+
+def hammer_choice(choice_id, workers, nvotes, use_processes=False):
+    """Vote concurrently for a choice from 'workers' threads (or processes),
+    'nvotes' times each. Return (successful votes, elapsed seconds).
+
+    """
+    if use_processes:
+        # Children must not share the parent's DB connection.
+        connection.close()
+        results = multiprocessing.Queue()
+        runner = multiprocessing.Process
+    else:
+        results = Queue.Queue()
+        runner = threading.Thread
+    jobs = [runner(target=vote_worker, args=(choice_id, nvotes, results))
+            for i in xrange(workers)]
+    start = time.time()
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    elapsed = time.time() - start
+    return sum(results.get() for job in jobs), elapsed
+
+
+class Command(BaseCommand):
+    help = "Votes concurrently for a choice and verifies that no vote is lost."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--choice', type=int, default=None,
+                help="Id of the choice to vote for (default: the first one).")
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--votes', type=int, default=200,
+                help="Votes emitted by each worker.")
+        parser.add_argument('--processes', action='store_true', default=False,
+                help="Use processes instead of threads.")
+
+    def handle(self, *args, **options):
+        try:
+            if options['choice'] is None:
+                choice = Choice.objects.order_by('pk')[0]
+            else:
+                choice = Choice.objects.get(pk=options['choice'])
+        except (IndexError, Choice.DoesNotExist):
+            raise CommandError("No choice to vote for.")
+
+        before = choice.votes
+        done, elapsed = hammer_choice(
+                choice.pk, options['workers'], options['votes'],
+                use_processes=options['processes'])
+        after = Choice.objects.get(pk=choice.pk).votes
+        lost = done - (after - before)
+        self.stdout.write("%i votes in %.2fs (%.0f votes/s), %i lost." % (
+                done, elapsed, done / elapsed, lost))
+        if lost:
+            raise CommandError("%i votes were lost." % lost)
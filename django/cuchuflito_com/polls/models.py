@@ -1,21 +1,60 @@
 import datetime
-from django.db import models
+import hashlib
+import random
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from django.core.urlresolvers import reverse
-from django.db.models import Max, F
+from django.db.models import Max, Sum, Count, F, Case, When, Value
 from django.contrib.auth.models import User
+from django.utils.crypto import salted_hmac
+
+# Choices per statement of ChoiceManager.edit_poll_choices (SQLite allows 999
+# parameters per statement, and each choice takes 5 in the UPDATE).
+EDIT_BATCH_SIZE = 100
+# Events per transaction of VoteEvent.roll_up.
+ROLLUP_BATCH_SIZE = 10000
+
+
+def vote_shards():
+    """Number of counter shards per choice. 0 or 1 means no sharding."""
+    return getattr(settings, 'POLLS_VOTE_SHARDS', 0)
+
+
+def log_vote_events():
+    """Whether the votes are logged as VoteEvents."""
+    return getattr(settings, 'POLLS_VOTE_EVENTS', False)
 
 
 class Poll(models.Model):
     """A poll about cuchuflitos."""
-    question = models.CharField(max_length=200)
+    question = models.CharField(max_length=200, db_index=True)
     pub_date = models.DateTimeField("date published", default=timezone.now)
     created_by = models.ForeignKey(User)
+    # Denormalized from the choices' votes by ChoiceManager.add_votes and
+    # Poll.refresh_totals. Rebuild them with the rebuild_poll_totals command.
+    total_votes = models.PositiveIntegerField(default=0, db_index=True)
+    max_votes = models.PositiveIntegerField(default=0, db_index=True)
+    # Bumped, with 'modified', whenever the poll or its results change: the
+    # results page is cached by version (see views.PollResults).
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField("last modified", default=timezone.now)
+
+    # Written only with UPDATEs (F() expressions), never by save(): a stale
+    # instance must not overwrite them.
+    COUNTERS = ('total_votes', 'max_votes', 'version', 'modified')
 
     class Meta:
         ordering = ['-pub_date']
+        # Archives: by date, and keyset pagination (polls.pagination).
+        index_together = [("pub_date", "id")]
         #order_with_respect_to = 'created_by'
-        permissions = (('can_view_stats', 'Can view the statistics?'),)
+        permissions = (
+                ('can_view_stats', 'Can view the statistics?'),
+                ('can_ingest_votes', 'Can send votes in bulk?'),
+            )
 
     def was_published_recently(self):
         """Return true if the poll was created from yesterday, afterwards."""
@@ -32,33 +71,739 @@ class Poll(models.Model):
 
     def get_max_votes(self):
         """Return the number of votes of the most voted choice."""
+        if vote_shards() > 1:
+            return max([c.votes for c in self.get_sharded_choices()] or [0])
         return self.choice_set.aggregate(max=Max('votes'))['max'] or 0
 
     def has_winners(self):
         """Return the choices with more votes than the rest."""
+        if vote_shards() > 1:
+            choices = self.get_sharded_choices()
+            M = max([c.votes for c in choices] or [0])
+            return [c for c in choices if c.votes > 0 and c.votes == M]
         voted_choices = self.choice_set.filter(votes__gt=0).order_by('-votes')
         M = voted_choices.aggregate(max=Max('votes'))['max']
         return voted_choices.filter(votes=M)
 
     def get_ordered_choices(self):
         """Most voted choices, first."""
+        if vote_shards() > 1:
+            return self.get_sharded_choices()
         return self.choice_set.order_by('-votes')
 
+    def save(self, *args, **kwargs):
+        """Save the poll. Saving a poll loaded from the DB doesn't write its
+        COUNTERS, and bumps its version.
+
+        """
+        if (self._state.adding or kwargs.get('force_insert')
+                or kwargs.get('update_fields') is not None):
+            return super(Poll, self).save(*args, **kwargs)
+        kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                   if not f.primary_key and f.name not in self.COUNTERS]
+        with transaction.atomic():
+            super(Poll, self).save(*args, **kwargs)
+            self.touch()
+
+    def touch(self):
+        """Bump the version of the poll (its cached results are stale)."""
+        Poll.objects.filter(pk=self.pk).update(
+                version=F('version') + 1, modified=timezone.now())
+
+    def delete(self, *args, **kwargs):
+        """Delete the poll (and its choices), and refresh the statistics."""
+        with transaction.atomic():
+            super(Poll, self).delete(*args, **kwargs)
+            PollStats.refresh()
+
+    def refresh_totals(self):
+        """Recompute total_votes and max_votes from the choices, and save them.
+
+        The poll's row is locked first: a concurrent vote updates the totals
+        after this, so its vote is not lost.
+
+        """
+        with transaction.atomic():
+            list(Poll.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
+            totals = self.choice_set.aggregate(total=Sum('votes'), max=Max('votes'))
+            self.total_votes = totals['total'] or 0
+            self.max_votes = totals['max'] or 0
+            Poll.objects.filter(pk=self.pk).update(
+                    total_votes=self.total_votes, max_votes=self.max_votes,
+                    version=F('version') + 1, modified=timezone.now())
+
+    def get_results(self):
+        """Return the VotingResults of the poll, reading the choices once."""
+        if vote_shards() > 1:
+            return VotingResults(self.get_sharded_choices())
+        return VotingResults(list(self.choice_set.order_by('-votes')))
+
+    def get_sharded_choices(self):
+        """Most voted choices first, with the votes still in their counter
+        shards added to Choice.votes.
+
+        """
+        pending = dict(ChoiceVotesShard.objects.filter(choice__poll=self)
+                .values_list('choice').annotate(Sum('votes')))
+        choices = list(self.choice_set.all())
+        for choice in choices:
+            choice.votes += pending.get(choice.pk) or 0
+        choices.sort(key=lambda c: c.votes, reverse=True)
+        return choices
+
+class VotingResults(object):
+    """The choices of a poll (most voted first), the votes of the most voted
+    one, and the winners: the choices with that many votes (if any).
+
+    """
+    def __init__(self, choices):
+        self.choices = choices
+        self.max_votes = choices[0].votes if choices else 0
+        self.winners = [c for c in choices if c.votes > 0 and c.votes == self.max_votes]
+
+
+class ChoiceManager(models.Manager):
+    def add_votes(self, poll_id, counts, log_events=True):
+        """Add votes to choices of a poll, with a single UPDATE, and update
+        the poll's total_votes, max_votes and version.
+
+        'counts' maps choice ids to the number of votes to add to each one.
+        Return a dict with the new number of votes of the updated choices.
+
+        The votes are logged (see VoteEvent) in the same transaction, with
+        one INSERT, unless 'log_events' is False (they are logged apart).
+
+        """
+        if len(counts) == 1:
+            increment = Value(counts.values()[0])
+        else:
+            increment = Case(
+                    *[When(pk=pk, then=Value(n)) for pk, n in counts.items()],
+                    default=Value(0),
+                    output_field=models.IntegerField()
+                )
+        choices = self.filter(poll_id=poll_id, pk__in=counts.keys())
+        with transaction.atomic():
+            choices.update(votes=F('votes') + increment)
+            new_votes = dict(choices.order_by().values_list('pk', 'votes'))
+            added = sum(counts[pk] for pk in new_votes)
+            top = max(new_votes.values() or [0])
+            now = timezone.now()
+            Poll.objects.filter(pk=poll_id).update(
+                    total_votes=F('total_votes') + added,
+                    max_votes=Case(
+                            When(max_votes__lt=top, then=Value(top)),
+                            default=F('max_votes'),
+                        ),
+                    version=F('version') + 1,
+                    modified=now,
+                )
+            if log_events and log_vote_events():
+                VoteEvent.log(poll_id, dict((pk, counts[pk]) for pk in new_votes), now)
+        return new_votes
+
+    def edit_poll_choices(self, poll, added=(), changed=(), deleted=()):
+        """Apply an edition of the choices of 'poll', in one transaction and
+        with a statement (per batch of EDIT_BATCH_SIZE choices) for each kind
+        of change, however many choices there are:
+
+        - 'deleted': ids of choices of the poll, deleted first (so their
+          texts can be given to other choices).
+        - 'changed': saved choices, whose text and _order are written by a
+          single UPDATE.
+        - 'added': new choices (with their _order), inserted by bulk_create.
+
+        Then the totals of the poll and the statistics are updated.
+
+        """
+        with transaction.atomic():
+            removed = []
+            for ids in batches(list(deleted)):
+                choices = self.filter(poll_id=poll.pk, pk__in=ids)
+                removed += list(choices)
+                choices.delete()
+            for batch in batches(list(changed)):
+                self.filter(poll_id=poll.pk, pk__in=[c.pk for c in batch]).update(
+                        choice=Case(
+                                *[When(pk=c.pk, then=Value(c.choice)) for c in batch],
+                                output_field=models.CharField()
+                            ),
+                        _order=Case(
+                                *[When(pk=c.pk, then=Value(c._order)) for c in batch],
+                                output_field=models.IntegerField()
+                            ),
+                    )
+            if added:
+                for choice in added:
+                    choice.poll = poll
+                self.bulk_create(added)
+                PollStats.objects.filter(pk=PollStats.SINGLETON).update(
+                        choices=F('choices') + len(added))
+            if removed:
+                # They take their votes away.
+                poll.refresh_totals()
+                PollStats.remove_choices(removed)
+            elif added or changed:
+                poll.touch()
+
+
+def batches(items, size=EDIT_BATCH_SIZE):
+    """'items' in lists of 'size' at most."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class Choice(models.Model):
     poll = models.ForeignKey(Poll) 
     choice = models.CharField(max_length=200) 
     votes = models.PositiveIntegerField(default=0)
 
+    objects = ChoiceManager()
+
     class Meta:
         order_with_respect_to = 'poll'
         unique_together = [("poll", "choice")]
+        # The results of a poll: choice_set.order_by('-votes'), max votes.
+        index_together = [("poll", "votes")]
         ordering = ['order',]
 
     def __unicode__(self):
         return self.choice
 
-    def vote_me(self):
-        """Increment in 1 the votes for this choice, and save."""
-        self.votes += 1
-        self.save()
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        with transaction.atomic():
+            super(Choice, self).save(*args, **kwargs)
+            if created:
+                PollStats.objects.filter(pk=PollStats.SINGLETON).update(
+                        choices=F('choices') + 1)
+
+    def delete(self, *args, **kwargs):
+        """Delete the choice, and recompute the totals of its poll and the
+        statistics.
+
+        """
+        with transaction.atomic():
+            self.votes = Choice.objects.values_list('votes', flat=True).get(pk=self.pk)
+            super(Choice, self).delete(*args, **kwargs)
+            self.poll.refresh_totals()
+            PollStats.remove_choices([self])
+
+    def vote_me(self, log=True):
+        """Increment in 1 the votes for this choice, and return the new count.
+
+        The increment is done by the DB in a single UPDATE (votes = votes + 1),
+        so concurrent voters never overwrite each other's votes. The instance
+        is not saved: only its 'votes' attribute is refreshed.
+
+        With settings.POLLS_VOTE_WRITE_BEHIND the vote is only buffered (see
+        polls.votebuffer), and None is returned.
+
+        The vote is logged (see log_vote) once it's committed. If 'log' is
+        False it isn't: the caller logs it after committing its transaction.
+
+        """
+        if self.pk is None:
+            raise IntegrityError("Can't vote for a choice not saved in the DB.")
+        if getattr(settings, 'POLLS_VOTE_WRITE_BEHIND', False):
+            from polls.votebuffer import vote_buffer
+            vote_buffer.add(self)
+            return None
+        if vote_shards() > 1:
+            self.vote_me_sharded()
+        else:
+            new_votes = Choice.objects.add_votes(self.poll_id, {self.pk: 1}, log_events=False)
+            if self.pk not in new_votes:
+                raise Choice.DoesNotExist("The choice to vote for doesn't exist.")
+            self.votes = new_votes[self.pk]
+        if log:
+            # Sharded ones too: now, and not when the shards are compacted.
+            self.log_vote()
+        return self.votes
+
+    def log_vote(self):
+        """Log a vote for this choice in the next batch of VoteEvents (see
+        polls.votebuffer.event_buffer), if the votes are logged. Call it out
+        of any transaction: a vote rolled back must not be logged, and a
+        full buffer is flushed then. It never raises.
+
+        """
+        if log_vote_events():
+            from polls.votebuffer import event_buffer
+            event_buffer.add(self)
+
+    def vote_once(self, voter=None, request_key=None):
+        """Vote for this choice (see vote_me), once per 'request_key' (an
+        idempotency key: a retry of the request doesn't vote again) and, if
+        'voter' is given, once per voter and poll (see Voter.key_of).
+
+        Return the new count, or None if the vote was buffered or the
+        request is a repeat (its vote was already counted). Raise
+        AlreadyVoted.
+
+        """
+        buffered = getattr(settings, 'POLLS_VOTE_WRITE_BEHIND', False)
+        with transaction.atomic():
+            if request_key is not None and not VoteRequest.record(self.poll_id, request_key):
+                return None
+            if voter is not None and not Voter.record(self.poll_id, voter):
+                raise AlreadyVoted(u"Already voted in this poll.")
+            if not buffered:
+                votes = self.vote_me(log=False)
+        if buffered:
+            # Out of the transaction, where a full buffer can be flushed.
+            return self.vote_me()
+        # Once the vote is committed.
+        self.log_vote()
+        return votes
+
+    def vote_me_sharded(self):
+        """Add the vote to one of the counter shards of this choice, picked
+        at random, and return the total number of votes.
+
+        Concurrent voters of a hot choice update different rows, instead of
+        queueing on the lock of the choice's row.
+
+        """
+        shard = random.randrange(vote_shards())
+        shard_votes = ChoiceVotesShard.objects.filter(choice_id=self.pk, shard=shard)
+        with transaction.atomic():
+            if not shard_votes.update(votes=F('votes') + 1):
+                try:
+                    with transaction.atomic():
+                        ChoiceVotesShard.objects.create(
+                                choice_id=self.pk, shard=shard, votes=1)
+                except IntegrityError:
+                    # Someone else created the shard in the meantime.
+                    shard_votes.update(votes=F('votes') + 1)
+            self.votes = Choice.objects.values_list('votes', flat=True).get(pk=self.pk)
+            self.votes += self.shards.aggregate(s=Sum('votes'))['s'] or 0
+        return self.votes
+
+
+class ChoiceVotesShard(models.Model):
+    """Part of the votes of a choice, not yet added to Choice.votes.
+
+    Used when settings.POLLS_VOTE_SHARDS > 1. See ChoiceVotesShard.compact.
+
+    """
+    choice = models.ForeignKey(Choice, related_name='shards')
+    shard = models.PositiveSmallIntegerField()
+    votes = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("choice", "shard")]
+
+    def __unicode__(self):
+        return u"%s [%i]" % (self.choice, self.shard)
+
+    @classmethod
+    def compact(cls):
+        """Move the votes of the shards to their choices. Return the number
+        of votes moved.
+
+        Each shard is locked and folded in its own transaction, so voting
+        can go on meanwhile.
+
+        """
+        moved = 0
+        for pk in cls.objects.filter(votes__gt=0).values_list('pk', flat=True):
+            with transaction.atomic():
+                shard = cls.objects.select_for_update().select_related('choice').get(pk=pk)
+                if shard.votes:
+                    Choice.objects.add_votes(
+                            shard.choice.poll_id, {shard.choice_id: shard.votes},
+                            log_events=False)
+                    cls.objects.filter(pk=pk).update(votes=F('votes') - shard.votes)
+                    moved += shard.votes
+        return moved
+
+
+class AlreadyVoted(Exception):
+    pass
+
+
+class Voter(models.Model):
+    """A voter of a poll: the ledger of who voted where, with
+    settings.POLLS_ONE_VOTE_PER_VOTER (see Choice.vote_once).
+
+    The voters are kept as short digests (see key_of), and looked up only by
+    the unique index: a vote inserts its voter, and a repeated voter is
+    found by the failed insert, without reading the ledger first.
+
+    """
+    poll = models.ForeignKey(Poll)
+    key = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = [("poll", "key")]
+
+    def __unicode__(self):
+        return u"%s in %s" % (self.key, self.poll_id)
+
+    @staticmethod
+    def key_of(identity):
+        """The key of the voter with 'identity' (e.g. "user:12")."""
+        return salted_hmac('polls.Voter', identity).hexdigest()[:32]
+
+    @classmethod
+    def record(cls, poll_id, key):
+        """Add the voter to the ledger. Return False if it was there."""
+        try:
+            with transaction.atomic():
+                cls.objects.create(poll_id=poll_id, key=key)
+        except IntegrityError:
+            return False
+        return True
+
+
+class VoteRequest(models.Model):
+    """A vote request already counted, by its idempotency key (see
+    Choice.vote_once). Purge the old ones with the purge_vote_requests
+    command.
+
+    """
+    key = models.CharField(max_length=40, unique=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __unicode__(self):
+        return self.key
+
+    @classmethod
+    def record(cls, poll_id, request_key):
+        """Record the request. Return False if it was already."""
+        key = hashlib.sha1(("%s:%s" % (poll_id, request_key)).encode('utf-8')).hexdigest()
+        try:
+            with transaction.atomic():
+                cls.objects.create(key=key)
+        except IntegrityError:
+            return False
+        return True
+
+
+class PollStats(models.Model):
+    """Snapshot of the statistics of all the polls, for the facts page.
+
+    There's a single row, recomputed from scratch by PollStats.refresh (the
+    refresh_poll_stats command, run periodically): 'updated' is the time of
+    the last refresh. The votes don't touch it (a single row updated by
+    every vote would serialize all of them); the creation and deletion of
+    choices update it incrementally.
+
+    """
+    SINGLETON = 1
+
+    choices = models.PositiveIntegerField(default=0)
+    voted_choices = models.PositiveIntegerField(default=0)
+    votes = models.PositiveIntegerField(default=0)
+    top_choice = models.ForeignKey(Choice, null=True, on_delete=models.SET_NULL, related_name='+')
+    top_choice_votes = models.PositiveIntegerField(default=0)
+    top_poll = models.ForeignKey(Poll, null=True, on_delete=models.SET_NULL, related_name='+')
+    top_poll_votes = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField("last updated", default=timezone.now)
+
+    def __unicode__(self):
+        return u"Statistics of %s" % self.updated
+
+    def avg_votes(self):
+        """Average number of votes of all the choices."""
+        return float(self.votes) / self.choices if self.choices else 0.0
+
+    def avg_votes_no_zero(self):
+        """Average number of votes of the voted choices."""
+        return float(self.votes) / self.voted_choices if self.voted_choices else 0.0
+
+    @classmethod
+    def get(cls):
+        """Return the snapshot (with its top choice and poll), computing it
+        if it doesn't exist yet.
+
+        """
+        stats = cls.objects.select_related('top_choice__poll', 'top_poll').filter(
+                pk=cls.SINGLETON).first()
+        return stats or cls.refresh()
+
+    @classmethod
+    def refresh(cls):
+        """Recompute the snapshot from all the polls and choices, and save it."""
+        totals = Choice.objects.aggregate(choices=Count('pk'), votes=Sum('votes'))
+        top_choice = Choice.objects.order_by('-votes', 'pk').first()
+        top_poll = Poll.objects.order_by('-total_votes', 'pk').first()
+        stats = cls(
+                pk=cls.SINGLETON,
+                choices=totals['choices'],
+                voted_choices=Choice.objects.filter(votes__gt=0).count(),
+                votes=totals['votes'] or 0,
+                top_choice=top_choice,
+                top_choice_votes=top_choice.votes if top_choice else 0,
+                top_poll=top_poll,
+                top_poll_votes=top_poll.total_votes if top_poll else 0,
+            )
+        stats.save()
+        return stats
+
+    @classmethod
+    def remove_choices(cls, choices):
+        """Update the snapshot after deleting the choices (with the votes
+        they had). The votes not in the snapshot yet may take it below zero:
+        it stays at zero until the next refresh.
+
+        """
+        stats = cls.objects.filter(pk=cls.SINGLETON).first()
+        if stats is None:
+            return
+        voted = [c for c in choices if c.votes]
+        if voted and (stats.top_choice_id in [None] + [c.pk for c in voted] or
+                stats.top_poll_id in [None] + [c.poll_id for c in voted]):
+            # The maximums may be somewhere else now.
+            cls.refresh()
+            return
+        cls.objects.filter(pk=cls.SINGLETON).update(
+                choices=F('choices') - len(choices),
+                voted_choices=at_least_zero('voted_choices', len(voted)),
+                votes=at_least_zero('votes', sum(c.votes for c in voted)),
+            )
+
+
+def at_least_zero(field, n):
+    """The value of 'field' less 'n', but not less than 0."""
+    return Case(When(**{'%s__gte' % field: n, 'then': F(field) - n}),
+                default=Value(0),
+                output_field=models.IntegerField())
+
+
+class VoteEvent(models.Model):
+    """Votes for a choice at a time: the append-only log of the votes, with
+    settings.POLLS_VOTE_EVENTS.
+
+    The log is written in batches, of a row per choice (with its number of
+    votes) per poll and batch:
+
+    - the votes added in batches (a flush of the write-behind buffer, or
+      the votes sent in bulk) are logged in the transaction that adds them,
+      with one INSERT per poll (see ChoiceManager.add_votes);
+    - the votes counted one by one (Choice.vote_me, sharded or not) are
+      logged apart, through polls.votebuffer.event_buffer: at most
+      POLLS_VOTE_FLUSH_MS later, and only if the process doesn't crash
+      meanwhile.
+
+    The log is rolled up by minute, hour and day (see roll_up, and the
+    rollup_votes command), and Choice.votes can be rebuilt from it (see
+    rebuild_votes, and the rebuild_choice_votes command).
+
+    """
+    poll = models.ForeignKey(Poll)
+    choice = models.ForeignKey(Choice)
+    created = models.DateTimeField(default=timezone.now)
+    votes = models.PositiveIntegerField(default=1)
+
+    def __unicode__(self):
+        return u"%i votes for %s at %s" % (self.votes, self.choice_id, self.created)
+
+    @classmethod
+    def log(cls, poll_id, counts, created=None):
+        """Log the 'counts' votes (by choice id) of a poll, with one INSERT."""
+        created = created or timezone.now()
+        cls.objects.bulk_create([
+                cls(poll_id=poll_id, choice_id=pk, created=created, votes=n)
+                for pk, n in counts.items() if n
+            ])
+
+    @classmethod
+    def roll_up(cls, lag=0, batch_size=ROLLUP_BATCH_SIZE):
+        """Add the events after the watermark (VoteRollupState.last_event)
+        and older than 'lag' seconds to the rollups. Return the number of
+        events rolled up.
+
+        The events are read by id, in batches of 'batch_size': each batch is
+        added to the rollups and moves the watermark in one transaction, so
+        no event is added twice nor skipped, even if interrupted. Roll up
+        with some 'lag' if the transactions of the votes may commit out of
+        the order of their ids (not with SQLite).
+
+        """
+        until = timezone.now() - datetime.timedelta(seconds=lag)
+        rolled = 0
+        while True:
+            with transaction.atomic():
+                state = VoteRollupState.lock()
+                events = list(cls.objects.filter(pk__gt=state.last_event).order_by('pk')
+                        .values_list('pk', 'poll_id', 'choice_id', 'created', 'votes')
+                        [:batch_size])
+                recent = [e for e in events if e[3] >= until]
+                if recent:
+                    # The rest waits for the next roll up, in the order of the ids.
+                    events = events[:events.index(recent[0])]
+                if events:
+                    for rollup in ROLLUPS.values():
+                        rollup.add(events)
+                    state.last_event = events[-1][0]
+                    rolled += len(events)
+                if len(events) < batch_size:
+                    state.rolled_up_to = until
+                state.save()
+            if len(events) < batch_size:
+                return rolled
+
+    @classmethod
+    def reset_rollups(cls):
+        """Delete the rollups, and move the watermark back to the first
+        event: the next roll_up rebuilds them from the whole log.
+
+        """
+        with transaction.atomic():
+            state = VoteRollupState.lock()
+            for rollup in ROLLUPS.values():
+                rollup.objects.all().delete()
+            state.last_event = 0
+            state.rolled_up_to = None
+            state.save()
+
+    @classmethod
+    def drifted_choices(cls):
+        """The (choice id, poll id, votes in the log) of the choices whose
+        votes are not the ones in the log (less those still in their
+        counter shards).
+
+        """
+        logged = dict(cls.objects.order_by().values_list('choice').annotate(Sum('votes')))
+        pending = dict(ChoiceVotesShard.objects.order_by().values_list('choice')
+                       .annotate(Sum('votes')))
+        drifted = []
+        for pk, poll_id, votes in Choice.objects.values_list('pk', 'poll_id', 'votes').iterator():
+            expected = (logged.get(pk) or 0) - (pending.get(pk) or 0)
+            if votes != expected:
+                drifted.append((pk, poll_id, expected))
+        return drifted
+
+    @classmethod
+    def rebuild_votes(cls):
+        """Set the votes of the drifted choices (see drifted_choices) to
+        those in the log, and recompute the totals of their polls and the
+        statistics. Return the number of choices fixed.
+
+        The choices are locked meanwhile (the votes wait). It's right only
+        if all the votes were logged: since the first vote, with
+        settings.POLLS_VOTE_EVENTS, and none lost in the event_buffer of a
+        crashed process (or still in one: flush it first).
+
+        """
+        with transaction.atomic():
+            list(Choice.objects.select_for_update().values_list('pk'))
+            drifted = cls.drifted_choices()
+            for batch in batches(drifted):
+                Choice.objects.filter(pk__in=[pk for pk, poll_id, votes in batch]).update(
+                        votes=Case(
+                                *[When(pk=pk, then=Value(votes)) for pk, poll_id, votes in batch],
+                                output_field=models.IntegerField()
+                            ))
+            for poll in Poll.objects.filter(pk__in=set(poll_id for pk, poll_id, votes in drifted)):
+                poll.refresh_totals()
+            if drifted:
+                PollStats.refresh()
+        return len(drifted)
+
+
+class VoteRollup(models.Model):
+    """The votes of a choice in a period (a minute, an hour or a day, in
+    UTC) starting at 'start', summed up from the VoteEvents.
+
+    """
+    poll = models.ForeignKey(Poll, related_name='+')
+    choice = models.ForeignKey(Choice, related_name='+')
+    start = models.DateTimeField()
+    votes = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        unique_together = [("choice", "start")]
+        # The trend of a poll (polls.api.poll_trend).
+        index_together = [("poll", "start")]
+
+    def __unicode__(self):
+        return u"%i votes for %s from %s" % (self.votes, self.choice_id, self.start)
+
+    @staticmethod
+    def truncate(when):
+        """The start of the period of the datetime 'when'."""
+        raise NotImplementedError
+
+    @classmethod
+    def add(cls, events):
+        """Add the votes of the 'events' (id, poll id, choice id, created,
+        votes) to the rollups: an UPDATE of the existing rows, and a
+        bulk_create of the new ones (per batch of EDIT_BATCH_SIZE rows).
+
+        """
+        counts = defaultdict(int)
+        poll_of = {}
+        for pk, poll_id, choice_id, created, votes in events:
+            counts[choice_id, cls.truncate(created)] += votes
+            poll_of[choice_id] = poll_id
+        existing = {}
+        # By start: the events of a batch are usually of a few periods.
+        for keys in batches(sorted(counts, key=lambda key: (key[1], key[0])), 300):
+            rows = cls.objects.filter(choice__in=set(choice_id for choice_id, start in keys),
+                                      start__in=set(start for choice_id, start in keys))
+            for pk, choice_id, start in rows.values_list('pk', 'choice_id', 'start'):
+                if (choice_id, start) in counts:
+                    existing[choice_id, start] = pk
+        for batch in batches(existing.items()):
+            cls.objects.filter(pk__in=[pk for key, pk in batch]).update(
+                    votes=F('votes') + Case(
+                            *[When(pk=pk, then=Value(counts[key])) for key, pk in batch],
+                            default=Value(0),
+                            output_field=models.IntegerField()
+                        ))
+        cls.objects.bulk_create([
+                cls(poll_id=poll_of[choice_id], choice_id=choice_id, start=start, votes=n)
+                for (choice_id, start), n in counts.items() if (choice_id, start) not in existing
+            ])
+
+
+def utc(when):
+    return timezone.localtime(when, timezone.utc)
+
+
+class VotesByMinute(VoteRollup):
+    @staticmethod
+    def truncate(when):
+        return utc(when).replace(second=0, microsecond=0)
+
+
+class VotesByHour(VoteRollup):
+    @staticmethod
+    def truncate(when):
+        return utc(when).replace(minute=0, second=0, microsecond=0)
+
+
+class VotesByDay(VoteRollup):
+    @staticmethod
+    def truncate(when):
+        return utc(when).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+ROLLUPS = OrderedDict([
+        ('minute', VotesByMinute),
+        ('hour', VotesByHour),
+        ('day', VotesByDay),
+    ])
+
+
+class VoteRollupState(models.Model):
+    """The watermark of the rollups: the last VoteEvent rolled up, and the
+    time until which all the events are (see VoteEvent.roll_up). A single
+    row.
+
+    """
+    SINGLETON = 1
+
+    last_event = models.PositiveIntegerField(default=0)
+    rolled_up_to = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return u"Votes rolled up to %s" % self.rolled_up_to
 
+    @classmethod
+    def lock(cls):
+        """The state, locked until the end of the transaction."""
+        return cls.objects.select_for_update().get_or_create(pk=cls.SINGLETON)[0]
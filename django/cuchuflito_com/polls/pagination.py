@@ -0,0 +1,117 @@
+"""Keyset (cursor) pagination of polls, newest first.
+
+Instead of OFFSET, each page is fetched with a WHERE on the (pub_date, id)
+of the last poll of the previous page, so fetching a page costs the same
+no matter how deep it is, and no COUNT(*) is needed. The cursors are opaque
+(signed) strings.
+
+"""
+from django.core import signing
+from django.http import Http404, QueryDict
+from django.utils.dateparse import parse_datetime
+
+CURSOR_SALT = 'polls.pagination'
+
+
+def encode_cursor(poll, backwards=False):
+    """Cursor to the polls after (or, if 'backwards', before) 'poll': a Poll,
+    or a dict with its 'pub_date' and 'id' (a row of values()).
+
+    """
+    if isinstance(poll, dict):
+        pub_date, pk = poll['pub_date'], poll['id']
+    else:
+        pub_date, pk = poll.pub_date, poll.pk
+    return signing.dumps((pub_date.isoformat(), pk, backwards),
+                         salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    """Return (pub_date, pk, backwards). Raise Http404 if the cursor is bad."""
+    try:
+        pub_date, pk, backwards = signing.loads(cursor, salt=CURSOR_SALT)
+        pub_date = parse_datetime(pub_date)
+    except (signing.BadSignature, ValueError, TypeError):
+        raise Http404(u"Bad page cursor.")
+    if pub_date is None:
+        raise Http404(u"Bad page cursor.")
+    return pub_date, pk, backwards
+
+
+class KeysetPage(object):
+    """A page of polls, with the cursors to the pages around it."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, params=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.params = params
+
+    def next_url(self):
+        """Query string of the next page: 'params' with its cursor."""
+        return self._url(self.next_cursor)
+
+    def previous_url(self):
+        """Query string of the previous page: 'params' with its cursor."""
+        return self._url(self.previous_cursor)
+
+    def _url(self, cursor):
+        params = self.params.copy() if self.params is not None else QueryDict('', mutable=True)
+        params['cursor'] = cursor
+        return '?' + params.urlencode()
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def keyset_page(queryset, cursor, page_size, params=None):
+    """Return the KeysetPage of 'queryset' polls (newest first) pointed by
+    the cursor, or the first one if 'cursor' is empty. The queryset may be
+    of values() with 'pub_date' and 'id'.
+
+    'params' (a QueryDict, usually request.GET) are kept in the pages' URLs.
+
+    """
+    backwards = False
+    if cursor:
+        pub_date, pk, backwards = decode_cursor(cursor)
+        # Written as a range on pub_date (and not as "pub_date < d OR
+        # (pub_date = d AND pk < n)") so the DB seeks the (pub_date, id)
+        # index instead of walking it from the start.
+        if backwards:
+            queryset = queryset.filter(pub_date__gte=pub_date).exclude(
+                    pub_date=pub_date, pk__lte=pk)
+        else:
+            queryset = queryset.filter(pub_date__lte=pub_date).exclude(
+                    pub_date=pub_date, pk__gte=pk)
+    if backwards:
+        queryset = queryset.order_by('pub_date', 'pk')
+    else:
+        queryset = queryset.order_by('-pub_date', '-pk')
+
+    polls = list(queryset[:page_size + 1])
+    more = len(polls) > page_size
+    polls = polls[:page_size]
+    if backwards:
+        polls.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, bool(cursor)
+    return KeysetPage(
+            polls,
+            next_cursor=encode_cursor(polls[-1]) if polls and has_next else None,
+            previous_cursor=encode_cursor(polls[0], backwards=True) if polls and has_previous else None,
+            params=params,
+        )
@@ -0,0 +1,59 @@
+"""Query plan checks (SQLite), to catch views that stop using the indexes.
+
+    with capture_selects() as selects:
+        ...render some views...
+    full_scans(selects)
+
+returns the queries that read a whole polls table without an index.
+
+"""
+import re
+from contextlib import contextmanager
+
+from django.db import connection
+
+# "SCAN TABLE polls_poll" (SQLite < 3.36) or "SCAN polls_poll" (>= 3.36),
+# with no "USING [COVERING] INDEX" after it.
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(?P<table>\w+)(?! USING)(?:\s|$)')
+
+
+@contextmanager
+def capture_selects():
+    """Collect the (sql, params) of the SELECT queries run in the block."""
+    selects = []
+    last_executed_query = connection.ops.last_executed_query
+    force_debug_cursor = connection.force_debug_cursor
+
+    def record(cursor, sql, params):
+        if sql.lstrip().upper().startswith('SELECT'):
+            selects.append((sql, params))
+        return last_executed_query(cursor, sql, params)
+
+    connection.ops.last_executed_query = record
+    connection.force_debug_cursor = True
+    try:
+        yield selects
+    finally:
+        del connection.ops.last_executed_query
+        connection.force_debug_cursor = force_debug_cursor
+
+
+def explain(sql, params=()):
+    """Return the details of the SQLite query plan of the query."""
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def full_scans(selects, tables_prefix='polls_'):
+    """Return (sql, plan detail) for each query that scans a whole table
+    whose name starts with 'tables_prefix', without using an index.
+
+    """
+    scans = []
+    for sql, params in selects:
+        for detail in explain(sql, params):
+            match = FULL_SCAN.match(detail)
+            if match and match.group('table').startswith(tables_prefix):
+                scans.append((sql, detail))
+    return scans
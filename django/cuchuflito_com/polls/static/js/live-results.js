@@ -0,0 +1,70 @@
+/*
+ * Live results: the votes, the bars (as the barrita tag) and the winners of
+ * the results page, updated with the messages pushed by the server (see
+ * polls/liveresults.py).
+ */
+function bar_importance(percent){
+    if (percent >= 66){
+        return "progress-danger";
+    } else if (percent >= 30){
+        return "progress-warning";
+    }
+    return "progress-info";
+}
+
+function update_results(votes, max_votes, total_votes){
+    var rows = $("tr[data-choice]");
+    rows.each(function(){
+        var row = $(this);
+        var n = votes[row.data("choice")];
+        var percent = max_votes ? Math.floor(n * 100 / max_votes) : 0;
+        row.find(".votes").text(n);
+        row.find(".progress").attr("class", "progress " + bar_importance(percent));
+        row.find(".bar").css("width", percent + "%");
+        row.toggleClass("muted", n == 0);
+    });
+    // Most voted first.
+    var sorted = rows.get().sort(function(a, b){
+        return votes[$(b).data("choice")] - votes[$(a).data("choice")];
+    });
+    rows.parent().append(sorted);
+
+    var winners = $.grep(sorted, function(row){
+        return max_votes > 0 && votes[$(row).data("choice")] == max_votes;
+    });
+    var html = "";
+    if (winners.length){
+        html = "<h2>The winning " + (winners.length > 1 ?
+                "choices, with " + max_votes + " votes each, are:" :
+                "choice, with " + max_votes + " votes, is:") + "</h2>";
+        $.each(winners, function(i, row){
+            var text = $("<div/>").text($(row).find(".choice").text()).html();
+            html += '<div class="text-success"><h3>' + text + "</h3></div>";
+        });
+    }
+    $("#winners").html(html);
+    $("#total-votes").text(total_votes + " vote" + (total_votes == 1 ? "" : "s") + " in total.");
+}
+
+function live_results(url){
+    if (!window.EventSource){
+        return;
+    }
+    var votes = {};
+    var source = new EventSource(url);
+    source.onmessage = function(event){
+        var message = JSON.parse(event.data);
+        if (message.reload){
+            source.close();
+            window.location.reload();
+            return;
+        }
+        if (message.full){
+            votes = {};
+        }
+        $.each(message.choices, function(choice, n){
+            votes[choice] = n;
+        });
+        update_results(votes, message.max_votes, message.total_votes);
+    };
+}
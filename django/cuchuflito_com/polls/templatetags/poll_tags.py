@@ -9,8 +9,13 @@ MEDIUM = "progress-warning"
 LOW = "progress-info"
 
 @register.simple_tag
-def barrita(choice, **kwargs):
-    max_votes = choice.poll.get_max_votes()
+def barrita(choice, max_votes=None, **kwargs):
+    """Progress bar with the votes of the choice, relative to 'max_votes'
+    (by default, the votes of the most voted choice of its poll).
+
+    """
+    if max_votes is None:
+        max_votes = choice.poll.get_max_votes()
     percent = 0.0
     importance = LOW
     if max_votes != 0:
@@ -1,24 +1,51 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import tempfile
 import datetime
+from StringIO import StringIO
 
-from django.test import TestCase
+from unittest import skipIf, skipUnless
+
+from django.test import TestCase, TransactionTestCase
 from django.test.html import parse_html
 from django.utils import timezone, html
 from django.core.urlresolvers import reverse
 from django.core.exceptions import PermissionDenied
 from django.http import HttpResponseNotAllowed, Http404, QueryDict
-from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.models import AnonymousUser, User, Permission
 from django.test.client import RequestFactory
-from django.db import IntegrityError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import IntegrityError, connection
+from django.db.models import Sum, Max
 from mock import patch
 
-from polls.models import Poll, Choice
-from polls import views, forms
+from polls.models import (Poll, Choice, ChoiceVotesShard, PollStats, Voter, VoteRequest,
+                          AlreadyVoted, VoteEvent, VotesByMinute, VotesByHour, VotesByDay,
+                          VoteRollupState)
+from polls import views, forms, api
+from polls.votebuffer import vote_buffer, event_buffer
+from polls.queryplans import capture_selects, full_scans, explain
+from polls.pagination import keyset_page
+from polls.liveresults import ResultsPublisher
+from polls.management.commands.stress_votes import hammer_choice
 from fixtures.polls_factory import UserFactory, PollFactory, ChoiceFactory, DEFAULT_PASSWORD
 
 
 request_factory = RequestFactory()
 
+def updates_of(table, captured):
+    """The UPDATE statements of 'table' in a CaptureQueriesContext."""
+    return [q['sql'] for q in captured.captured_queries
+            if 'UPDATE "%s"' % table in q['sql']]
+
+def in_memory_test_db():
+    """True if the test DB is an in-memory SQLite, not shared among threads."""
+    name = connection.settings_dict['TEST'].get('NAME') or ''
+    return connection.vendor == 'sqlite' and name in ('', ':memory:')
+
 # Auxiliar method
 def aux_initial_management_form(total_forms=1, extra=None):
     """Creates the formset's management form items."""
@@ -191,7 +218,369 @@ class ChoiceModelTesting(TestCase):
         """The Choice.vote_me method works only on saved objects."""
         c = Choice()
         self.assertRaises(IntegrityError, c.vote_me)
-        
+
+    def test_vote_me_returns_the_new_count(self):
+        """The Choice.vote_me method returns the number of votes after voting."""
+        self.assertEqual(self.choice.vote_me(), 1)
+        self.assertEqual(self.choice.vote_me(), 2)
+
+    def test_vote_me_does_not_overwrite_other_votes(self):
+        """Voting from a stale instance doesn't lose the votes made by others."""
+        stale = Choice.objects.get(pk=self.choice.pk)
+        self.choice.vote_me()
+        self.choice.vote_me()
+        self.assertEqual(stale.vote_me(), 3)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, 3)
+
+    def test_vote_me_is_a_single_update(self):
+        """The Choice.vote_me method writes the choice once."""
+        with CaptureQueriesContext(connection) as ctx:
+            self.choice.vote_me()
+        self.assertEqual(len(updates_of('polls_choice', ctx)), 1)
+
+
+@skipIf(in_memory_test_db(), "Needs a test DB shared among threads and processes.")
+class ChoiceConcurrentVotingTesting(TransactionTestCase):
+    WORKERS = 16
+    VOTES = 50
+
+    def setUp(self):
+        self.choice = ChoiceFactory()
+
+    def test_concurrent_threads_lose_no_votes(self):
+        """Many threads voting at the same time for a choice lose no vote."""
+        done, elapsed = hammer_choice(self.choice.pk, self.WORKERS, self.VOTES)
+        self.assertEqual(done, self.WORKERS * self.VOTES)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, done)
+
+    def test_concurrent_processes_lose_no_votes(self):
+        """Many processes voting at the same time for a choice lose no vote."""
+        done, elapsed = hammer_choice(
+                self.choice.pk, self.WORKERS, self.VOTES, use_processes=True)
+        self.assertEqual(done, self.WORKERS * self.VOTES)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, done)
+
+
+
+class PollTotalsTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+        self.c1 = ChoiceFactory(poll=self.poll)
+        self.c2 = ChoiceFactory(poll=self.poll)
+        for i in range(3):
+            self.c1.vote_me()
+        self.c2.vote_me()
+
+    def totals(self):
+        return Poll.objects.values_list('total_votes', 'max_votes').get(pk=self.poll.pk)
+
+    def test_voting_updates_the_totals(self):
+        """Voting updates the total_votes and max_votes of the poll."""
+        self.assertEqual(self.totals(), (4, 3))
+        self.c2.vote_me()
+        self.c2.vote_me()
+        self.c2.vote_me()
+        self.assertEqual(self.totals(), (7, 4))
+
+    def test_deleting_a_choice_updates_the_totals(self):
+        """Deleting a choice takes its votes out of the totals."""
+        Choice.objects.get(pk=self.c1.pk).delete()
+        self.assertEqual(self.totals(), (1, 1))
+
+    def test_refresh_totals(self):
+        """Poll.refresh_totals recomputes the totals from the choices."""
+        Poll.objects.filter(pk=self.poll.pk).update(total_votes=100, max_votes=0)
+        self.poll.refresh_totals()
+        self.assertEqual(self.totals(), (4, 3))
+        self.assertEqual((self.poll.total_votes, self.poll.max_votes), (4, 3))
+
+    def test_rebuild_poll_totals_check_fails_on_drift(self):
+        """rebuild_poll_totals --check fails if some totals drifted."""
+        call_command('rebuild_poll_totals', check=True, stdout=StringIO())
+        Poll.objects.filter(pk=self.poll.pk).update(total_votes=100)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_poll_totals', check=True, stdout=StringIO())
+
+    def test_rebuild_poll_totals_fixes_the_drift(self):
+        """rebuild_poll_totals fixes the drifted totals."""
+        Poll.objects.filter(pk=self.poll.pk).update(total_votes=100, max_votes=50)
+        call_command('rebuild_poll_totals', stdout=StringIO())
+        self.assertEqual(self.totals(), (4, 3))
+
+
+class PollStatsTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+        self.c1 = ChoiceFactory(poll=self.poll)
+        self.c2 = ChoiceFactory(poll=self.poll)
+        self.other = ChoiceFactory()
+        PollStats.refresh()
+
+    def snapshot(self):
+        stats = PollStats.objects.get()
+        return (stats.choices, stats.voted_choices, stats.votes,
+                stats.top_choice_id, stats.top_choice_votes,
+                stats.top_poll_id, stats.top_poll_votes)
+
+    def assertSnapshotIsFresh(self):
+        incremental = self.snapshot()
+        PollStats.refresh()
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_refresh(self):
+        """PollStats.refresh computes the statistics from scratch."""
+        self.c1.vote_me()
+        self.c1.vote_me()
+        self.other.vote_me()
+        stats = PollStats.refresh()
+        self.assertEqual(self.snapshot(),
+                (3, 2, 3, self.c1.pk, 2, self.poll.pk, 2))
+        self.assertEqual(stats.avg_votes(), 1.0)
+        self.assertEqual(stats.avg_votes_no_zero(), 1.5)
+
+    def test_votes_dont_write_the_snapshot(self):
+        """The votes are in the snapshot after the next refresh, not before."""
+        before = self.snapshot()
+        with CaptureQueriesContext(connection) as captured:
+            self.c1.vote_me()
+            self.other.vote_me()
+        self.assertEqual(updates_of('polls_pollstats', captured), [])
+        self.assertEqual(self.snapshot(), before)
+        call_command('refresh_poll_stats', stdout=StringIO())
+        self.assertEqual(self.snapshot()[:3], (3, 2, 2))
+
+    def test_new_choices_update_the_snapshot(self):
+        """Creating choices updates the snapshot."""
+        ChoiceFactory(poll=self.poll)
+        self.assertSnapshotIsFresh()
+
+    def test_deleted_choices_update_the_snapshot(self):
+        """Deleting choices updates the snapshot."""
+        self.c1.vote_me()
+        self.c1.vote_me()
+        self.c2.vote_me()
+        self.other.vote_me()
+        PollStats.refresh()
+        Choice.objects.get(pk=self.c2.pk).delete()
+        self.assertSnapshotIsFresh()
+        Choice.objects.get(pk=self.c1.pk).delete()
+        self.assertSnapshotIsFresh()
+
+    def test_deleting_votes_not_in_the_snapshot(self):
+        """The votes of the snapshot don't go below zero."""
+        choice = ChoiceFactory(poll=self.other.poll)
+        PollStats.refresh()
+        choice.vote_me()
+        Choice.objects.get(pk=choice.pk).delete()
+        self.assertEqual(self.snapshot()[:3], (3, 0, 0))
+
+    def test_facts_view_reads_the_snapshot(self):
+        """The facts page reads the snapshot instead of aggregating the choices."""
+        self.c1.vote_me()
+        PollStats.refresh()
+        request = request_factory.get(reverse('polls:facts'))
+        request.user = UserFactory(is_superuser=True)
+        # The snapshot, the polls with votes, and the 'useless' polls.
+        with self.assertNumQueries(3):
+            response = views.FactsView.as_view()(request)
+            response.render()
+        self.assertEqual(len(response.context_data['facts_list']), 6)
+        self.assertContains(response, "(%s - 1 votes)" % self.c1.choice)
+
+
+@override_settings(POLLS_VOTE_WRITE_BEHIND=True, POLLS_VOTE_FLUSH_MAX=1)
+class BufferedPollsModelTesting(PollsModelTesting):
+    """The PollsModelTesting tests, voting through the write-behind buffer."""
+
+
+@override_settings(POLLS_VOTE_WRITE_BEHIND=True, POLLS_VOTE_FLUSH_MAX=1000,
+        POLLS_VOTE_FLUSH_MS=60000)
+class VoteBufferTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+        self.c1 = ChoiceFactory(poll=self.poll)
+        self.c2 = ChoiceFactory(poll=self.poll)
+        self.other = ChoiceFactory()
+
+    def tearDown(self):
+        vote_buffer.flush()
+
+    def votes(self, choice):
+        return Choice.objects.get(pk=choice.pk).votes
+
+    def test_buffered_votes_are_not_written(self):
+        """With write-behind, vote_me doesn't write the DB."""
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.c1.vote_me())
+        self.assertEqual(self.votes(self.c1), 0)
+
+    def test_flush_writes_the_votes(self):
+        """Flushing the buffer adds the pending votes to the choices."""
+        self.c1.vote_me()
+        self.c1.vote_me()
+        self.c2.vote_me()
+        self.other.vote_me()
+        self.assertEqual(vote_buffer.flush(), 4)
+        self.assertEqual(self.votes(self.c1), 2)
+        self.assertEqual(self.votes(self.c2), 1)
+        self.assertEqual(self.votes(self.other), 1)
+        self.assertEqual(vote_buffer.flush(), 0)
+
+    def test_flush_is_one_update_per_poll(self):
+        """The pending votes of each poll are written with a single UPDATE."""
+        for i in range(10):
+            self.c1.vote_me()
+            self.c2.vote_me()
+        self.other.vote_me()
+        with CaptureQueriesContext(connection) as ctx:
+            vote_buffer.flush()
+        self.assertEqual(len(updates_of('polls_choice', ctx)), 2)
+
+    def test_full_buffer_is_flushed(self):
+        """The buffer is flushed when it holds POLLS_VOTE_FLUSH_MAX votes."""
+        with self.settings(POLLS_VOTE_FLUSH_MAX=3):
+            self.c1.vote_me()
+            self.c1.vote_me()
+            self.assertEqual(self.votes(self.c1), 0)
+            self.c2.vote_me()
+        self.assertEqual(self.votes(self.c1), 2)
+        self.assertEqual(self.votes(self.c2), 1)
+
+    def test_failed_flush_keeps_the_votes(self):
+        """If the DB fails, the votes stay in the buffer."""
+        self.c1.vote_me()
+        with patch.object(Choice.objects, 'add_votes', side_effect=IntegrityError):
+            self.assertRaises(IntegrityError, vote_buffer.flush)
+        self.assertEqual(vote_buffer.flush(), 1)
+        self.assertEqual(self.votes(self.c1), 1)
+
+    def test_failed_flush_is_scheduled_again(self):
+        """After a failed flush, the buffer is flushed again in POLLS_VOTE_FLUSH_MS."""
+        self.c1.vote_me()
+        with patch.object(Choice.objects, 'add_votes', side_effect=IntegrityError):
+            self.assertRaises(IntegrityError, vote_buffer.flush)
+        self.assertIsNotNone(vote_buffer.timer)
+        self.assertEqual(vote_buffer.timer.function, vote_buffer.timed_flush)
+        self.assertEqual(vote_buffer.timer.interval, 60)
+
+    def test_failed_full_flush_does_not_fail_the_vote(self):
+        """If flushing a full buffer fails, the vote is still buffered, and
+        vote_me doesn't raise.
+
+        """
+        with self.settings(POLLS_VOTE_FLUSH_MAX=1), \
+                patch('polls.votebuffer.logger') as logger, \
+                patch.object(Choice.objects, 'add_votes', side_effect=IntegrityError):
+            self.assertIsNone(self.c1.vote_once(request_key='k'))
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(VoteRequest.objects.count(), 1)
+        self.assertEqual(vote_buffer.flush(), 1)
+        self.assertEqual(self.votes(self.c1), 1)
+
+    def test_full_flush_is_out_of_the_vote_transaction(self):
+        """vote_once buffers the vote (and flushes) after its transaction."""
+        depth = len(connection.savepoint_ids)
+        flushed = []
+        def add_votes(poll_id, counts):
+            flushed.append(len(connection.savepoint_ids))
+        with self.settings(POLLS_VOTE_FLUSH_MAX=1):
+            with patch.object(Choice.objects, 'add_votes', side_effect=add_votes):
+                self.c1.vote_once(request_key='k')
+        self.assertEqual(flushed, [depth])
+
+
+@override_settings(POLLS_VOTE_SHARDS=4)
+class ShardedVotesTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+        self.winner = ChoiceFactory(poll=self.poll)
+        self.looser = ChoiceFactory(poll=self.poll)
+        self.nobody = ChoiceFactory(poll=self.poll)
+        for i in range(5):
+            self.winner.vote_me()
+        self.looser.vote_me()
+
+    def test_votes_go_to_the_shards(self):
+        """With sharding, the votes are kept in the shards, not in Choice.votes."""
+        self.assertEqual(Choice.objects.get(pk=self.winner.pk).votes, 0)
+        self.assertEqual(self.winner.shards.aggregate(s=Sum('votes'))['s'], 5)
+        self.assertLessEqual(self.winner.shards.count(), 4)
+
+    def test_vote_me_returns_the_total(self):
+        """vote_me returns the votes in Choice.votes plus the ones in the shards."""
+        Choice.objects.filter(pk=self.winner.pk).update(votes=10)
+        self.assertEqual(self.winner.vote_me(), 16)
+
+    def test_poll_methods_sum_the_shards(self):
+        """The Poll methods see the votes of the shards."""
+        self.assertEqual(self.poll.get_max_votes(), 5)
+        self.assertEqual([c.pk for c in self.poll.has_winners()], [self.winner.pk])
+        self.assertEqual(
+                [(c.pk, c.votes) for c in self.poll.get_ordered_choices()],
+                [(self.winner.pk, 5), (self.looser.pk, 1), (self.nobody.pk, 0)])
+
+    def test_compact_folds_the_shards_into_the_choices(self):
+        """ChoiceVotesShard.compact moves the votes from the shards to Choice.votes."""
+        self.assertEqual(ChoiceVotesShard.compact(), 6)
+        self.assertEqual(Choice.objects.get(pk=self.winner.pk).votes, 5)
+        self.assertEqual(Choice.objects.get(pk=self.looser.pk).votes, 1)
+        self.assertFalse(ChoiceVotesShard.objects.filter(votes__gt=0).exists())
+        self.assertEqual(self.poll.get_max_votes(), 5)
+
+
+class LoadPollsCommandTesting(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+
+    def load(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(content.encode('utf-8'))
+        self.addCleanup(os.remove, f.name)
+        call_command('load_polls', f.name, user=self.user.username,
+                     stdout=StringIO(), **options)
+
+    def test_load_txt(self):
+        """Each line is a poll, with the default choices in order."""
+        self.load(u"¿Quién va a venir hoy?\n\nIs it?\n", '.txt')
+        polls = Poll.objects.order_by('pk')
+        self.assertEqual([p.question for p in polls], [u"¿Quién va a venir hoy?", u"Is it?"])
+        self.assertEqual([c.choice for c in polls[0].choice_set.all()], ["Yes", "No", "WTF?"])
+        self.assertTrue(polls[0].pub_date > polls[1].pub_date)
+        self.assertEqual(polls[0].created_by, self.user)
+
+    def test_load_csv(self):
+        """The CSV rows have the question, the pub_date and the choices."""
+        self.load(u"Red or blue?,2013-01-02 10:00,Red,Blue,Red\n", '.csv')
+        poll = Poll.objects.get()
+        self.assertEqual(timezone.localtime(poll.pub_date).date(), datetime.date(2013, 1, 2))
+        self.assertEqual([c.choice for c in poll.choice_set.all()], ["Red", "Blue"])
+
+    def test_load_jsonl_with_votes(self):
+        """The votes of the choices are loaded, with the totals and stats."""
+        self.load(u'{"question": "Q?", "choices": ["A", {"choice": "B", "votes": 3}]}\n', '.jsonl')
+        poll = Poll.objects.get()
+        self.assertEqual((poll.total_votes, poll.max_votes), (3, 3))
+        self.assertEqual(PollStats.get().votes, 3)
+        call_command('rebuild_poll_totals', check=True, stdout=StringIO())
+
+    def test_load_synthetic_in_batches(self):
+        """Made up polls are inserted with one INSERT of polls per batch."""
+        with CaptureQueriesContext(connection) as captured:
+            call_command('load_polls', synthetic=25, synthetic_choices=4, batch=10,
+                         user=self.user.username, stdout=StringIO())
+        inserts = [q for q in captured if 'INSERT INTO "polls_poll"' in q['sql']]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(Poll.objects.count(), 25)
+        self.assertEqual(Choice.objects.count(), 100)
+        self.assertEqual(PollStats.get().choices, 100)
+        poll = PollFactory()
+        self.assertEqual(poll.pk, Poll.objects.aggregate(Max('pk'))['pk__max'])
+
+    def test_bad_input(self):
+        with self.assertRaises(CommandError):
+            self.load(u"Q?", '.xml')
+        with self.assertRaises(CommandError):
+            self.load(u"not json\n", '.jsonl')
 
 
 class PollsIndexViewsTestCase(TestCase):
@@ -219,6 +608,737 @@ class PollsIndexViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 405)
 
 
+class PollResultsViewTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+
+    def get_results_page(self):
+        request = request_factory.get(
+                reverse('polls:results', kwargs={'poll_id':self.poll.id}))
+        request.user = AnonymousUser()
+        response = views.PollResults.as_view()(request, poll_id=self.poll.id)
+        response.render()
+        return response
+
+    def test_results_page_queries_dont_depend_on_the_choices(self):
+        """The results page reads the poll and its choices: 2 queries, always."""
+        for n in (3, 30):
+            for i in range(n):
+                ChoiceFactory(poll=self.poll).vote_me()
+            with self.assertNumQueries(2):
+                self.get_results_page()
+
+    def test_results_page_shows_the_winners(self):
+        """The winning choices are shown, with their votes."""
+        winner = ChoiceFactory(poll=self.poll, choice="The winner")
+        looser = ChoiceFactory(poll=self.poll, choice="The looser")
+        winner.vote_me()
+        winner.vote_me()
+        looser.vote_me()
+        response = self.get_results_page()
+        self.assertContains(response, "choice, with 2 votes")
+        self.assertContains(response, "<h3>The winner</h3>")
+
+    def test_get_results(self):
+        """Poll.get_results returns the ordered choices, max votes and winners."""
+        looser = ChoiceFactory(poll=self.poll)
+        winner = ChoiceFactory(poll=self.poll)
+        winner.vote_me()
+        results = self.poll.get_results()
+        self.assertEqual([c.pk for c in results.choices], [winner.pk, looser.pk])
+        self.assertEqual(results.max_votes, 1)
+        self.assertEqual([c.pk for c in results.winners], [winner.pk])
+
+    def test_get_results_without_votes_has_no_winners(self):
+        """A poll without votes has no winners."""
+        ChoiceFactory(poll=self.poll)
+        results = self.poll.get_results()
+        self.assertEqual(results.max_votes, 0)
+        self.assertEqual(results.winners, [])
+
+
+class PollResultsCacheTesting(TestCase):
+    """The results page with its fragments cached (in local memory)."""
+
+    def setUp(self):
+        self.poll = PollFactory()
+        self.choice = ChoiceFactory(poll=self.poll, choice="The winner")
+        self.choice.vote_me()
+        views.results_cache().clear()
+
+    def get_results_page(self, user=None, **headers):
+        request = request_factory.get(
+                reverse('polls:results', kwargs={'poll_id':self.poll.id}), **headers)
+        request.user = user or AnonymousUser()
+        response = views.PollResults.as_view()(request, poll_id=self.poll.id)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def test_cached_results_page_reads_only_the_poll(self):
+        """The second view of the results reads just the poll."""
+        self.get_results_page()
+        with self.assertNumQueries(1):
+            response = self.get_results_page()
+        self.assertContains(response, "<h3>The winner</h3>")
+
+    def test_a_vote_invalidates_the_cached_results(self):
+        """After a vote, the results page shows it."""
+        self.assertContains(self.get_results_page(), "1 vote in total")
+        self.choice.vote_me()
+        self.assertContains(self.get_results_page(), "2 votes in total")
+
+    def test_editing_the_poll_invalidates_the_cached_results(self):
+        """Renaming a choice (and saving the poll) bumps the poll's version."""
+        self.get_results_page()
+        version = Poll.objects.get(pk=self.poll.pk).version
+        Choice.objects.filter(pk=self.choice.pk).update(choice="Renamed")
+        self.poll.save()
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).version, version + 1)
+        self.assertContains(self.get_results_page(), "<h3>Renamed</h3>")
+
+    def test_saving_a_stale_poll_keeps_the_totals(self):
+        """save() doesn't overwrite the totals with the instance's ones."""
+        self.choice.vote_me()
+        self.poll.question = "Edited?"
+        self.poll.save()
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.question, poll.total_votes), ("Edited?", 2))
+
+    def test_saving_a_new_poll_with_a_pk_inserts_it(self):
+        """A poll not loaded from the DB is inserted, as in a fixture."""
+        poll = Poll(pk=self.poll.pk + 100, question="New?", created_by=self.poll.created_by,
+                    total_votes=3)
+        poll.save()
+        poll = Poll.objects.get(pk=self.poll.pk + 100)
+        self.assertEqual((poll.question, poll.total_votes), ("New?", 3))
+
+    def test_repeat_viewers_get_not_modified(self):
+        """With the ETag or the date of the last response, the answer is a 304."""
+        response = self.get_results_page()
+        self.assertEqual(response['Vary'], 'Cookie')
+        not_modified = self.get_results_page(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.get_results_page(
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_the_etag_changes_with_the_votes_and_the_user(self):
+        """A new vote, or another user, gets the whole page again."""
+        etag = self.get_results_page()['ETag']
+        response = self.get_results_page(user=self.poll.created_by, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.choice.vote_me()
+        self.assertEqual(self.get_results_page(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_sharded_votes_are_not_modified(self):
+        """With sharded votes, the old ETag gets the new votes."""
+        response = self.get_results_page()
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.settings(POLLS_VOTE_SHARDS=4):
+            self.choice.vote_me()
+            response = self.get_results_page(HTTP_IF_NONE_MATCH=etag,
+                                             HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.has_header('ETag'))
+            self.assertContains(response, "with 2 votes")
+
+    @override_settings(POLLS_RESULTS_CACHE=None)
+    def test_results_page_without_cache(self):
+        """Without cache, the results are read every time."""
+        self.get_results_page()
+        with self.assertNumQueries(2):
+            self.get_results_page()
+
+
+@override_settings(CACHES={'polls_results': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'cuchuflito_test_results'),
+    }})
+class FileBasedPollResultsCacheTesting(PollResultsCacheTesting):
+    """The results page with its fragments cached in files."""
+
+
+@skipUnless(os.environ.get('POLLS_TEST_MEMCACHED'),
+            "Set POLLS_TEST_MEMCACHED to the address of a memcached (e.g. "
+            "127.0.0.1:11211) to test the results cache on it.")
+@override_settings(CACHES={'polls_results': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get('POLLS_TEST_MEMCACHED'),
+    }})
+class MemcachedPollResultsCacheTesting(PollResultsCacheTesting):
+    """The results page with its fragments cached in memcached."""
+
+
+def read_events(watcher):
+    """The messages waiting for the watcher."""
+    messages = []
+    while True:
+        message = watcher.get(timeout=0)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+class LiveResultsTesting(TestCase):
+    """The live results' publisher, with many simulated watchers (its thread
+    is not started: the tests call check()).
+
+    """
+    watchers = 500
+
+    def setUp(self):
+        self.poll = PollFactory()
+        self.poll.save()
+        self.c1 = self.poll.choice_set.create(choice="one")
+        self.c2 = self.poll.choice_set.create(choice="two")
+        self.publisher = ResultsPublisher()
+        patcher = patch.object(self.publisher, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def subscribe(self, n):
+        return [self.publisher.subscribe(self.poll.pk) for i in range(n)]
+
+    def test_the_first_message_is_a_snapshot(self):
+        """A watcher gets all the votes first."""
+        self.c1.vote_me()
+        watcher, = self.subscribe(1)
+        message, = read_events(watcher)
+        self.assertTrue(message['full'])
+        self.assertEqual(message['choices'], {self.c1.pk: 1, self.c2.pk: 0})
+        self.assertEqual((message['total_votes'], message['max_votes']), (1, 1))
+
+    def test_only_the_first_watcher_reads_the_poll(self):
+        """The next watchers get the snapshot from memory."""
+        self.subscribe(1)
+        with self.assertNumQueries(0):
+            watchers = self.subscribe(self.watchers)
+        self.assertTrue(all(read_events(w)[0]['full'] for w in watchers))
+
+    def test_a_change_is_read_once_for_all_the_watchers(self):
+        """A vote costs one read of the versions and one of the choices,
+        and is published to every watcher, with just the changed choice.
+
+        """
+        watchers = self.subscribe(self.watchers)
+        for w in watchers:
+            read_events(w)
+        self.c2.vote_me()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.publisher.check(), self.watchers)
+        for w in watchers:
+            message, = read_events(w)
+            self.assertEqual(message['choices'], {self.c2.pk: 1})
+            self.assertEqual(message['total_votes'], 1)
+            self.assertFalse(message.get('full'))
+
+    def test_no_change_reads_only_the_versions(self):
+        """Without votes, a check reads the versions, and publishes nothing."""
+        watchers = self.subscribe(self.watchers)
+        self.publisher.check()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.publisher.check(), 0)
+
+    def test_many_polls_are_checked_at_once(self):
+        """The changes of several polls are read with the same two queries."""
+        other = PollFactory()
+        other.save()
+        choice = other.choice_set.create(choice="other")
+        self.subscribe(10)
+        others = [self.publisher.subscribe(other.pk) for i in range(10)]
+        self.c1.vote_me()
+        choice.vote_me()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.publisher.check(), 20)
+        self.assertEqual(read_events(others[0])[-1]['choices'], {choice.pk: 1})
+
+    def test_new_choices_reload_the_page(self):
+        """Adding (or renaming, or deleting) a choice asks for a reload."""
+        watcher, = self.subscribe(1)
+        self.poll.choice_set.create(choice="three")
+        self.poll.touch()
+        self.publisher.check()
+        self.assertTrue(read_events(watcher)[-1]['reload'])
+
+    def test_deleted_poll_reloads_the_page(self):
+        watcher, = self.subscribe(1)
+        self.poll.delete()
+        self.publisher.check()
+        self.assertTrue(read_events(watcher)[-1]['reload'])
+
+    def test_lagging_watchers_are_dropped(self):
+        """A watcher whose messages are not read is dropped when its queue
+        is full.
+
+        """
+        watcher, = self.subscribe(1)
+        for i in range(200):
+            self.c1.vote_me()
+            self.publisher.check()
+        self.assertTrue(watcher.lagging)
+        self.assertEqual(self.publisher.watchers, {})
+
+    def test_unsubscribe_forgets_the_poll(self):
+        watchers = self.subscribe(2)
+        for w in watchers:
+            self.publisher.unsubscribe(w)
+        self.assertEqual(self.publisher.states, {})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.publisher.check(), 0)
+
+    @override_settings(POLLS_LIVE_RESULTS=True)
+    def test_live_results_view_streams_events(self):
+        """The view streams the snapshot, then the changes, as events."""
+        request = request_factory.get(
+                reverse('polls:live_results', kwargs={'poll_id':self.poll.id}))
+        with patch('polls.views.publisher', self.publisher):
+            response = views.live_results(request, poll_id=str(self.poll.id))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertTrue(next(events).startswith("retry: "))
+        snapshot = next(events)
+        version = Poll.objects.get(pk=self.poll.pk).version
+        self.assertTrue(snapshot.startswith("id: %s\n" % version))
+        self.assertTrue(json.loads(snapshot.split("data: ", 1)[1])['full'])
+        self.c1.vote_me()
+        self.publisher.check()
+        delta = json.loads(next(events).split("data: ", 1)[1])
+        self.assertEqual(delta['choices'], {str(self.c1.pk): 1})
+        response.close()
+        self.assertEqual(self.publisher.watchers, {})
+
+    @override_settings(POLLS_LIVE_RESULTS=True)
+    def test_live_results_of_no_poll_is_404(self):
+        request = request_factory.get('/')
+        with self.assertRaises(Http404):
+            views.live_results(request, poll_id='9999')
+
+    def test_live_results_are_off_by_default(self):
+        request = request_factory.get('/')
+        with self.assertRaises(Http404):
+            views.live_results(request, poll_id=str(self.poll.id))
+
+    @override_settings(POLLS_LIVE_RESULTS=True)
+    def test_live_results_closed_before_streaming(self):
+        """A response closed before its first event subscribes no watcher."""
+        request = request_factory.get('/')
+        with patch('polls.views.publisher', self.publisher):
+            views.live_results(request, poll_id=str(self.poll.id)).close()
+        self.assertEqual(self.publisher.watchers, {})
+        self.assertEqual(self.publisher.states, {})
+
+    def test_stream_of_a_deleted_poll_ends(self):
+        stream = self.publisher.stream(self.poll.pk, duration=10)
+        self.poll.delete()
+        self.assertEqual(list(stream), [])
+        self.assertEqual(self.publisher.watchers, {})
+
+
+class ApiTesting(TestCase):
+    """The JSON API: one query per request, and no model instances."""
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.user.save()
+        start = datetime.datetime(2013, 1, 1, tzinfo=timezone.utc)
+        self.polls = [Poll.objects.create(question=u"Question %i" % i, created_by=self.user,
+                                          pub_date=start + datetime.timedelta(days=i))
+                      for i in range(5)]
+        self.poll = self.polls[0]
+        self.c1 = self.poll.choice_set.create(choice=u"one")
+        self.c2 = self.poll.choice_set.create(choice=u"two")
+        self.c2.vote_me()
+        self.c2.vote_me()
+        self.c1.vote_me()
+
+    def get_json(self, name, params=None, **kwargs):
+        response = self.client.get(reverse('polls:%s' % name, kwargs=kwargs), params or {})
+        content = (''.join(response.streaming_content) if response.streaming
+                   else response.content)
+        return response, json.loads(content)
+
+    def test_poll_list_pages(self):
+        """The polls, newest first, in keyset pages."""
+        with self.assertNumQueries(1):
+            response, page = self.get_json('api_polls', {'limit': 2})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual([p['question'] for p in page['polls']], [u"Question 4", u"Question 3"])
+        self.assertIsNone(page['previous'])
+        seen = []
+        while page['next']:
+            seen += [p['id'] for p in page['polls']]
+            page = json.loads(''.join(self.client.get(page['next']).streaming_content))
+        seen += [p['id'] for p in page['polls']]
+        self.assertEqual(seen, [p.pk for p in reversed(self.polls)])
+        self.assertTrue(page['previous'])
+
+    def test_poll_list_is_streamed_in_batches(self):
+        with patch.object(api, 'STREAM_BATCH', 2):
+            response = self.client.get(reverse('polls:api_polls'))
+            chunks = list(response.streaming_content)
+        # The opening, 3 batches, and the end.
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(len(json.loads(''.join(chunks))['polls']), 5)
+
+    def test_poll_list_bad_parameters(self):
+        response, data = self.get_json('api_polls', {'limit': 'x'})
+        self.assertEqual(response.status_code, 400)
+        response, data = self.get_json('api_polls', {'limit': api.MAX_LIMIT + 1})
+        self.assertEqual(response.status_code, 400)
+        response, data = self.get_json('api_polls', {'cursor': 'forged'})
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', data)
+
+    def test_poll_results(self):
+        """A poll's results, most voted first, with one query."""
+        with self.assertNumQueries(1):
+            response, results = self.get_json('api_results', poll_id=self.poll.pk)
+        self.assertEqual(results['question'], self.poll.question)
+        self.assertEqual((results['total_votes'], results['max_votes']), (3, 2))
+        self.assertEqual([(c['id'], c['choice'], c['votes']) for c in results['choices']],
+                         [(self.c2.pk, u"two", 2), (self.c1.pk, u"one", 1)])
+
+    def test_poll_results_without_choices_or_poll(self):
+        response, results = self.get_json('api_results', poll_id=self.polls[1].pk)
+        self.assertEqual(results['choices'], [])
+        response, results = self.get_json('api_results', poll_id=9999)
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_results_in_one_query(self):
+        """The results of many polls take one query, in the order asked."""
+        ids = [p.pk for p in reversed(self.polls)] + [9999]
+        with self.assertNumQueries(1):
+            response, data = self.get_json(
+                    'api_bulk_results', {'ids': ','.join(map(str, ids + ids))})
+        self.assertEqual([r['id'] for r in data['results']], ids[:-1])
+        self.assertEqual(data['missing'], [9999])
+        self.assertEqual(len(data['results'][-1]['choices']), 2)
+
+    def test_bulk_results_bad_ids(self):
+        response, data = self.get_json('api_bulk_results', {'ids': '1,a'})
+        self.assertEqual(response.status_code, 400)
+        response, data = self.get_json('api_bulk_results', {'ids': ''})
+        self.assertEqual(response.status_code, 400)
+        too_many = ','.join(str(i) for i in range(1, api.MAX_BULK_IDS + 2))
+        response, data = self.get_json('api_bulk_results', {'ids': too_many})
+        self.assertEqual(response.status_code, 400)
+        for ids in ('1,%i' % (api.MAX_ID + 1), '1,0', '-1'):
+            response, data = self.get_json('api_bulk_results', {'ids': ids})
+            self.assertEqual(response.status_code, 400, ids)
+        response, data = self.get_json('api_bulk_results', {'ids': str(api.MAX_ID)})
+        self.assertEqual(data['missing'], [api.MAX_ID])
+
+    def test_poll_results_id_out_of_range(self):
+        response, results = self.get_json('api_results', poll_id=api.MAX_ID + 1)
+        self.assertEqual(response.status_code, 400)
+        response, results = self.get_json('api_results', poll_id=api.MAX_ID)
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_results_with_sharded_votes(self):
+        """The votes in the shards are counted."""
+        self.c1.vote_me()
+        self.c1.vote_me()
+        response, results = self.get_json('api_results', poll_id=self.poll.pk)
+        self.assertEqual([(c['id'], c['votes']) for c in results['choices']],
+                         [(self.c1.pk, 3), (self.c2.pk, 2)])
+        self.assertEqual(results['total_votes'], 5)
+
+    def test_api_only_gets(self):
+        response = self.client.post(reverse('polls:api_results', kwargs={'poll_id': self.poll.pk}))
+        self.assertEqual(response.status_code, 405)
+
+
+class BulkVotesTesting(TestCase):
+    """Votes in bulk, for the kiosks."""
+
+    def setUp(self):
+        self.kiosk = UserFactory(username="kiosk")
+        self.kiosk.set_password(DEFAULT_PASSWORD)
+        self.kiosk.save()
+        self.kiosk.user_permissions.add(Permission.objects.get(codename='can_ingest_votes'))
+        self.client.login(username="kiosk", password=DEFAULT_PASSWORD)
+        self.poll = PollFactory()
+        self.poll.save()
+        self.c1 = self.poll.choice_set.create(choice=u"one")
+        self.c2 = self.poll.choice_set.create(choice=u"two")
+        self.other = PollFactory()
+        self.other.save()
+        self.c3 = self.other.choice_set.create(choice=u"three")
+
+    def post_votes(self, votes, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(votes)
+        else:
+            body = "\n".join(v if isinstance(v, basestring) else json.dumps(v) for v in votes)
+        return self.client.post(reverse('polls:api_votes'), body, content_type=content_type)
+
+    def votes(self):
+        return dict(Choice.objects.values_list('pk', 'votes'))
+
+    def test_bulk_votes_are_counted(self):
+        votes = ([{'poll': self.poll.pk, 'choice': self.c1.pk}] * 1500 +
+                 [{'poll': self.poll.pk, 'choice': self.c2.pk}] * 500 +
+                 [{'poll': self.other.pk, 'choice': self.c3.pk}] * 7)
+        response = self.post_votes(votes)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'accepted': 2007, 'rejected': []})
+        self.assertEqual(self.votes(), {self.c1.pk: 1500, self.c2.pk: 500, self.c3.pk: 7})
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.total_votes, poll.max_votes), (2000, 1500))
+
+    def test_bulk_votes_queries_dont_grow_with_the_votes(self):
+        """The queries depend on the polls voted, not on the votes."""
+        def count(n):
+            votes = [{'poll': self.poll.pk, 'choice': self.c1.pk}] * n
+            with CaptureQueriesContext(connection) as captured:
+                self.post_votes(votes)
+            return len(captured)
+        self.assertEqual(count(10), count(3000))
+
+    def test_bulk_votes_one_update_of_the_choices_per_poll(self):
+        votes = [{'poll': self.poll.pk, 'choice': c.pk} for c in (self.c1, self.c2) * 100]
+        with CaptureQueriesContext(connection) as captured:
+            self.post_votes(votes)
+        self.assertEqual(len(updates_of('polls_choice', captured)), 1)
+
+    def test_bulk_votes_rejects(self):
+        """The wrong items are reported, and the rest counted."""
+        votes = [
+                {'poll': self.poll.pk, 'choice': self.c1.pk},
+                {'poll': self.poll.pk, 'choice': self.c3.pk},
+                {'poll': self.poll.pk},
+                [self.poll.pk, self.c1.pk],
+                {'poll': self.poll.pk, 'choice': "1"},
+                {'poll': 9999, 'choice': self.c1.pk},
+                {'poll': self.other.pk, 'choice': self.c3.pk},
+            ]
+        data = json.loads(self.post_votes(votes).content)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual([r['index'] for r in data['rejected']], [1, 2, 3, 4, 5])
+        self.assertEqual(self.votes(), {self.c1.pk: 1, self.c2.pk: 0, self.c3.pk: 1})
+
+    def test_bulk_votes_ids_out_of_range(self):
+        """The items with an id beyond the DB's integers are rejected, and
+        the rest counted.
+
+        """
+        votes = [{'poll': self.poll.pk, 'choice': self.c1.pk}]
+        for poll_id, choice_id in [(self.poll.pk, api.MAX_ID + 1), (2 ** 64, self.c1.pk),
+                                   (self.poll.pk, 0)]:
+            votes.append({'poll': poll_id, 'choice': choice_id})
+        for content_type in ('application/json', 'application/x-ndjson'):
+            response = self.post_votes(votes, content_type)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+            self.assertEqual(data['accepted'], 1)
+            self.assertEqual(data['rejected'], [
+                    {'index': i, 'error': u"Ids go from 1 to %i." % api.MAX_ID}
+                    for i in (1, 2, 3)])
+        self.assertEqual(self.votes()[self.c1.pk], 2)
+
+    def test_bulk_votes_ndjson(self):
+        votes = [{'poll': self.poll.pk, 'choice': self.c2.pk}, "not json", "",
+                 {'poll': self.poll.pk, 'choice': self.c2.pk}]
+        data = json.loads(self.post_votes(votes, 'application/x-ndjson').content)
+        self.assertEqual(data, {'accepted': 2, 'rejected': [
+                {'index': 1, 'error': u'Not {"poll": id, "choice": id}.'}]})
+        self.assertEqual(self.votes()[self.c2.pk], 2)
+
+    def test_bulk_votes_failure_counts_nothing(self):
+        """The votes are added in a single transaction."""
+        votes = [{'poll': self.poll.pk, 'choice': self.c1.pk},
+                 {'poll': self.other.pk, 'choice': self.c3.pk}]
+        add_votes = Choice.objects.add_votes
+        calls = []
+        def failing(poll_id, counts):
+            calls.append(poll_id)
+            if len(calls) == 2:
+                raise IntegrityError("Failed")
+            return add_votes(poll_id, counts)
+        with patch.object(Choice.objects, 'add_votes', side_effect=failing):
+            with self.assertRaises(IntegrityError):
+                self.post_votes(votes)
+        self.assertEqual(self.votes(), {self.c1.pk: 0, self.c2.pk: 0, self.c3.pk: 0})
+
+    def test_bulk_votes_bad_requests(self):
+        self.assertEqual(self.post_votes({'poll': 1}).status_code, 400)
+        response = self.client.post(reverse('polls:api_votes'), "[]", content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+        with patch.object(api, 'MAX_BULK_VOTES', 10):
+            votes = [{'poll': self.poll.pk, 'choice': self.c1.pk}] * 11
+            self.assertEqual(self.post_votes(votes).status_code, 413)
+        self.assertEqual(self.votes()[self.c1.pk], 0)
+        self.assertEqual(self.client.get(reverse('polls:api_votes')).status_code, 405)
+
+    def test_bulk_votes_need_the_permission(self):
+        """Anonymous users, and users without the permission, get a 403."""
+        votes = [{'poll': self.poll.pk, 'choice': self.c1.pk}]
+        self.client.logout()
+        self.assertEqual(self.post_votes(votes).status_code, 403)
+        someone = UserFactory(username="someone")
+        someone.set_password(DEFAULT_PASSWORD)
+        someone.save()
+        self.client.login(username="someone", password=DEFAULT_PASSWORD)
+        self.assertEqual(self.post_votes(votes).status_code, 403)
+        self.assertEqual(self.votes()[self.c1.pk], 0)
+
+
+@skipUnless(connection.vendor == 'sqlite', "The query plans are checked on SQLite.")
+class QueryPlansTesting(TestCase):
+    """No view reads a whole polls table without an index.
+
+    Set POLLS_PLAN_CHECK_CHOICES (e.g. to 1000000) to check the plans on a
+    bigger dataset.
+
+    """
+    NCHOICES = int(os.environ.get('POLLS_PLAN_CHECK_CHOICES', 3000))
+
+    @classmethod
+    def setUpTestData(cls):
+        user = UserFactory()
+        start = datetime.datetime(2011, 1, 1, tzinfo=timezone.utc)
+        Poll.objects.bulk_create(
+                Poll(question=u"%s question %i" % ("AB"[i % 2], i),
+                     pub_date=start + datetime.timedelta(hours=i),
+                     created_by=user,
+                     total_votes=i % 7)
+                for i in xrange(cls.NCHOICES // 3)
+            )
+        Choice.objects.bulk_create(
+                Choice(poll_id=poll_id, choice=u"Choice %i" % j,
+                       votes=(poll_id * j) % 11, _order=j)
+                for poll_id in Poll.objects.values_list('pk', flat=True)
+                for j in range(3)
+            )
+        connection.cursor().execute("ANALYZE")
+        PollStats.refresh() # Done by a scheduled command, not by the views.
+        cls.poll = Poll.objects.order_by('pk')[cls.NCHOICES // 6]
+        cls.user = UserFactory(is_superuser=True)
+
+    def assertNoFullScans(self, view, url, **kwargs):
+        request = request_factory.get(url)
+        request.user = self.user
+        with capture_selects() as selects:
+            response = view(request, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        self.assertTrue(selects)
+        self.assertEqual(full_scans(selects), [])
+
+    def test_archive(self):
+        self.assertNoFullScans(views.PollsArchiveView.as_view(), reverse('polls:archive'))
+
+    def test_archive_year(self):
+        url = "%s?year=2011" % reverse('polls:archive_year')
+        self.assertNoFullScans(views.PollsYearArchiveView.as_view(), url)
+
+    def test_voting(self):
+        url = reverse('polls:voting', kwargs={'poll_id':self.poll.id})
+        self.assertNoFullScans(views.PollVoting.as_view(), url, poll_id=self.poll.id)
+
+    def test_results(self):
+        url = reverse('polls:results', kwargs={'poll_id':self.poll.id})
+        self.assertNoFullScans(views.PollResults.as_view(), url, poll_id=self.poll.id)
+
+    def test_facts(self):
+        self.assertNoFullScans(views.FactsView.as_view(), reverse('polls:facts'))
+
+    def test_api_polls(self):
+        self.assertNoFullScans(api.poll_list, reverse('polls:api_polls'))
+
+    def test_api_bulk_results(self):
+        url = "%s?ids=%s,%s" % (reverse('polls:api_bulk_results'), self.poll.id, self.poll.id + 1)
+        self.assertNoFullScans(api.bulk_results, url)
+
+    def test_api_trend(self):
+        url = reverse('polls:api_trend', kwargs={'poll_id':self.poll.id})
+        self.assertNoFullScans(api.poll_trend, url, poll_id=self.poll.id)
+
+    @skipUnless(connection.vendor == 'sqlite', "The query plans are checked on SQLite.")
+    def test_results_order_by_the_index(self):
+        """The choices of a poll by votes are read from the (poll, votes)
+        index, already sorted.
+
+        """
+        with capture_selects() as selects:
+            list(self.poll.choice_set.order_by('-votes'))
+        [plan] = [explain(sql, params) for sql, params in selects]
+        self.assertTrue(plan[0].startswith('SEARCH'), plan)
+        self.assertFalse([d for d in plan if 'TEMP B-TREE' in d], plan)
+
+
+class KeysetPaginationTesting(TestCase):
+    def setUp(self):
+        user = UserFactory()
+        day = datetime.datetime(2012, 3, 1, tzinfo=timezone.utc)
+        # Pairs of polls published at the same time, to check the ties.
+        for i in range(25):
+            PollFactory(created_by=user, pub_date=day + datetime.timedelta(days=i // 2))
+        self.expected = list(Poll.objects.order_by('-pub_date', '-pk').values_list('pk', flat=True))
+
+    def walk(self, size):
+        pages, cursor = [], None
+        while True:
+            page = keyset_page(Poll.objects.all(), cursor, size)
+            pages.append(page)
+            if not page.has_next():
+                return pages
+            cursor = page.next_cursor
+
+    def test_pages_walk_all_the_polls_in_order(self):
+        """Following the next cursors visits every poll once, newest first."""
+        pages = self.walk(4)
+        self.assertEqual(len(pages), 7)
+        self.assertEqual([p.pk for page in pages for p in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+    def test_previous_cursor_goes_back_a_page(self):
+        """The previous cursor of a page leads to the page before it."""
+        pages = self.walk(4)
+        for before, page in zip(pages, pages[1:]):
+            back = keyset_page(Poll.objects.all(), page.previous_cursor, 4)
+            self.assertEqual([p.pk for p in back], [p.pk for p in before])
+
+    def test_page_is_a_single_query(self):
+        """A page is fetched with one query, without counting the polls."""
+        cursor = self.walk(4)[3].next_cursor
+        with self.assertNumQueries(1):
+            keyset_page(Poll.objects.all(), cursor, 4)
+
+    @skipUnless(connection.vendor == 'sqlite', "The query plans are checked on SQLite.")
+    def test_page_seeks_the_index(self):
+        """A page after a cursor seeks the index instead of scanning it."""
+        cursor = self.walk(4)[3].next_cursor
+        with capture_selects() as selects:
+            keyset_page(Poll.objects.all(), cursor, 4)
+        [plan] = [explain(sql, params) for sql, params in selects]
+        self.assertTrue(plan[0].startswith('SEARCH'), plan)
+
+    def test_bad_cursor_is_404(self):
+        """A tampered cursor responds a 404."""
+        with self.assertRaises(Http404):
+            keyset_page(Poll.objects.all(), "not-a-cursor", 4)
+
+    @override_settings(POLLS_KEYSET_PAGINATION=True)
+    def test_year_archive_with_cursors(self):
+        """The year archive links to the next page with a cursor."""
+        response = self.client.get(reverse('polls:archive_year'), {'year': 2012})
+        page = response.context['page_obj']
+        self.assertEqual([p.pk for p in response.context['object_list']], self.expected[:10])
+        self.assertContains(response, html.escape(page.next_url()))
+        response = self.client.get(reverse('polls:archive_year') + page.next_url())
+        self.assertEqual([p.pk for p in response.context['object_list']], self.expected[10:20])
+
+    @override_settings(POLLS_KEYSET_PAGINATION=True)
+    def test_archive_with_cursors(self):
+        """The archive index is paginated with cursors."""
+        response = self.client.get(reverse('polls:archive'))
+        self.assertEqual([p.pk for p in response.context['latest']], self.expected[:10])
+        self.assertIsNone(response.context['paginator'])
+
+
 class YearArchiveViewTest(TestCase):
     def test_year_archive_bad_year_parameter(self):
         """Passing a year that's not a number, responds with 404"""
@@ -511,6 +1631,97 @@ class EditPollTesting(TestCase):
         for i, db_choice in enumerate(Choice.objects.all()):
             self.assertEqual(db_choice.choice, desired_values[i])
 
+    def test_edit_poll_deleting_choices_updates_the_totals(self):
+        """Deleting a voted choice while editing takes its votes out of the totals."""
+        self.choice.vote_me()
+        valid_data = formset_management_form(
+                [(self.choice.id, self.a_choice), (None, u'another')],
+                extra={'question': self.a_question, 'choice_set-0-DELETE': 'on'})
+        request = request_factory.post(
+                reverse('polls:edit_poll', kwargs={'poll_id':self.poll.id}),
+                data = valid_data,
+            )
+        request.user = self.a_user
+        views.edit_poll(request, poll_id=self.poll.id)
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).total_votes, 0)
+
+
+
+class EditPollQueriesTesting(TestCase):
+    """Saving an edited poll takes the same queries with any number of choices."""
+    def setUp(self):
+        self.a_user = UserFactory(username="editor")
+        self.a_question = 'a question?'
+
+    def edit(self, n):
+        """Edit a poll of 'n' choices: delete the first two (one of them
+        voted), rename the third, reverse the order of the rest and add two.
+        Return the number of queries, and the poll.
+
+        """
+        poll = self.a_user.poll_set.create(question=self.a_question)
+        choices = [poll.choice_set.create(choice=u'choice %i' % i) for i in range(n)]
+        choices[0].vote_me()
+        choices[2].vote_me()
+        items = [(c.id, c.choice) for c in choices]
+        items[2] = (choices[2].id, u'renamed')
+        items[3:] = reversed(items[3:])
+        items += [(None, u'new 1'), (None, u'new 2')]
+        data = formset_management_form(items, extra={
+                'question': self.a_question,
+                'choice_set-0-DELETE': 'on',
+                'choice_set-1-DELETE': 'on',
+            })
+        request = request_factory.post(
+                reverse('polls:edit_poll', kwargs={'poll_id':poll.id}), data=data)
+        request.user = self.a_user
+        with CaptureQueriesContext(connection) as captured:
+            response = views.edit_poll(request, poll_id=poll.id)
+        self.assertEqual(response.status_code, 302)
+        return len(captured), poll
+
+    def test_edit_poll_queries_dont_grow_with_the_choices(self):
+        """Editing 60 choices takes as many queries as editing 10."""
+        few, poll = self.edit(10)
+        many, poll = self.edit(60)
+        self.assertEqual(few, many)
+
+    def test_edit_poll_in_bulk_saves_all_the_changes(self):
+        """The deleted, renamed, reordered and new choices are all saved."""
+        queries, poll = self.edit(60)
+        names = [u'renamed'] + [u'choice %i' % i for i in reversed(range(3, 60))] + [u'new 1', u'new 2']
+        self.assertEqual(list(poll.choice_set.values_list('choice', flat=True)), names)
+        poll = Poll.objects.get(pk=poll.pk)
+        self.assertEqual(poll.total_votes, 1)
+        self.assertEqual(poll.max_votes, 1)
+        self.assertEqual(PollStats.get().choices, Choice.objects.count())
+
+    def test_edit_poll_renaming_to_a_deleted_choice(self):
+        """A choice can take the text of a choice deleted in the same edition."""
+        poll = self.a_user.poll_set.create(question=self.a_question)
+        a = poll.choice_set.create(choice=u'a')
+        b = poll.choice_set.create(choice=u'b')
+        data = formset_management_form([(a.id, u'a'), (b.id, u'a')], extra={
+                'question': self.a_question, 'choice_set-0-DELETE': 'on'})
+        request = request_factory.post(
+                reverse('polls:edit_poll', kwargs={'poll_id':poll.id}), data=data)
+        request.user = self.a_user
+        response = views.edit_poll(request, poll_id=poll.id)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(poll.choice_set.values_list('pk', 'choice')), [(b.pk, u'a')])
+
+    def test_edit_poll_failure_saves_nothing(self):
+        """If saving the choices fails, the poll isn't saved either."""
+        poll = self.a_user.poll_set.create(question=self.a_question)
+        data = formset_management_form([(None, u'a')], extra={'question': u'changed?'})
+        request = request_factory.post(
+                reverse('polls:edit_poll', kwargs={'poll_id':poll.id}), data=data)
+        request.user = self.a_user
+        with patch.object(Choice.objects, 'bulk_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                views.edit_poll(request, poll_id=poll.id)
+        self.assertEqual(Poll.objects.get(pk=poll.pk).question, self.a_question)
+        self.assertFalse(poll.choice_set.exists())
 
 
 class VotingFormTesting(TestCase):
@@ -527,12 +1738,93 @@ class VotingFormTesting(TestCase):
         c1 = ChoiceFactory(poll=self.poll)
         c2 = ChoiceFactory(poll=self.poll)
         form = forms.VoteForm(poll=self.poll)
-        self.assertQuerysetEqual(
-                form.fields['choice'].queryset, 
-                [c1.id, c2.id],
-                transform=lambda c:c.id
+        self.assertEqual(
+                [pk for pk, label in form.fields['choice'].choices],
+                [c1.id, c2.id]
             )
 
+    def test_voting_form_validates_in_memory(self):
+        """With the choices given, the VotingForm validates without queries,
+        and its cleaned choice is the Choice."""
+        c1 = ChoiceFactory(poll=self.poll)
+        c2 = ChoiceFactory(poll=self.poll)
+        choices = list(self.poll.choice_set.all())
+        with self.assertNumQueries(0):
+            form = forms.VoteForm({'choice': c2.id}, poll=self.poll, choices=choices)
+            self.assertTrue(form.is_valid())
+            self.assertIs(form.cleaned_data['choice'], choices[1])
+            form = forms.VoteForm({'choice': 505050}, poll=self.poll, choices=choices)
+            self.assertFalse(form.is_valid())
+
+
+class VotingQueriesTesting(TestCase):
+    """The voting page, and the vote, read the poll and its choices in one
+    query."""
+
+    def setUp(self):
+        self.poll = PollFactory()
+
+    def get_voting_page(self):
+        request = request_factory.get(
+                reverse('polls:voting', kwargs={'poll_id':self.poll.id}))
+        request.user = AnonymousUser()
+        response = views.PollVoting.as_view()(request, poll_id=self.poll.id)
+        response.render()
+        return response
+
+    def post_vote(self, choice_id):
+        request = request_factory.post(
+                reverse('polls:emit_vote', kwargs={'poll_id':self.poll.id}),
+                data = {'choice': choice_id}
+            )
+        request.user = AnonymousUser()
+        response = views.PollVote.as_view()(request, poll_id=self.poll.id)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def test_voting_page_is_one_query(self):
+        """The voting page makes 1 query, whatever the number of choices."""
+        for n in (3, 30):
+            for i in range(n):
+                ChoiceFactory(poll=self.poll)
+            with self.assertNumQueries(1):
+                response = self.get_voting_page()
+            self.assertContains(response, 'type="radio"', count=self.poll.choice_set.count())
+            self.assertContains(response, self.poll.created_by.username)
+
+    def test_voting_page_without_choices(self):
+        """A poll without choices takes a second query, and has no form."""
+        with self.assertNumQueries(2):
+            response = self.get_voting_page()
+        self.assertNotContains(response, 'type="radio"')
+
+    def test_voting_page_of_a_missing_poll(self):
+        """The voting page of a poll that doesn't exist is a 404."""
+        request = request_factory.get(reverse('polls:voting', kwargs={'poll_id':10000}))
+        with self.assertRaises(Http404):
+            views.PollVoting.as_view()(request, poll_id=10000)
+
+    def test_invalid_vote_is_one_query(self):
+        """A vote for a choice of another poll is rejected after 1 query."""
+        ChoiceFactory(poll=self.poll)
+        other = ChoiceFactory()
+        with self.assertNumQueries(1):
+            response = self.post_vote(other.id)
+        self.assertContains(response, u"Select a valid choice.")
+        self.assertEqual(Choice.objects.get(pk=other.pk).votes, 0)
+
+    def test_vote_reads_the_choices_once(self):
+        """A vote reads the poll and its choices in 1 query, and then votes."""
+        choices = [ChoiceFactory(poll=self.poll) for i in range(5)]
+        with CaptureQueriesContext(connection) as captured:
+            response = self.post_vote(choices[2].id)
+        self.assertEqual(response.status_code, 302)
+        sql = [q['sql'] for q in captured.captured_queries]
+        first_write = min(i for i, q in enumerate(sql) if 'UPDATE "polls_choice"' in q)
+        self.assertEqual(len([q for q in sql[:first_write] if 'SELECT ' in q]), 1)
+        self.assertEqual(Choice.objects.get(pk=choices[2].pk).votes, 1)
+
 
 class PollVoteTesting(TestCase):
     def setUp(self):
@@ -603,3 +1895,405 @@ class PollVoteTesting(TestCase):
         print response
         self.assertContains(response, u"Select a valid choice.")
 
+
+@override_settings(POLLS_VOTE_WRITE_BEHIND=True, POLLS_VOTE_FLUSH_MAX=1)
+class BufferedPollVoteTesting(PollVoteTesting):
+    """The PollVoteTesting tests, voting through the write-behind buffer."""
+
+    def test_buffered_vote_is_counted(self):
+        """A vote emitted with write-behind is in the DB after the flush."""
+        self.client.post(
+                reverse('polls:emit_vote', kwargs={'poll_id':self.poll.id}),
+                data = {'choice':self.c1.id}
+            )
+        self.assertEqual(Choice.objects.get(pk=self.c1.pk).votes, 1)
+
+
+
+class IdempotentVoteTesting(TestCase):
+    """A vote request is counted once per idempotency key."""
+
+    def setUp(self):
+        self.poll = PollFactory()
+        self.poll.save()
+        self.c1 = self.poll.choice_set.create(choice=u"one")
+        self.url = reverse('polls:emit_vote', kwargs={'poll_id':self.poll.id})
+
+    def votes(self):
+        return Choice.objects.get(pk=self.c1.pk).votes
+
+    def test_voting_form_has_a_new_key(self):
+        response = self.client.get(reverse('polls:voting', kwargs={'poll_id':self.poll.id}))
+        form = response.context['voting_form']
+        self.assertEqual(len(form['idempotency_key'].value()), 32)
+        self.assertContains(response, 'name="idempotency_key"')
+        self.assertNotEqual(forms.VoteForm(poll=self.poll)['idempotency_key'].value(),
+                            form['idempotency_key'].value())
+
+    def test_resubmitted_form_votes_once(self):
+        data = {'choice': self.c1.id, 'idempotency_key': 'a key'}
+        for i in range(3):
+            response = self.client.post(self.url, data)
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.votes(), 1)
+        self.client.post(self.url, dict(data, idempotency_key='another key'))
+        self.assertEqual(self.votes(), 2)
+
+    def test_idempotency_key_header(self):
+        for i in range(2):
+            self.client.post(self.url, {'choice': self.c1.id}, HTTP_IDEMPOTENCY_KEY='retry')
+        self.assertEqual(self.votes(), 1)
+
+    def test_keys_are_per_poll(self):
+        other = Poll.objects.create(question="other", created_by=self.poll.created_by)
+        choice = other.choice_set.create(choice=u"x")
+        self.assertEqual(self.c1.vote_once(request_key='k'), 1)
+        self.assertEqual(choice.vote_once(request_key='k'), 1)
+        self.assertIsNone(self.c1.vote_once(request_key='k'))
+
+    def test_without_key_every_request_votes(self):
+        for i in range(2):
+            self.client.post(self.url, {'choice': self.c1.id})
+        self.assertEqual(self.votes(), 2)
+
+    def test_purge_vote_requests(self):
+        self.c1.vote_once(request_key='old')
+        VoteRequest.objects.update(created=timezone.now() - datetime.timedelta(days=3))
+        self.c1.vote_once(request_key='new')
+        out = StringIO()
+        call_command('purge_vote_requests', days=2, stdout=out)
+        self.assertEqual(VoteRequest.objects.count(), 1)
+        self.assertEqual(self.c1.vote_once(request_key='old'), 3)
+
+
+@override_settings(POLLS_ONE_VOTE_PER_VOTER=True)
+class OneVotePerVoterTesting(TestCase):
+    """With POLLS_ONE_VOTE_PER_VOTER, a voter votes once per poll."""
+
+    def setUp(self):
+        self.poll = PollFactory()
+        self.poll.save()
+        self.c1 = self.poll.choice_set.create(choice=u"one")
+        self.c2 = self.poll.choice_set.create(choice=u"two")
+        self.url = reverse('polls:emit_vote', kwargs={'poll_id':self.poll.id})
+
+    def votes(self):
+        return Poll.objects.get(pk=self.poll.pk).total_votes
+
+    def test_anonymous_voter_votes_once(self):
+        """Anonymous voters are told by their session."""
+        self.assertEqual(self.client.post(self.url, {'choice': self.c1.id}).status_code, 302)
+        response = self.client.post(self.url, {'choice': self.c2.id})
+        self.assertContains(response, forms.ALREADY_VOTED_MSG)
+        self.assertEqual(self.votes(), 1)
+        self.client.cookies.clear()
+        self.client.post(self.url, {'choice': self.c2.id})
+        self.assertEqual(self.votes(), 2)
+
+    def test_user_votes_once_from_any_session(self):
+        user = UserFactory(username="voter")
+        user.set_password(DEFAULT_PASSWORD)
+        user.save()
+        for i in range(2):
+            self.client.login(username="voter", password=DEFAULT_PASSWORD)
+            self.client.post(self.url, {'choice': self.c1.id})
+            self.client.logout()
+        self.assertEqual(self.votes(), 1)
+        self.assertEqual(Voter.objects.filter(poll=self.poll).count(), 1)
+
+    def test_voter_votes_in_every_poll(self):
+        other = PollFactory()
+        other.save()
+        choice = other.choice_set.create(choice=u"x")
+        voter = Voter.key_of("user:1")
+        self.c1.vote_once(voter=voter)
+        choice.vote_once(voter=voter)
+        with self.assertRaises(AlreadyVoted):
+            self.c2.vote_once(voter=voter)
+        self.assertEqual(Choice.objects.get(pk=self.c2.pk).votes, 0)
+
+    def test_retry_of_a_vote_is_not_an_error(self):
+        """The retried request of a counted vote redirects to the results."""
+        data = {'choice': self.c1.id, 'idempotency_key': 'k'}
+        self.client.post(self.url, data)
+        self.assertEqual(self.client.post(self.url, data).status_code, 302)
+        self.assertEqual(self.votes(), 1)
+
+    def test_rejected_vote_leaves_no_request_key(self):
+        """A vote refused to a voter doesn't record its idempotency key."""
+        voter = Voter.key_of("user:1")
+        self.c1.vote_once(voter=voter)
+        with self.assertRaises(AlreadyVoted):
+            self.c2.vote_once(voter=voter, request_key='k')
+        self.assertFalse(VoteRequest.objects.exists())
+
+    def test_first_vote_takes_one_insert_in_the_ledger(self):
+        """The ledger is not read before inserting the voter."""
+        with CaptureQueriesContext(connection) as captured:
+            self.c1.vote_once(voter=Voter.key_of("user:1"))
+        ledger = [q['sql'] for q in captured.captured_queries if 'polls_voter' in q['sql']]
+        self.assertEqual(len(ledger), 1)
+        self.assertIn('INSERT', ledger[0])
+
+    def test_deleting_the_poll_deletes_its_voters(self):
+        self.c1.vote_once(voter=Voter.key_of("user:1"))
+        self.poll.delete()
+        self.assertFalse(Voter.objects.exists())
+
+
+@override_settings(POLLS_VOTE_EVENTS=True, POLLS_VOTE_FLUSH_MAX=1000, POLLS_VOTE_FLUSH_MS=60000)
+class VoteEventsTesting(TestCase):
+    def setUp(self):
+        self.poll = PollFactory()
+        self.c1 = ChoiceFactory(poll=self.poll)
+        self.c2 = ChoiceFactory(poll=self.poll)
+        self.other = ChoiceFactory()
+        self.start = datetime.datetime(2013, 5, 1, 10, 0, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        event_buffer.flush()
+
+    def at(self, minutes, counts, poll=None):
+        VoteEvent.log((poll or self.poll).pk, counts,
+                      self.start + datetime.timedelta(minutes=minutes))
+
+    def rollup(self, model):
+        return sorted((r.choice_id, r.start, r.votes) for r in model.objects.all())
+
+    def events(self):
+        event_buffer.flush()
+        return list(VoteEvent.objects.order_by('pk').values_list('choice', 'votes'))
+
+    def test_votes_are_logged(self):
+        self.c1.vote_me()
+        Choice.objects.add_votes(self.poll.pk, {self.c1.pk: 2, self.c2.pk: 3})
+        self.assertEqual(sorted(self.events()), [(self.c1.pk, 1), (self.c1.pk, 2), (self.c2.pk, 3)])
+        self.assertEqual(set(VoteEvent.objects.values_list('poll', flat=True)), set([self.poll.pk]))
+
+    def test_single_votes_are_logged_in_batches(self):
+        """vote_me doesn't write the log: its votes are logged when the buffer is flushed."""
+        with CaptureQueriesContext(connection) as captured:
+            for i in range(3):
+                self.c1.vote_me()
+            self.c2.vote_me()
+            self.other.vote_me()
+        self.assertFalse([q for q in captured.captured_queries if 'polls_voteevent' in q['sql']])
+        self.assertFalse(VoteEvent.objects.exists())
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(event_buffer.flush(), 5)
+        inserts = [q for q in captured.captured_queries if 'INSERT INTO "polls_voteevent"' in q['sql']]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(sorted(self.events()),
+                         sorted([(self.c1.pk, 3), (self.c2.pk, 1), (self.other.pk, 1)]))
+
+    def test_votes_of_deleted_choices_are_not_logged(self):
+        self.c1.vote_me()
+        self.c2.vote_me()
+        Choice.objects.get(pk=self.c2.pk).delete()
+        self.assertEqual(self.events(), [(self.c1.pk, 1)])
+
+    def test_failed_log_flush_does_not_fail_the_vote(self):
+        """If the log of the votes can't be written, the vote is counted
+        once, the request doesn't fail, and the log is written later.
+
+        """
+        url = reverse('polls:emit_vote', kwargs={'poll_id':self.poll.id})
+        with self.settings(POLLS_VOTE_FLUSH_MAX=1), \
+                patch('polls.votebuffer.logger') as logger, \
+                patch.object(VoteEvent, 'log', side_effect=IntegrityError):
+            for i in range(2):
+                response = self.client.post(url, data={'choice': self.c1.id},
+                                            HTTP_IDEMPOTENCY_KEY='k')
+                self.assertEqual(response.status_code, 302)
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(Choice.objects.get(pk=self.c1.pk).votes, 1)
+        self.assertEqual(self.events(), [(self.c1.pk, 1)])
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_rolled_back_votes_are_not_logged(self):
+        with patch.object(Choice.objects, 'values_list', side_effect=IntegrityError):
+            self.assertRaises(IntegrityError, self.c1.vote_me)
+        self.assertFalse(ChoiceVotesShard.objects.exists())
+        self.assertEqual(self.events(), [])
+
+    def test_vote_once_logs_after_its_transaction(self):
+        depth = len(connection.savepoint_ids)
+        logged = []
+        with patch.object(event_buffer, 'add',
+                          side_effect=lambda c: logged.append(len(connection.savepoint_ids))):
+            self.c1.vote_once(request_key='k')
+        self.assertEqual(logged, [depth])
+
+    def test_votes_are_logged_with_one_insert(self):
+        with CaptureQueriesContext(connection) as captured:
+            Choice.objects.add_votes(self.poll.pk, {self.c1.pk: 2, self.c2.pk: 3})
+        inserts = [q for q in captured.captured_queries if 'INSERT INTO "polls_voteevent"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+
+    @override_settings(POLLS_VOTE_EVENTS=False)
+    def test_votes_not_logged(self):
+        self.c1.vote_me()
+        self.assertFalse(VoteEvent.objects.exists())
+
+    @override_settings(POLLS_VOTE_WRITE_BEHIND=True, POLLS_VOTE_FLUSH_MAX=1000,
+            POLLS_VOTE_FLUSH_MS=60000)
+    def test_buffered_votes_are_logged_when_flushed(self):
+        for i in range(5):
+            self.c1.vote_me()
+        self.assertFalse(VoteEvent.objects.exists())
+        vote_buffer.flush()
+        self.assertEqual(self.events(), [(self.c1.pk, 5)])
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_sharded_votes_are_logged_once(self):
+        """A sharded vote is logged when voted, not again when compacted."""
+        self.c1.vote_me()
+        self.c1.vote_me()
+        ChoiceVotesShard.compact()
+        self.assertEqual(self.events(), [(self.c1.pk, 2)])
+
+    def test_roll_up(self):
+        self.at(0, {self.c1.pk: 1, self.c2.pk: 2})
+        self.at(0.5, {self.c1.pk: 3})
+        self.at(1, {self.c1.pk: 1})
+        self.at(60 * 25, {self.c1.pk: 4})
+        self.at(0, {self.other.pk: 7}, poll=self.other.poll)
+        self.assertEqual(VoteEvent.roll_up(), 6)
+        minute = datetime.timedelta(minutes=1)
+        day = datetime.timedelta(days=1)
+        self.assertEqual(self.rollup(VotesByMinute), sorted([
+                (self.c1.pk, self.start, 4), (self.c1.pk, self.start + minute, 1),
+                (self.c1.pk, self.start + day + 60 * minute, 4),
+                (self.c2.pk, self.start, 2), (self.other.pk, self.start, 7)]))
+        self.assertEqual(self.rollup(VotesByHour), sorted([
+                (self.c1.pk, self.start, 5), (self.c1.pk, self.start + day + 60 * minute, 4),
+                (self.c2.pk, self.start, 2), (self.other.pk, self.start, 7)]))
+        midnight = self.start.replace(hour=0)
+        self.assertEqual(self.rollup(VotesByDay), sorted([
+                (self.c1.pk, midnight, 5), (self.c1.pk, midnight + day, 4),
+                (self.c2.pk, midnight, 2), (self.other.pk, midnight, 7)]))
+        self.assertEqual(VotesByDay.objects.get(choice=self.other).poll_id, self.other.poll_id)
+
+    def test_roll_up_is_incremental(self):
+        """Each event is rolled up once, added to the rows already there."""
+        self.at(0, {self.c1.pk: 1})
+        VoteEvent.roll_up()
+        self.assertEqual(VoteEvent.roll_up(), 0)
+        self.at(0.5, {self.c1.pk: 2, self.c2.pk: 1})
+        self.assertEqual(VoteEvent.roll_up(), 2)
+        self.assertEqual(self.rollup(VotesByMinute),
+                         sorted([(self.c1.pk, self.start, 3), (self.c2.pk, self.start, 1)]))
+        self.assertEqual(VoteRollupState.objects.get().last_event,
+                         VoteEvent.objects.order_by('-pk')[0].pk)
+
+    def test_roll_up_in_batches(self):
+        for i in range(10):
+            self.at(i, {self.c1.pk: 1, self.c2.pk: i})
+        self.assertEqual(VoteEvent.roll_up(batch_size=3), 19)
+        batched = [self.rollup(model) for model in (VotesByMinute, VotesByHour, VotesByDay)]
+        VoteEvent.reset_rollups()
+        self.assertFalse(VotesByHour.objects.exists())
+        self.assertEqual(VoteEvent.roll_up(), 19)
+        self.assertEqual(batched,
+                         [self.rollup(model) for model in (VotesByMinute, VotesByHour, VotesByDay)])
+
+    def test_roll_up_leaves_the_recent_events(self):
+        """The events of the last 'lag' seconds, and those after them, wait."""
+        self.c1.vote_me()
+        event_buffer.flush()
+        VoteEvent.log(self.poll.pk, {self.c2.pk: 1}, timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(VoteEvent.roll_up(lag=60), 0)
+        self.assertEqual(VoteEvent.roll_up(), 2)
+        self.assertEqual(VotesByDay.objects.aggregate(Sum('votes'))['votes__sum'], 2)
+
+    def test_rollup_votes_command(self):
+        self.at(0, {self.c1.pk: 1})
+        self.at(1, {self.c1.pk: 1})
+        call_command('rollup_votes', lag=0, stdout=StringIO())
+        VotesByHour.objects.update(votes=100)
+        out = StringIO()
+        call_command('rollup_votes', lag=0, rebuild=True, stdout=out)
+        self.assertEqual(out.getvalue(), "2 vote events rolled up.\n")
+        self.assertEqual(self.rollup(VotesByHour), [(self.c1.pk, self.start, 2)])
+        self.assertTrue(VoteRollupState.objects.get().rolled_up_to)
+
+    def test_rebuild_choice_votes(self):
+        self.c1.vote_me()
+        self.c1.vote_me()
+        self.c2.vote_me()
+        event_buffer.flush()
+        call_command('rebuild_choice_votes', check=True, stdout=StringIO())
+        Choice.objects.filter(pk=self.c1.pk).update(votes=0)
+        Choice.objects.filter(pk=self.c2.pk).update(votes=10)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_choice_votes', check=True, stdout=StringIO())
+        out = StringIO()
+        call_command('rebuild_choice_votes', stdout=out)
+        self.assertEqual(out.getvalue(), "2 choices fixed.\n")
+        self.assertEqual(Choice.objects.get(pk=self.c1.pk).votes, 2)
+        self.assertEqual(Choice.objects.get(pk=self.c2.pk).votes, 1)
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.total_votes, poll.max_votes), (3, 2))
+        self.assertEqual(PollStats.get().votes, 3)
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_rebuild_leaves_the_votes_in_the_shards(self):
+        self.c1.vote_me()
+        self.c1.vote_me()
+        event_buffer.flush()
+        self.assertEqual(VoteEvent.drifted_choices(), [])
+        ChoiceVotesShard.compact()
+        self.assertEqual(VoteEvent.rebuild_votes(), 0)
+        self.assertEqual(Choice.objects.get(pk=self.c1.pk).votes, 2)
+
+    def get_trend(self, params=None, poll_id=None):
+        response = self.client.get(
+                reverse('polls:api_trend', kwargs={'poll_id': poll_id or self.poll.pk}),
+                params or {})
+        return response, json.loads(response.content)
+
+    def test_api_trend(self):
+        self.at(0, {self.c1.pk: 1, self.c2.pk: 2})
+        self.at(30, {self.c1.pk: 3})
+        self.at(65, {self.c2.pk: 1})
+        self.at(0, {self.other.pk: 7}, poll=self.other.poll)
+        VoteEvent.roll_up()
+        params = {'period': 'hour', 'since': '2013-05-01T09:30:00Z', 'until': '2013-05-01T12:00:00Z'}
+        with self.assertNumQueries(3):
+            response, trend = self.get_trend(params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(trend['choices'], [{'id': self.c1.pk, 'choice': self.c1.choice},
+                                            {'id': self.c2.pk, 'choice': self.c2.choice}])
+        self.assertEqual(trend['trend'], [
+                {'start': '2013-05-01T10:00:00Z', 'total': 6,
+                 'votes': {str(self.c1.pk): 4, str(self.c2.pk): 2}},
+                {'start': '2013-05-01T11:00:00Z', 'total': 1, 'votes': {str(self.c2.pk): 1}},
+            ])
+        self.assertTrue(trend['rolled_up_to'])
+
+        params.update(period='minute', until='2013-05-01T10:31:00Z')
+        response, trend = self.get_trend(params)
+        self.assertEqual([(b['start'], b['total']) for b in trend['trend']],
+                         [('2013-05-01T10:00:00Z', 3), ('2013-05-01T10:30:00Z', 3)])
+
+    def test_api_trend_default_window(self):
+        self.c1.vote_me()
+        event_buffer.flush()
+        VoteEvent.roll_up()
+        response, trend = self.get_trend({'period': 'day'})
+        self.assertEqual([b['total'] for b in trend['trend']], [1])
+        since, until = [datetime.datetime.strptime(trend[k][:19], "%Y-%m-%dT%H:%M:%S")
+                        for k in ('since', 'until')]
+        self.assertEqual(until - since, datetime.timedelta(days=30))
+
+    def test_api_trend_errors(self):
+        for params in [{'period': 'week'}, {'since': 'yesterday'},
+                       {'since': '2013-05-02T00:00', 'until': '2013-05-01T00:00'},
+                       {'period': 'minute', 'since': '2013-01-01T00:00', 'until': '2013-05-01T00:00'}]:
+            response, trend = self.get_trend(params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', trend)
+        response, trend = self.get_trend(poll_id=self.poll.pk + 1000)
+        self.assertEqual(response.status_code, 404)
+        response, trend = self.get_trend(poll_id=api.MAX_ID + 1)
+        self.assertEqual(response.status_code, 400)
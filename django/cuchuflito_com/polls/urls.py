@@ -1,6 +1,6 @@
 from django.conf.urls import patterns, url
 
-from polls import views
+from polls import views, api
 
 urlpatterns = patterns('',
     url(r'^$', views.PollsIndex.as_view(), name='index'),
@@ -11,7 +11,13 @@ urlpatterns = patterns('',
     url(r'^(?P<poll_id>\d+)/voting/$', views.PollVoting.as_view(), name='voting'),
     url(r'^(?P<poll_id>\d+)/emit_vote/$', views.PollVote.as_view(), name='emit_vote'),
     url(r'^(?P<poll_id>\d+)/results/$', views.PollResults.as_view(), name='results'),
+    url(r'^(?P<poll_id>\d+)/results/live/$', views.live_results, name='live_results'),
     url(r'^facts/$', views.FactsView.as_view(), name='facts'),
+    url(r'^api/polls/$', api.poll_list, name='api_polls'),
+    url(r'^api/polls/(?P<poll_id>\d+)/results/$', api.poll_results, name='api_results'),
+    url(r'^api/polls/(?P<poll_id>\d+)/trend/$', api.poll_trend, name='api_trend'),
+    url(r'^api/results/$', api.bulk_results, name='api_bulk_results'),
+    url(r'^api/votes/$', api.ingest_votes, name='api_votes'),
     url(r'^login/$', 'django.contrib.auth.views.login', {'template_name': 'polls/login.html'}, name='login'),
     url(r'^logout/$', 'django.contrib.auth.views.logout', {'next_page':'/polls/'}, name='logout'),
 )
\ No newline at end of file
@@ -2,7 +2,7 @@
 import datetime
 
 from django.shortcuts import get_object_or_404, render, redirect, render_to_response
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.core.exceptions import PermissionDenied
 from django.template import RequestContext
 from django.template.response import TemplateResponse
@@ -11,11 +11,21 @@ from django.views.generic.dates import ArchiveIndexView, YearArchiveView
 from django.db.models import Avg, Max, Sum, Q, F
 from django.contrib.auth.decorators import login_required, permission_required
 from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.views.decorators.vary import vary_on_cookie
+from django.template.loader import render_to_string
+from django.core.cache import caches
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import transaction
 
-from polls.models import Poll, Choice
+from polls.models import Poll, Choice, PollStats, Voter, AlreadyVoted, vote_shards
 
-from polls.forms import VoteForm, PollDetailForm, ChoiceFormSet
+from polls.forms import VoteForm, PollDetailForm, ChoiceFormSet, ALREADY_VOTED_MSG
+from polls.pagination import keyset_page
+from polls.liveresults import publisher
 
 
 # Pagination for year-view: number of polls to show per page.
@@ -31,15 +41,16 @@ def edit_poll(request, poll_id=None):
 
     if request.method == "POST":
         poll_form = PollDetailForm(request.POST, instance=poll)
-        choices_formset = ChoiceFormSet(request.POST, request.FILES, instance=poll)
         if poll_form.is_valid():
             poll = poll_form.save(commit=False)
-            request.user.poll_set.add(poll)
-            choices_formset = ChoiceFormSet(request.POST, request.FILES, instance=poll)
-            if  choices_formset.is_valid():
+            poll.created_by = request.user
+        choices_formset = ChoiceFormSet(request.POST, request.FILES, instance=poll)
+        if poll_form.is_valid() and choices_formset.is_valid():
+            # The poll and all its choices, or nothing.
+            with transaction.atomic():
                 poll.save()
                 choices_formset.save()
-                return redirect('polls:voting', poll_id=poll.pk)
+            return redirect('polls:voting', poll_id=poll.pk)
         # Some form is not valid.
     else:
         poll_form = PollDetailForm(instance=poll)
@@ -57,15 +68,46 @@ class PollsIndex(ListView):
     template_name = "polls/index.html"
 
 
+def voting_poll(poll_id):
+    """The poll, with its creator, and its choices, in one query: the choices
+    are read with their poll joined. Only a poll without choices takes a
+    second query. Return (poll, choices), or raise Http404.
+
+    """
+    choices = list(Choice.objects.filter(poll_id=poll_id).select_related('poll__created_by'))
+    if not choices:
+        poll = get_object_or_404(Poll.objects.select_related('created_by'), pk=poll_id)
+        return poll, []
+    poll = choices[0].poll
+    for choice in choices:
+        choice.poll = poll
+    return poll, choices
+
+
+def voter_identity(request):
+    """Who votes: the user or, if anonymous, their session (started if it
+    wasn't).
+
+    """
+    if request.user.is_authenticated():
+        return "user:%s" % request.user.pk
+    if request.session.session_key is None:
+        request.session.save()
+    return "session:%s" % request.session.session_key
+
+
 class PollVoting(DetailView):
     context_object_name = 'poll'
     pk_url_kwarg = 'poll_id'
-    model = Poll
     template_name = "polls/poll_voting.html"
 
+    def get_object(self, queryset=None):
+        poll, self.choices = voting_poll(self.kwargs[self.pk_url_kwarg])
+        return poll
+
     def get_context_data(self, **kwargs):
         context = super(PollVoting, self).get_context_data(**kwargs)
-        context['voting_form'] = VoteForm(poll=self.get_object())
+        context['voting_form'] = VoteForm(poll=self.object, choices=self.choices)
         return context
 
 
@@ -73,13 +115,21 @@ class PollVote(FormView):
     template_name = 'polls/poll_voting.html'
 
     def get_form(self, form_class):
-        self.poll = get_object_or_404(Poll, pk=self.kwargs['poll_id'])
-        return VoteForm(self.request.POST, poll=self.poll)
+        self.poll, choices = voting_poll(self.kwargs['poll_id'])
+        return VoteForm(self.request.POST, poll=self.poll, choices=choices)
 
     def form_valid(self, form):
         choice = form.cleaned_data['choice']
-        choice.vote_me()
-        choice.save()
+        voter = None
+        if getattr(settings, 'POLLS_ONE_VOTE_PER_VOTER', False):
+            voter = Voter.key_of(voter_identity(self.request))
+        request_key = (self.request.META.get('HTTP_IDEMPOTENCY_KEY') or
+                       form.cleaned_data.get('idempotency_key') or None)
+        try:
+            choice.vote_once(voter=voter, request_key=request_key)
+        except AlreadyVoted:
+            form.add_error('choice', ALREADY_VOTED_MSG)
+            return self.form_invalid(form)
         return redirect('polls:results', poll_id=self.poll.pk)
 
     def form_invalid(self, form):
@@ -87,14 +137,127 @@ class PollVote(FormView):
         return render(self.request, 'polls/poll_voting.html', context)
 
 
+def results_cache():
+    """The cache of the results pages' fragments (settings.POLLS_RESULTS_CACHE,
+    an alias of settings.CACHES), or None if they are not cached.
+
+    With sharded votes the results change without bumping the poll's version
+    (until the shards are compacted), so they are not cached.
+
+    """
+    alias = getattr(settings, 'POLLS_RESULTS_CACHE', None)
+    if not alias or vote_shards() > 1:
+        return None
+    return caches[alias]
+
+
+def results_poll(request, poll_id):
+    """The poll of the results page, read once per request."""
+    if getattr(request, 'results_poll', None) is None:
+        request.results_poll = get_object_or_404(
+                Poll.objects.select_related('created_by'), pk=poll_id)
+    return request.results_poll
+
+
+def results_etag(request, poll_id):
+    # With sharded votes the version lags the votes: no conditional GETs
+    # (like results_cache).
+    if vote_shards() > 1:
+        return None
+    # The page shows the user (e.g. the edit link), not just the results.
+    user = getattr(request, 'user', None)
+    return "%s-%s-%s" % (poll_id, results_poll(request, poll_id).version,
+                         user.pk if user is not None and user.pk else 'anon')
+
+
+def results_last_modified(request, poll_id):
+    if vote_shards() > 1:
+        return None
+    return results_poll(request, poll_id).modified
+
+
 class PollResults(DetailView):
+    """The results of a poll.
+
+    The winners and the ranking are rendered once per poll's version, and
+    kept in the results_cache(), if any. Repeat viewers get a 304 (Not
+    Modified) until the poll changes.
+
+    """
     context_object_name = 'poll'
     pk_url_kwarg = 'poll_id'
-    model = Poll
     template_name = "polls/poll_results.html"
+    fragments = (
+            ('winners', "polls/poll_results_winners.html"),
+            ('ranking', "polls/poll_results_ranking.html"),
+        )
 
+    @method_decorator(vary_on_cookie)
+    @method_decorator(cache_control(private=True, max_age=0))
+    @method_decorator(condition(etag_func=results_etag,
+                                last_modified_func=results_last_modified))
+    def dispatch(self, *args, **kwargs):
+        return super(PollResults, self).dispatch(*args, **kwargs)
+
+    def get_object(self, queryset=None):
+        return results_poll(self.request, self.kwargs[self.pk_url_kwarg])
+
+    def get_context_data(self, **kwargs):
+        context = super(PollResults, self).get_context_data(**kwargs)
+        context['fragments'] = self.get_fragments(self.object)
+        context['live_results'] = getattr(settings, 'POLLS_LIVE_RESULTS', False)
+        return context
 
-class PollsArchiveView(ArchiveIndexView):
+    def get_fragments(self, poll):
+        """The rendered results fragments of the poll, by name."""
+        cache = results_cache()
+        # 'modified' too: a version number can come back if the DB is reset.
+        key = 'polls:results:%s:%s:%s' % (poll.pk, poll.version, poll.modified.isoformat())
+        fragments = cache.get(key) if cache is not None else None
+        if fragments is None:
+            context = {'poll': poll, 'results': poll.get_results()}
+            fragments = dict((name, render_to_string(template, context))
+                             for name, template in self.fragments)
+            if cache is not None:
+                cache.set(key, fragments)
+        return dict((name, mark_safe(html)) for name, html in fragments.items())
+
+
+def live_results(request, poll_id):
+    """The changes of the poll's results, pushed as server-sent events (see
+    polls.liveresults), for settings.POLLS_LIVE_RESULTS_MAX_SECONDS at most.
+
+    """
+    if not getattr(settings, 'POLLS_LIVE_RESULTS', False):
+        raise Http404(u"No live results.")
+    if not Poll.objects.filter(pk=poll_id).exists():
+        raise Http404(u"No such poll.")
+    duration = getattr(settings, 'POLLS_LIVE_RESULTS_MAX_SECONDS', 300)
+    response = StreamingHttpResponse(publisher.stream(int(poll_id), duration),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Not buffered by nginx.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class KeysetPaginationMixin(object):
+    """With settings.POLLS_KEYSET_PAGINATION, paginate the polls with
+    cursors (the 'cursor' GET parameter) instead of page numbers.
+
+    The page_obj is then a polls.pagination.KeysetPage, and there's no
+    paginator.
+
+    """
+    def paginate_queryset(self, queryset, page_size):
+        if not getattr(settings, 'POLLS_KEYSET_PAGINATION', False):
+            return super(KeysetPaginationMixin, self).paginate_queryset(queryset, page_size)
+        page = keyset_page(queryset, self.request.GET.get('cursor'), page_size,
+                           params=self.request.GET)
+        return (None, page, page.object_list, page.has_other_pages())
+
+
+class PollsArchiveView(KeysetPaginationMixin, ArchiveIndexView):
     queryset = Poll.objects.all()
     date_field = "pub_date"
     allow_future = True
@@ -102,7 +265,7 @@ class PollsArchiveView(ArchiveIndexView):
     paginate_by = NPOLLSINPAGE
 
 
-class PollsYearArchiveView(YearArchiveView):
+class PollsYearArchiveView(KeysetPaginationMixin, YearArchiveView):
     queryset = Poll.objects.all()
     date_field = "pub_date"
     make_object_list = True
@@ -121,43 +284,45 @@ class PollsYearArchiveView(YearArchiveView):
 
 
 class FactsView(ListView):
+    """Facts about all the polls, read from the PollStats snapshot."""
     template_name = "polls/facts.html"
     context_object_name = "facts_list"
 
     @method_decorator(permission_required('polls.can_view_stats', raise_exception=True))
     def dispatch(self, *args, **kwargs):
+        self.stats = PollStats.get()
         return super(FactsView, self).dispatch(*args, **kwargs)
 
     def poll_with_votes(self):
-        voted = Poll.objects.annotate(s=Sum('choice__votes')).filter(s__gt=0)
+        voted = Poll.objects.filter(total_votes__gt=0)
         return ("Polls with votes", voted)
 
     def poll_with_no_votes(self):
-        no_votes = Poll.objects.annotate(s=Sum('choice__votes')).filter(s=0)
+        no_votes = Poll.objects.filter(total_votes=0)
         return ("Polls with no votes", no_votes)
 
     def most_voted_choice(self):
-        the_choice = Choice.objects.order_by('-votes')[0]
-        return ("Poll with the most voted choice <small>(%s - %i votes)</small>"%(the_choice.choice, the_choice.votes), 
+        the_choice = self.stats.top_choice
+        return ("Poll with the most voted choice <small>(%s - %i votes)</small>"%(the_choice.choice, self.stats.top_choice_votes), 
                 [the_choice.poll]
             )
 
     def poll_with_more_votes(self, poll_set=Poll.objects.all()):
-        poll = Poll.objects.annotate(s=Sum('choice__votes')).order_by('-s')[0]
-        return ("Poll with more votes <small>(%i votes total)</small>"%poll.s, [poll])
+        poll = self.stats.top_poll
+        return ("Poll with more votes <small>(%i votes total)</small>"%self.stats.top_poll_votes, [poll])
 
     def avg_votes(self):
-        a = Choice.objects.aggregate(a=Avg('votes'))['a'] or 0.0
+        a = self.stats.avg_votes()
         return ("Average number of votes <small>(all the choices)</small>: %f"%a, [])
 
     def avg_votes_no_zero(self):
-        a = Choice.objects.filter(votes__gt=0).aggregate(a=Avg('votes'))['a'] or 0.0
+        a = self.stats.avg_votes_no_zero()
         return ("Average number of votes <small>(only voted choices)</small>: %f"%a, [])
 
     def useless(self):
         return ("Polls whose ID is greater (or equal) to the max number of votes in any choice, whose question starts with A and was published since 2012 ", 
                 Poll.objects.filter(
-                        pk__gte=Choice.objects.aggregate(m=Max('votes'))['m'], 
+                        pk__gte=self.stats.top_choice_votes, 
                         question__startswith='A', 
                         pub_date__gte="2012-01-01"
                     )
@@ -166,7 +331,7 @@ class FactsView(ListView):
     def get_queryset(self):
         t1, voted_polls = self.poll_with_votes()
         qs = []
-        if voted_polls:
+        if self.stats.votes and self.stats.top_choice and self.stats.top_poll:
             qs = [
                     (t1, voted_polls),
                     self.avg_votes(),
@@ -176,4 +341,8 @@ class FactsView(ListView):
                     self.useless(),
                 ]
         return qs
-        
\ No newline at end of file
+
+    def get_context_data(self, **kwargs):
+        context = super(FactsView, self).get_context_data(**kwargs)
+        context['stats'] = self.stats
+        return context
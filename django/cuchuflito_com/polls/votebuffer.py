@@ -0,0 +1,144 @@
+"""Write-behind buffer for the votes.
+
+With settings.POLLS_VOTE_WRITE_BEHIND = True, Choice.vote_me doesn't write
+the DB: the vote is counted in memory, and the buffer is flushed adding all
+the pending votes of each poll with a single UPDATE (see
+ChoiceManager.add_votes).
+
+The buffer is flushed when it holds settings.POLLS_VOTE_FLUSH_MAX votes, at
+most settings.POLLS_VOTE_FLUSH_MS milliseconds after its first pending vote,
+and when the process exits normally (atexit, e.g. a graceful restart of the
+web server).
+
+Durability: the buffer lives in the memory of each server process, so if a
+process crashes (or is killed with SIGKILL) its pending votes are lost. The
+loss is bounded by POLLS_VOTE_FLUSH_MAX votes and POLLS_VOTE_FLUSH_MS
+milliseconds of voting, per process. A vote shows up in the results only
+after it has been flushed.
+
+The log of the votes counted one by one (settings.POLLS_VOTE_EVENTS, see
+polls.models.VoteEvent) is buffered the same way, in event_buffer: the
+votes are counted right away, and logged in batches.
+
+"""
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer(object):
+    """Pending votes, by poll and choice, written by 'write(poll_id,
+    counts)' when flushed. Thread safe.
+
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.lock = threading.Lock()
+        self.pending = defaultdict(lambda: defaultdict(int))
+        self.size = 0
+        self.timer = None
+
+    def add(self, choice):
+        """Buffer a vote for the choice, flushing if the buffer is full.
+
+        Never raises: if the flush fails, the error is logged, and the votes
+        are flushed again later (see flush). Call it out of any transaction,
+        so the flush doesn't write the votes of others in it.
+
+        """
+        with self.lock:
+            self.pending[choice.poll_id][choice.pk] += 1
+            self.size += 1
+            full = self.size >= getattr(settings, 'POLLS_VOTE_FLUSH_MAX', 100)
+            if not full:
+                self.schedule()
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                # The vote is buffered: the request must not fail.
+                logger.exception("Flushing the %s failed.", self.write.__name__)
+
+    def schedule(self):
+        """Flush in POLLS_VOTE_FLUSH_MS, unless already scheduled. Call with
+        the lock held.
+
+        """
+        if self.timer is None:
+            delay = getattr(settings, 'POLLS_VOTE_FLUSH_MS', 500) / 1000.0
+            self.timer = threading.Timer(delay, self.timed_flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write the pending votes, with a write() per poll. Return the
+        number of votes written.
+
+        If the DB fails, the votes not written go back to the buffer, and
+        are flushed again in POLLS_VOTE_FLUSH_MS.
+
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, defaultdict(lambda: defaultdict(int))
+            self.size = 0
+        written = 0
+        try:
+            while pending:
+                poll_id, counts = pending.popitem()
+                try:
+                    self.write(poll_id, counts)
+                except Exception:
+                    pending[poll_id] = counts
+                    raise
+                written += sum(counts.values())
+        finally:
+            if pending:
+                self.restore(pending)
+        return written
+
+    def restore(self, pending):
+        with self.lock:
+            for poll_id, counts in pending.items():
+                for choice_id, n in counts.items():
+                    self.pending[poll_id][choice_id] += n
+                    self.size += n
+            if self.size:
+                self.schedule()
+
+    def timed_flush(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread has its own DB connection.
+            connection.close()
+
+
+def add_votes(poll_id, counts):
+    """Add the votes to the choices: one UPDATE."""
+    from polls.models import Choice
+    Choice.objects.add_votes(poll_id, counts)
+
+
+def log_votes(poll_id, counts):
+    """Log the votes of the choices not deleted meanwhile: one INSERT."""
+    from polls.models import Choice, VoteEvent
+    with transaction.atomic():
+        existing = Choice.objects.filter(poll_id=poll_id, pk__in=counts.keys())
+        VoteEvent.log(poll_id, dict((pk, counts[pk]) for pk in
+                                    existing.values_list('pk', flat=True)))
+
+
+vote_buffer = VoteBuffer(add_votes)
+atexit.register(vote_buffer.flush)
+event_buffer = VoteBuffer(log_votes)
+atexit.register(event_buffer.flush)
@@ -0,0 +1,80 @@
+"""Latency of the answers file's hit path in simpleHTTPServer.py
+
+Handles GETs of /answers.txt in this process, without sockets (as the
+async mode does, with asyncserver.BufferedRequestHandler), so the client
+doesn't count: a full response from the cache, a 304 to If-None-Match and
+to If-Modified-Since, the gzip variant, and a full response read from the
+disk (a cache that keeps nothing, as for the files bigger than
+MAX_CACHED_SIZE).
+
+	python answers_bench.py --size 100000
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from simpleHTTPServer import MySimpleHTTPRequestHandler, FileCache, ANSWERS_DATA_FILE
+from asyncserver import BufferedRequestHandler
+
+
+def raw_request(headers):
+	lines = ["GET /%s HTTP/1.1" % ANSWERS_DATA_FILE, "Host: localhost"]
+	lines += ["%s: %s" % item for item in headers.items()]
+	return "\r\n".join(lines) + "\r\n\r\n"
+
+
+def time_requests(raw, n):
+	"""Handle the raw request 'n' times. Return the microseconds per request
+	and the status line of the response.
+
+	"""
+	start = time.time()
+	for i in xrange(n):
+		handler = BufferedRequestHandler(raw, ('127.0.0.1', 0), None)
+	elapsed = time.time() - start
+	return elapsed / n * 1000000, handler.response().split("\r\n", 1)[0]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--size', type=int, default=100,
+			help="Bytes of the answers file.")
+	parser.add_argument('-n', '--requests', type=int, default=20000)
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp()
+	cwd = os.getcwd()
+	try:
+		os.chdir(directory)
+		with open(ANSWERS_DATA_FILE, 'wb') as f:
+			line = "first name = Load\nlast name = Generator\nemail = load@example.com\n"
+			f.write((line * (args.size // len(line) + 1))[:args.size])
+		MySimpleHTTPRequestHandler.log_message = lambda self, *args: None
+		MySimpleHTTPRequestHandler.answers_cache = FileCache()
+		cached = MySimpleHTTPRequestHandler.answers_cache.get(ANSWERS_DATA_FILE)
+		runs = [
+				("cached", {}),
+				("If-None-Match (304)", {'If-None-Match': cached.etag}),
+				("If-Modified-Since (304)", {'If-Modified-Since': cached.last_modified}),
+				("cached, gzip", {'Accept-Encoding': 'gzip'}),
+				("from the disk", None),
+			]
+		print "%i bytes (%s gzipped)" % (cached.size,
+				len(cached.gzip_body) if cached.gzip_body is not None else "not")
+		for name, headers in runs:
+			if headers is None:
+				MySimpleHTTPRequestHandler.answers_cache = FileCache(max_size=-1)
+				headers = {}
+			us, status = time_requests(raw_request(headers), args.requests)
+			print "%-26s %8.1f us/request (%s)" % (name, us, status)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main()
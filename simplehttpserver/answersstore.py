@@ -0,0 +1,300 @@
+"""Append-only store of the answers (the submissions of the questions form)
+
+Each submission is a line of JSON with its number "n" (1, 2, ...), appended
+to the current segment of the store's directory: a file named after the
+first submission in it (answers-000000000001.jsonl). When the segment
+reaches 'segment_size' bytes, the next submission starts a new one.
+
+Group commit: the submissions that arrive while a commit is being written
+and fsynced wait for it to finish, and are written and fsynced together in
+the next one. fsync is paid per batch, not per submission, and append()
+returns only when its submission is on disk.
+
+An index in memory has the offset of each submission in its segment, so
+get(n) reads just its line. It is built when the store is opened (cutting a
+line left half written by a crash), and kept up to date with the
+submissions of the other processes that share the directory (e.g. the
+prefork workers): appends are serialized with an flock on the "lock" file.
+
+Compaction merges the small segments (e.g. after lowering segment_size, or
+after many crashes): run it with the server stopped,
+
+	python answersstore.py compact answers/
+
+"""
+
+import bisect
+import errno
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+SEGMENT_PREFIX = "answers-"
+SEGMENT_SUFFIX = ".jsonl"
+SEGMENT_SIZE = 64 * 2 ** 20 # Bytes.
+
+
+def segment_name(first):
+	return "%s%012i%s" % (SEGMENT_PREFIX, first, SEGMENT_SUFFIX)
+
+
+def fsync_directory(directory):
+	"""Make the creation (or renaming) of files in the directory durable."""
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+class AnswersStore(object):
+	"""The submissions, numbered from 1. Thread and process safe.
+
+	'latest_file', if given, is replaced after each commit by the last
+	submission, formatted with 'format_record'.
+
+	"""
+	def __init__(self, directory, segment_size=SEGMENT_SIZE, commit_delay=0,
+			latest_file=None, format_record=None):
+		self.directory = directory
+		self.segment_size = segment_size
+		self.commit_delay = commit_delay
+		self.latest_file = latest_file
+		self.format_record = format_record or json.dumps
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.lock = threading.Condition()
+		self.pending = []
+		self.committing = False
+		self.index_lock = threading.Lock()
+		self.segments = [] # First submission of each segment.
+		self.offsets = array('l', [0]) # By submission number.
+		self.lengths = array('l', [0])
+		self.current = None # The last segment,
+		self.end = 0 # and its bytes indexed.
+		self.pid = None
+		with self.index_lock:
+			with self.file_lock():
+				self.catch_up()
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def path(self, first):
+		return os.path.join(self.directory, segment_name(first))
+
+	@contextmanager
+	def file_lock(self):
+		"""Hold the lock of the directory (among processes)."""
+		if self.pid != os.getpid():
+			# Opened after a fork: an flock is shared with the parent's file.
+			self.pid = os.getpid()
+			self.lock_file = open(os.path.join(self.directory, "lock"), "a")
+			self.segment_file = None
+		fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+	def segment_files(self):
+		"""The first submission of each segment in the directory, sorted."""
+		return sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+				for name in os.listdir(self.directory)
+				if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+	def catch_up(self):
+		"""Index the submissions appended since the last time, by any
+		process. Must hold the index_lock and the file_lock.
+
+		"""
+		for first in self.segment_files():
+			if self.current is not None and first < self.current:
+				continue
+			if first != self.current:
+				self.current, self.end = first, 0
+			self.index_segment(first)
+
+	def index_segment(self, first):
+		f = open(self.path(first), 'rb+')
+		try:
+			f.seek(self.end)
+			offset = self.end
+			for line in iter(f.readline, ''):
+				if not line.endswith("\n"):
+					# Half written (the writers hold the lock): a crash.
+					f.truncate(offset)
+					break
+				n = json.loads(line)["n"]
+				if n == len(self.offsets):
+					if not self.segments or self.segments[-1] != first:
+						self.segments.append(first)
+					self.offsets.append(offset)
+					self.lengths.append(len(line))
+				elif n > len(self.offsets):
+					raise IOError("Submission %i missing in %s" % (len(self.offsets), f.name))
+				# n < expected: a copy left by an interrupted compaction.
+				offset += len(line)
+			self.end = offset
+		finally:
+			f.close()
+
+	def append(self, record):
+		"""Append the record (a dict) and wait until it is on disk. Return
+		its number.
+
+		"""
+		slot = {}
+		with self.lock:
+			self.pending.append((record, slot))
+			while not slot:
+				if self.committing:
+					self.lock.wait()
+					continue
+				self.committing = True
+				if self.commit_delay:
+					# Let more submissions join this commit.
+					self.lock.wait(self.commit_delay)
+				batch, self.pending = self.pending, []
+				self.lock.release()
+				try:
+					self.commit(batch)
+				finally:
+					self.lock.acquire()
+					self.committing = False
+					self.lock.notify_all()
+		if 'error' in slot:
+			raise slot['error']
+		return slot['n']
+
+	def commit(self, batch):
+		"""Write the batch of (record, slot), fsync it, and put the number
+		of each record (or the error) in its slot.
+
+		"""
+		try:
+			with self.index_lock:
+				with self.file_lock():
+					self.catch_up()
+					numbers = self.write(batch)
+		except Exception, e:
+			for record, slot in batch:
+				slot['error'] = e
+			return
+		for (record, slot), n in zip(batch, numbers):
+			slot['n'] = n
+		if self.latest_file is not None:
+			self.write_latest(batch[-1][0], numbers[-1])
+
+	def write(self, batch):
+		n = len(self.offsets)
+		if self.current is None or self.end >= self.segment_size:
+			self.current, self.end = n, 0
+			open(self.path(n), 'ab').close()
+			fsync_directory(self.directory)
+		if not self.segments or self.segments[-1] != self.current:
+			self.segments.append(self.current)
+		if self.segment_file is None or self.segment_file_first != self.current:
+			if self.segment_file is not None:
+				self.segment_file.close()
+			self.segment_file = open(self.path(self.current), 'ab')
+			self.segment_file_first = self.current
+		lines = []
+		for i, (record, slot) in enumerate(batch):
+			lines.append(json.dumps(dict(record, n=n + i), sort_keys=True) + "\n")
+		self.segment_file.write("".join(lines))
+		self.segment_file.flush()
+		os.fsync(self.segment_file.fileno())
+		offset = self.end
+		for line in lines:
+			self.offsets.append(offset)
+			self.lengths.append(len(line))
+			offset += len(line)
+		self.end = offset
+		return range(n, n + len(batch))
+
+	def write_latest(self, record, n):
+		"""Replace the latest_file (atomically, so readers never see half of
+		it), unless a later submission, of any process, got there first.
+
+		"""
+		with self.index_lock:
+			with self.file_lock():
+				self.catch_up()
+				if n < len(self):
+					return
+				tmp = "%s.%i.tmp" % (self.latest_file, os.getpid())
+				with open(tmp, 'wb') as f:
+					f.write(self.format_record(record))
+				os.rename(tmp, self.latest_file)
+
+	def get(self, n):
+		"""The submission number n (a dict), or None."""
+		if n >= len(self.offsets):
+			with self.index_lock:
+				with self.file_lock():
+					self.catch_up()
+		if n < 1 or n >= len(self.offsets):
+			return None
+		first = self.segments[bisect.bisect_right(self.segments, n) - 1]
+		with open(self.path(first), 'rb') as f:
+			f.seek(self.offsets[n])
+			return json.loads(f.read(self.lengths[n]))
+
+
+def compact(directory, segment_size=SEGMENT_SIZE):
+	"""Merge the consecutive segments that fit together in 'segment_size'
+	bytes. The server must be stopped.
+
+	Each merged segment is written to a new file and renamed over the first
+	one, and then the rest are removed: if interrupted, the copies left are
+	skipped when indexing.
+
+	"""
+	store = AnswersStore(directory, segment_size)
+	for first in set(store.segment_files()) - set(store.segments):
+		# Just copies, left by an interrupted compaction.
+		os.remove(store.path(first))
+	groups = []
+	for first in store.segments:
+		size = os.path.getsize(store.path(first))
+		if groups and groups[-1][1] + size <= segment_size:
+			groups[-1][0].append(first)
+			groups[-1][1] += size
+		else:
+			groups.append([[first], size])
+	for firsts, size in groups:
+		if len(firsts) == 1:
+			continue
+		tmp = store.path(firsts[0]) + ".tmp"
+		with open(tmp, 'wb') as out:
+			for first in firsts:
+				with open(store.path(first), 'rb') as f:
+					for chunk in iter(lambda: f.read(2 ** 20), ''):
+						out.write(chunk)
+			out.flush()
+			os.fsync(out.fileno())
+		os.rename(tmp, store.path(firsts[0]))
+		fsync_directory(directory)
+		for first in firsts[1:]:
+			os.remove(store.path(first))
+		print "merged %i segments from %i" % (len(firsts), firsts[0])
+	fsync_directory(directory)
+
+
+def main():
+	if len(sys.argv) != 3 or sys.argv[1] not in ('compact', 'check'):
+		raise SystemExit("usage: python answersstore.py compact|check DIRECTORY")
+	if sys.argv[1] == 'compact':
+		compact(sys.argv[2])
+	store = AnswersStore(sys.argv[2])
+	print "%i submissions in %i segments" % (len(store), len(store.segments))
+
+
+if __name__ == "__main__":
+	main()
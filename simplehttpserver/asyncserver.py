@@ -0,0 +1,419 @@
+"""Event loop backend for simpleHTTPServer.py (--mode async)
+
+A single thread holds all the connections, reading each request until it
+is complete. The connections are asyncore dispatchers, but the event loop is
+not asyncore.loop(), which asks every connection what it waits for on every
+iteration: they are kept registered in an epoll (or poll) object, with no
+limit of 1024 sockets as with select(), and updated only when they had some
+activity. Then the request is handled by MySimpleHTTPRequestHandler, over
+strings instead of the socket, in a pool of worker threads: the handler
+reads and writes files, and that must not block the event loop. The
+response goes back to the event loop, which sends it.
+
+Idle connections cost a socket and a buffer, not a thread: one process can
+hold thousands of them (see --idle-connections in loadgen.py). They are
+closed after MySimpleHTTPRequestHandler.timeout seconds (checked every
+second).
+
+"""
+
+import Queue
+import StringIO
+import asynchat
+import asyncore
+import collections
+import errno
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from simpleHTTPServer import MySimpleHTTPRequestHandler, DEFAULT_WORKERS, LISTEN_BACKLOG, \
+		FILE_CHUNK_SIZE
+
+MAX_HEADERS_SIZE = 65536 # Bytes of the request line and the headers.
+
+
+def content_length(headers):
+	"""The Content-Length in the raw 'headers', or 0."""
+	for line in headers.split("\r\n")[1:]:
+		name, _, value = line.partition(":")
+		if name.strip().lower() == "content-length":
+			try:
+				return max(int(value), 0)
+			except ValueError:
+				return 0
+	return 0
+
+
+class FileProducer(object):
+	"""Produces 'length' bytes of a file from 'offset', in chunks, for
+	asynchat: the file is read as the client takes it.
+
+	"""
+	def __init__(self, data_file, offset, length):
+		# A file of its own: the handler closes the one it sends.
+		self.data_file = os.fdopen(os.dup(data_file.fileno()), 'rb')
+		self.offset = offset
+		self.length = length
+
+	def more(self):
+		chunk = ""
+		if self.length > 0:
+			self.data_file.seek(self.offset)
+			chunk = self.data_file.read(min(FILE_CHUNK_SIZE, self.length))
+			self.offset += len(chunk)
+			self.length -= len(chunk)
+		if not chunk:
+			self.data_file.close()
+		return chunk
+
+
+class BufferedRequestHandler(MySimpleHTTPRequestHandler):
+	"""MySimpleHTTPRequestHandler reading a whole request from a string,
+	and writing the response to a buffer (but for the files, which are
+	sent by a FileProducer).
+
+	"""
+	def __init__(self, raw_request, client_address, server, requests_served=0):
+		self.raw_request = raw_request
+		self.requests_served = requests_served
+		self.producer = None
+		MySimpleHTTPRequestHandler.__init__(self, None, client_address, server)
+
+	def setup(self):
+		self.rfile = StringIO.StringIO(self.raw_request)
+		self.wfile = StringIO.StringIO()
+
+	def handle(self):
+		# Just one request: the connection is kept by the event loop.
+		self.close_connection = 1
+		self.handle_one_request()
+
+	def finish(self):
+		pass
+
+	def send_file(self, data_file, offset, length):
+		if length <= FILE_CHUNK_SIZE:
+			# Small: read it here, in the worker, and send it with the headers.
+			self.write_file(data_file, offset, length)
+		else:
+			self.producer = FileProducer(data_file, offset, length)
+
+	def response(self):
+		return self.wfile.getvalue()
+
+
+class HTTPChannel(asynchat.async_chat):
+	"""A client connection. Its requests are handled one after the other,
+	so the responses of pipelined requests go out in order.
+
+	"""
+	ac_out_buffer_size = FILE_CHUNK_SIZE
+	def __init__(self, sock, client_address, server):
+		asynchat.async_chat.__init__(self, sock, map=server.map)
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.client_address = client_address
+		self.server = server
+		self.data = []
+		self.size = 0
+		self.reading_body = False
+		self.discarding = False
+		self.requests = collections.deque()
+		self.busy = False
+		self.requests_served = 0
+		self.last_activity = time.time()
+		self.set_terminator("\r\n\r\n")
+
+	def collect_incoming_data(self, data):
+		self.last_activity = time.time()
+		if self.discarding:
+			return
+		self.data.append(data)
+		self.size += len(data)
+		if not self.reading_body and self.size > MAX_HEADERS_SIZE:
+			self.close()
+
+	def found_terminator(self):
+		request = "".join(self.data)
+		self.data = []
+		self.size = 0
+		if not self.reading_body:
+			request += "\r\n\r\n"
+			length = content_length(request)
+			if length > MySimpleHTTPRequestHandler.max_body_size:
+				# Refused (with a 413) without reading the body: the rest
+				# of the connection is dropped, and then it's closed.
+				self.discarding = True
+				self.set_terminator(None)
+				self.requests.append(request)
+				self.next_request()
+				return
+			if length:
+				self.reading_body = True
+				self.body_started = time.time()
+				self.data = [request]
+				self.set_terminator(length)
+				return
+		self.reading_body = False
+		self.set_terminator("\r\n\r\n")
+		self.requests.append(request)
+		self.next_request()
+
+	def next_request(self):
+		if not self.busy and self.requests and self.connected:
+			self.busy = True
+			self.server.submit(self, self.requests.popleft(), self.requests_served)
+
+	def request_done(self, response, producer, close):
+		"""Send the response (called in the event loop)."""
+		self.busy = False
+		self.requests_served += 1
+		self.last_activity = time.time()
+		if not self.connected:
+			if producer is not None:
+				producer.data_file.close()
+			return
+		self.push(response)
+		if producer is not None:
+			self.push_with_producer(producer)
+		if close or self.discarding:
+			self.requests.clear()
+			self.close_when_done()
+		else:
+			self.next_request()
+
+	def timed_out(self, now):
+		"""Waiting for the client (not for the server) for too long: idle,
+		or sending a body for longer than the handler's body_timeout.
+
+		"""
+		if self.reading_body and now - self.body_started > MySimpleHTTPRequestHandler.body_timeout:
+			return True
+		return (not (self.busy or self.requests or self.producer_fifo)
+				and now - self.last_activity > MySimpleHTTPRequestHandler.timeout)
+
+	def idle(self):
+		"""No request in flight: neither coming, nor handled, nor going."""
+		return not (self.data or self.busy or self.requests or self.producer_fifo)
+
+	def handle_error(self):
+		self.server.handle_error()
+		self.close()
+
+	def close(self):
+		self.server.unwatch(self)
+		asynchat.async_chat.close(self)
+
+
+class Waker(asyncore.file_dispatcher):
+	"""A pipe to wake up the event loop from other threads."""
+
+	def __init__(self, map):
+		self.read_fd, self.write_fd = os.pipe()
+		asyncore.file_dispatcher.__init__(self, self.read_fd, map=map)
+		os.close(self.read_fd) # file_dispatcher keeps a dup.
+
+	def wake(self):
+		try:
+			os.write(self.write_fd, "x")
+		except OSError:
+			pass
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		try:
+			self.recv(4096)
+		except socket.error:
+			pass
+
+
+class Poller(object):
+	"""select.epoll if there is one (Linux), whose cost doesn't grow with
+	the idle connections, or select.poll. Both take the POLL* events
+	(EPOLL* have the same values).
+
+	"""
+	def __init__(self):
+		self.epoll = getattr(select, 'epoll', None)
+		self.poller = self.epoll() if self.epoll else select.poll()
+		self.fds = set()
+
+	def register(self, fd, events):
+		if self.epoll and fd in self.fds:
+			self.poller.modify(fd, events)
+		else:
+			self.poller.register(fd, events)
+		self.fds.add(fd)
+
+	def unregister(self, fd):
+		self.poller.unregister(fd)
+		self.fds.discard(fd)
+
+	def poll(self, timeout):
+		"""Wait up to 'timeout' seconds. Return [(fd, events)]."""
+		try:
+			if self.epoll:
+				return self.poller.poll(timeout)
+			return self.poller.poll(timeout * 1000)
+		except (select.error, IOError), e:
+			if e.args[0] != errno.EINTR:
+				raise
+			return []
+
+
+class AsyncServer(asyncore.dispatcher):
+	"""The listening socket, the event loop and the workers."""
+
+	def __init__(self, server_address, workers=DEFAULT_WORKERS):
+		self.map = {}
+		asyncore.dispatcher.__init__(self, map=self.map)
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind(server_address)
+		self.listen(LISTEN_BACKLOG)
+		self.channels = set()
+		self.last_sweep = time.time()
+		self.jobs = Queue.Queue()
+		self.done = Queue.Queue()
+		self.poller = Poller()
+		self.events = {} # The events each fd is registered for.
+		self.waker = Waker(self.map)
+		self.watch(self)
+		self.watch(self.waker)
+		self.workers = []
+		for i in range(workers):
+			t = threading.Thread(target=self.work)
+			t.daemon = True
+			t.start()
+			self.workers.append(t)
+
+	def handle_accept(self):
+		try:
+			pair = self.accept()
+		except socket.error:
+			return
+		if pair is not None:
+			sock, client_address = pair
+			channel = HTTPChannel(sock, client_address, self)
+			self.channels.add(channel)
+			self.watch(channel)
+
+	def submit(self, channel, raw_request, requests_served):
+		self.jobs.put((channel, raw_request, requests_served))
+
+	def work(self):
+		"""Worker thread: handle the requests, out of the event loop."""
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				break
+			channel, raw_request, requests_served = job
+			try:
+				handler = BufferedRequestHandler(raw_request, channel.client_address, self,
+						requests_served)
+				self.done.put((channel, handler.response(), handler.producer,
+						handler.close_connection))
+			except Exception:
+				self.handle_error()
+				self.done.put((channel, "", None, True))
+			self.waker.wake()
+
+	def send_responses(self):
+		while True:
+			try:
+				channel, response, producer, close = self.done.get_nowait()
+			except Queue.Empty:
+				return
+			channel.request_done(response, producer, close)
+			self.watch(channel)
+
+	def watch(self, dispatcher):
+		"""Register (or update) the events the dispatcher waits for."""
+		fd = dispatcher._fileno
+		if fd is None:
+			return
+		events = 0
+		if dispatcher.readable():
+			events |= select.POLLIN | select.POLLPRI
+		if dispatcher.writable() and not dispatcher.accepting:
+			events |= select.POLLOUT
+		if self.events.get(fd) != events:
+			self.poller.register(fd, events)
+			self.events[fd] = events
+
+	def unwatch(self, dispatcher):
+		fd = dispatcher._fileno
+		if fd in self.events:
+			self.poller.unregister(fd)
+			del self.events[fd]
+		self.channels.discard(dispatcher)
+
+	def serve(self, drain_timeout, stopping):
+		"""Run the event loop until 'stopping' has something, then stop
+		accepting and wait up to 'drain_timeout' seconds for the requests in
+		flight.
+
+		"""
+		while not stopping:
+			self.loop_once()
+		print 'shutting down the web server (pid %i)' % os.getpid()
+		self.unwatch(self)
+		self.close()
+		deadline = time.time() + drain_timeout
+		while time.time() < deadline and not self.drained():
+			self.loop_once(0.05)
+		for t in self.workers:
+			self.jobs.put(None)
+		for t in self.workers:
+			t.join(1)
+		asyncore.close_all(self.map)
+
+	def loop_once(self, timeout=0.2):
+		for fd, events in self.poller.poll(timeout):
+			dispatcher = self.map.get(fd)
+			if dispatcher is None:
+				continue
+			asyncore.readwrite(dispatcher, events)
+			self.watch(dispatcher)
+		self.send_responses()
+		now = time.time()
+		if now - self.last_sweep > 1:
+			self.last_sweep = now
+			for channel in list(self.channels):
+				if channel.timed_out(now):
+					channel.close()
+
+	def drained(self):
+		return all(c.idle() for c in self.channels)
+
+	def handle_error(self):
+		# Log it, but keep listening (asyncore would close the server).
+		traceback.print_exc()
+
+
+def raise_open_files_limit():
+	"""Allow as many connections as the system lets this process have."""
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ImportError, ValueError):
+		pass
+
+
+def serve(server_address, workers, drain_timeout):
+	"""Serve with the event loop until a SIGINT or SIGTERM."""
+	raise_open_files_limit()
+	server = AsyncServer(server_address, workers=workers)
+	stopping = []
+	def handler(signum, frame):
+		stopping.append(signum)
+	signal.signal(signal.SIGINT, handler)
+	signal.signal(signal.SIGTERM, handler)
+	server.serve(drain_timeout, stopping)
@@ -0,0 +1,106 @@
+"""Check that simpleHTTPServer.py serves big files with flat memory.
+
+Serves a sparse answers file (and a static file) of --size-gb gigabytes in
+each of the --modes, downloads them, asks for a Range at their end, and
+reports the throughput and the peak memory (VmHWM) of the server process.
+Exits with an error if a response is wrong or the memory grew with the file.
+The responses themselves are tested by BigFileTest, in test_simpleHTTPServer.py.
+
+	python bigfile_check.py --size-gb 4
+
+"""
+
+import argparse
+import httplib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from loadgen import start_server
+
+MAX_PEAK_MB = 100 # Way below the size of the file.
+
+
+def peak_memory_mb(pid):
+	"""Peak resident memory of the process, from /proc (Linux), or None."""
+	try:
+		for line in open('/proc/%i/status' % pid):
+			if line.startswith('VmHWM:'):
+				return int(line.split()[1]) / 1024.0
+	except IOError:
+		return None
+
+
+def download(port, path, headers={}):
+	"""GET the path, reading and dropping the body. Return (response, bytes)."""
+	conn = httplib.HTTPConnection('localhost', port, timeout=60)
+	conn.request('GET', path, headers=headers)
+	response = conn.getresponse()
+	received = 0
+	while True:
+		chunk = response.read(1024 * 1024)
+		if not chunk:
+			break
+		received += len(chunk)
+	conn.close()
+	return response, received
+
+
+def check_mode(mode, port, size, directory):
+	"""Return a list of the problems found in 'mode'."""
+	problems = []
+	server = start_server(mode, port, 4, cwd=directory)
+	try:
+		for path in ('/answers.txt', '/big.bin'):
+			start = time.time()
+			response, received = download(port, path)
+			elapsed = time.time() - start
+			if response.status != 200 or received != size:
+				problems.append("%s: %s, %i bytes" % (path, response.status, received))
+			print "%-8s %-13s %6.0f MB/s" % (mode, path, size / elapsed / 2 ** 20)
+		response, received = download(port, '/answers.txt', {'Range': 'bytes=-10'})
+		expected = "bytes %i-%i/%i" % (size - 10, size - 1, size)
+		if (response.status, received, response.getheader('Content-Range')) != (206, 10, expected):
+			problems.append("Range: %s, %i bytes, %s" % (
+					response.status, received, response.getheader('Content-Range')))
+		response, received = download(port, '/answers.txt', {'Range': 'bytes=%i-' % size})
+		if response.status != 416:
+			problems.append("Range past the end: %s" % response.status)
+		peak = peak_memory_mb(server.pid)
+		if peak is not None:
+			print "%-8s peak memory %.1f MB" % (mode, peak)
+			if peak > MAX_PEAK_MB:
+				problems.append("peak memory of %.1f MB" % peak)
+	finally:
+		server.terminate()
+		server.wait()
+	return ["%s: %s" % (mode, p) for p in problems]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--size-gb', type=float, default=2)
+	parser.add_argument('--modes', default='single,thread,async')
+	parser.add_argument('--port', type=int, default=8001)
+	args = parser.parse_args()
+
+	size = int(args.size_gb * 2 ** 30)
+	directory = tempfile.mkdtemp()
+	try:
+		for name in ('answers.txt', 'big.bin'):
+			with open(os.path.join(directory, name), 'wb') as f:
+				f.truncate(size) # Sparse: takes no disk.
+		problems = []
+		for mode in args.modes.split(','):
+			problems += check_mode(mode, args.port, size, directory)
+	finally:
+		shutil.rmtree(directory)
+	for p in problems:
+		print "FAILED", p
+	sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+	main()
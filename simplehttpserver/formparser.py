@@ -0,0 +1,197 @@
+"""Streaming parser of the forms' bodies (the POSTs to /save)
+
+The body is read from the socket in chunks, never past its Content-Length,
+and parsed as it arrives. The parsing stops as soon as all the wanted fields
+are there: the rest of the body is not read, so the connection can't be
+reused for another request (see 'unread'). Both encodings of HTML forms are
+parsed incrementally:
+
+- application/x-www-form-urlencoded: name=value&name=value...
+- multipart/form-data (RFC 7578): the parts of the other fields (e.g.
+  files) are skipped as they are read, without keeping them.
+
+The first value of each field counts, as cgi.FieldStorage.getfirst(). A body
+bigger than 'max_size' is refused before reading it, and one that takes
+longer than 'timeout' seconds to arrive is cut.
+
+"""
+
+import StringIO
+import cgi
+import re
+import time
+import urllib
+
+CHUNK_SIZE = 8192 # Bytes per read.
+MAX_PART_HEADERS_SIZE = 8192 # Bytes of the headers of a multipart part.
+URLENCODED_SEPARATOR_RE = re.compile(r'[&;]')
+
+
+class FormError(Exception):
+	"""A body that can't be parsed. 'status' is the HTTP status code to
+	answer it with.
+
+	"""
+	def __init__(self, status, message):
+		Exception.__init__(self, message)
+		self.status = status
+
+
+def read_some(rfile, n):
+	"""Read from 1 to 'n' bytes from 'rfile' ('' at its end). From the file
+	of a socket, with one recv() at most: rfile.read(n) would wait for the
+	'n' bytes, as long as a slow client keeps sending them.
+
+	"""
+	rbuf = getattr(rfile, '_rbuf', None)
+	sock = getattr(rfile, '_sock', None)
+	if rbuf is None or sock is None:
+		return rfile.read(n)
+	buffered = rbuf.getvalue()
+	if not buffered:
+		return sock.recv(n)
+	# What was buffered with the headers (as socket._fileobject.read()).
+	rfile._rbuf = StringIO.StringIO()
+	rfile._rbuf.write(buffered[n:])
+	return buffered[:n]
+
+
+class BodyReader(object):
+	"""Reads 'length' bytes from 'rfile', buffering them."""
+
+	def __init__(self, rfile, length, timeout=None):
+		self.rfile = rfile
+		self.unread = length
+		self.buf = ""
+		self.deadline = time.time() + timeout if timeout is not None else None
+
+	def fill(self):
+		"""Read a chunk more into buf. Return False at the end of the body."""
+		if self.unread == 0:
+			return False
+		if self.deadline is not None and time.time() > self.deadline:
+			raise FormError(408, "The form took too long to arrive")
+		chunk = read_some(self.rfile, min(CHUNK_SIZE, self.unread))
+		if not chunk:
+			raise FormError(400, "The form is shorter than its Content-Length")
+		self.unread -= len(chunk)
+		self.buf += chunk
+		return True
+
+	def read(self):
+		"""Return (and consume) the buffer and a chunk more, or '' at the
+		end of the body.
+
+		"""
+		if not self.buf:
+			self.fill()
+		data, self.buf = self.buf, ""
+		return data
+
+	def until(self, separator, keep=True, max_size=None):
+		"""Consume the body up to 'separator' (consumed too). Return what
+		was before it, or '' if not 'keep' (it's not kept in memory).
+
+		"""
+		parts = []
+		size = 0
+		while True:
+			i = self.buf.find(separator)
+			if i >= 0:
+				if keep:
+					parts.append(self.buf[:i])
+				self.buf = self.buf[i + len(separator):]
+				return "".join(parts)
+			# The separator may begin at the end of the buffer.
+			cut = max(len(self.buf) - len(separator) + 1, 0)
+			if keep:
+				parts.append(self.buf[:cut])
+			size += cut
+			self.buf = self.buf[cut:]
+			if max_size is not None and size > max_size:
+				raise FormError(400, "Too long a multipart header")
+			if not self.fill():
+				raise FormError(400, "The multipart form is truncated")
+
+	def peek(self, n):
+		"""The next 'n' bytes (or fewer, at the end of the body)."""
+		while len(self.buf) < n and self.fill():
+			pass
+		return self.buf[:n]
+
+
+def parse_form(rfile, content_type, content_length, fields, max_size, timeout=None):
+	"""Read the form's body from 'rfile', with the values of the request's
+	Content-Type and Content-Length headers (None if missing), until the
+	values of the 'fields' are found.
+
+	Return (a dict with the value of each of the fields found, the bytes of
+	the body left unread). Raise FormError.
+
+	"""
+	if content_length is None:
+		raise FormError(411, "The form needs a Content-Length")
+	try:
+		length = int(content_length)
+	except ValueError:
+		length = -1
+	if length < 0:
+		raise FormError(400, "Bad Content-Length: %r" % content_length)
+	if length > max_size:
+		raise FormError(413, "The form is bigger than %i bytes" % max_size)
+	ctype, params = cgi.parse_header(content_type or "")
+	reader = BodyReader(rfile, length, timeout)
+	if ctype == "application/x-www-form-urlencoded":
+		found = parse_urlencoded(reader, fields)
+	elif ctype == "multipart/form-data":
+		boundary = params.get("boundary")
+		if not boundary or len(boundary) > 70:
+			raise FormError(400, "Bad multipart boundary: %r" % boundary)
+		found = parse_multipart(reader, boundary, fields)
+	else:
+		raise FormError(415, "Unsupported form encoding: %r" % ctype)
+	return found, reader.unread
+
+
+def parse_urlencoded(reader, fields):
+	found = {}
+	tail = ""
+	while len(found) < len(fields):
+		chunk = reader.read()
+		pairs = URLENCODED_SEPARATOR_RE.split(tail + chunk)
+		# The last one may go on in the next chunk (but for the last chunk).
+		tail = pairs.pop() if chunk else ""
+		for pair in pairs:
+			name, equals, value = pair.partition("=")
+			if not (equals and value):
+				# Skipped by cgi.FieldStorage too.
+				continue
+			name = urllib.unquote_plus(name)
+			if name in fields and name not in found:
+				found[name] = urllib.unquote_plus(value)
+		if not chunk:
+			break
+	return found
+
+
+def parse_multipart(reader, boundary, fields):
+	found = {}
+	delimiter = "\r\n--" + boundary
+	# The preamble, up to the first delimiter (maybe at the very beginning).
+	reader.buf = "\r\n" + reader.buf
+	reader.until(delimiter, keep=False)
+	while len(found) < len(fields):
+		if reader.peek(2) != "\r\n":
+			# "--": the last one (or a malformed body).
+			break
+		headers = reader.until("\r\n\r\n", max_size=MAX_PART_HEADERS_SIZE)
+		name = None
+		for line in headers.split("\r\n"):
+			header, _, value = line.partition(":")
+			if header.strip().lower() == "content-disposition":
+				name = cgi.parse_header(value.strip())[1].get("name")
+		wanted = name in fields and name not in found
+		value = reader.until(delimiter, keep=wanted)
+		if wanted:
+			found[name] = value
+	return found
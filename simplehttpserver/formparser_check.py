@@ -0,0 +1,158 @@
+"""Fuzzing and benchmark of formparser.py against cgi.FieldStorage
+
+Fuzzing: random urlencoded and multipart forms (duplicated, empty, unknown
+and file fields, escapes, CRLFs and dashes in the values, preambles...),
+read in random short reads, must give the same fields as cgi.FieldStorage;
+and mangled bodies (cut, with bytes changed) must give some fields or a
+FormError, nothing else.
+
+Benchmark: the time to parse the questions form, and forms with a big file
+part, before or after the fields.
+
+	python formparser_check.py --forms 20000
+
+"""
+
+import argparse
+import cgi
+import random
+import StringIO
+import time
+import urllib
+
+from formparser import FormError, parse_form
+
+FIELDS = ["firstname", "lastname", "email"]
+NAMES = FIELDS + ["other", "firstname2", "x"]
+MAX_SIZE = 1 << 30
+
+
+class ShortReader(object):
+	"""A file whose reads return random amounts of bytes (at least one)."""
+
+	def __init__(self, data, rnd):
+		self.data = data
+		self.pos = 0
+		self.rnd = rnd
+
+	def read(self, n):
+		n = self.rnd.randint(1, max(n, 1))
+		chunk = self.data[self.pos:self.pos + n]
+		self.pos += len(chunk)
+		return chunk
+
+
+def random_value(rnd):
+	alphabet = "abcXYZ019 &=+%;-_.@\r\n\xc3\xa9\x00"
+	if rnd.random() < 0.1:
+		return ""
+	return "".join(rnd.choice(alphabet) for i in range(rnd.randint(1, 20)))
+
+
+def random_fields(rnd):
+	return [(rnd.choice(NAMES), random_value(rnd)) for i in range(rnd.randint(0, 8))]
+
+
+def urlencoded_form(rnd):
+	pairs = []
+	for name, value in random_fields(rnd):
+		pairs.append("%s=%s" % (urllib.quote_plus(name), urllib.quote_plus(value)))
+		if rnd.random() < 0.1:
+			pairs.append(rnd.choice(["", "novalue", "=x", "firstname="]))
+	return "application/x-www-form-urlencoded", rnd.choice("&;").join(pairs)
+
+
+def multipart_form(rnd):
+	boundary = "".join(rnd.choice("abc-_'()+,./:=?019") for i in range(rnd.randint(1, 40))) + "z"
+	parts = []
+	for name, value in random_fields(rnd):
+		headers = 'Content-Disposition: form-data; name="%s"' % name
+		if rnd.random() < 0.2:
+			headers += '; filename="f.txt"\r\nContent-Type: text/plain'
+		parts.append("--%s\r\n%s\r\n\r\n%s\r\n" % (boundary, headers, value.replace("\r\n--", "\r\n")))
+	preamble = rnd.choice(["", "", "This is a preamble.\r\n"])
+	epilogue = rnd.choice(["", "\r\n", "\r\nepilogue"])
+	body = preamble + "".join(parts) + "--%s--%s" % (boundary, epilogue)
+	return 'multipart/form-data; boundary="%s"' % boundary, body
+
+
+def field_storage(content_type, body):
+	"""The fields, by cgi.FieldStorage (first values)."""
+	form = cgi.FieldStorage(fp=StringIO.StringIO(body),
+			headers={'content-type': content_type, 'content-length': str(len(body))},
+			environ={'REQUEST_METHOD': 'POST'})
+	return dict((k, form.getfirst(k, '')) for k in FIELDS)
+
+
+def stream_parse(content_type, body, rfile=None):
+	"""The fields, by formparser."""
+	found, unread = parse_form(rfile or StringIO.StringIO(body), content_type, str(len(body)),
+			FIELDS, MAX_SIZE)
+	return dict((k, found.get(k, '')) for k in FIELDS)
+
+
+def fuzz(forms, seed):
+	rnd = random.Random(seed)
+	problems = 0
+	for i in xrange(forms):
+		content_type, body = rnd.choice([urlencoded_form, multipart_form])(rnd)
+		expected = field_storage(content_type, body)
+		got = stream_parse(content_type, body, ShortReader(body, rnd))
+		if got != expected:
+			problems += 1
+			if problems <= 5:
+				print "DIFFERENT (%s):\n%r\nformparser: %r\ncgi: %r" % (
+						content_type, body, got, expected)
+		# Mangled.
+		mangled = list(body[:rnd.randint(0, len(body))])
+		for j in range(rnd.randint(0, 3)):
+			if mangled:
+				mangled[rnd.randrange(len(mangled))] = chr(rnd.randint(0, 255))
+		try:
+			stream_parse(content_type, "".join(mangled), ShortReader("".join(mangled), rnd))
+		except FormError:
+			pass
+	print "%i forms fuzzed: %i different from cgi.FieldStorage" % (forms, problems)
+	return problems
+
+
+def benchmark(repeat):
+	form = [("firstname", "Load"), ("lastname", "Generator"), ("email", "load@example.com")]
+	big = "x" * (2 ** 20)
+	boundary = "----FormBoundary7MA4YWxkTrZu0gW"
+	def multipart(fields):
+		return 'multipart/form-data; boundary=%s' % boundary, "".join(
+				'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+				% (boundary, name, value) for name, value in fields) + "--%s--\r\n" % boundary
+	cases = [
+			("urlencoded", ("application/x-www-form-urlencoded", urllib.urlencode(form)), repeat),
+			("multipart", multipart(form), repeat),
+			("multipart, 1 MB file after", multipart(form + [("file", big)]), 20),
+			("multipart, 1 MB file before", multipart([("file", big)] + form), 20),
+		]
+	print "%-30s %14s %14s" % ("form", "formparser us", "cgi us")
+	for name, (content_type, body), n in cases:
+		times = []
+		for parse in (stream_parse, field_storage):
+			start = time.time()
+			for i in xrange(n):
+				parse(content_type, body)
+			times.append((time.time() - start) / n * 1000000)
+		print "%-30s %14.1f %14.1f" % (name, times[0], times[1])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--forms', type=int, default=5000, help="Forms to fuzz.")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--repeat', type=int, default=2000,
+			help="Parses of each small form in the benchmark.")
+	args = parser.parse_args()
+	problems = fuzz(args.forms, args.seed)
+	benchmark(args.repeat)
+	if problems:
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	main()
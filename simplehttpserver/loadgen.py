@@ -0,0 +1,275 @@
+"""Load generator for simpleHTTPServer.py
+
+Sends requests from several concurrent clients and reports the throughput
+and the latency percentiles. With --modes it starts the server in each of
+the modes, one after the other, and compares them:
+
+	python loadgen.py --modes single,thread,pool,prefork --slow-clients 2
+
+--slow-clients keeps some connections busy during the run, sending a POST to
+/save very slowly (like a slow upload): a single-threaded server can't serve
+anyone else meanwhile. --idle-connections opens connections that send
+nothing (like idle keep-alive clients), for the whole run:
+
+	python loadgen.py --modes thread,async --idle-connections 5000
+
+--keepalive both runs each mode with a new connection per request and with
+persistent connections, and shows how many connections were opened:
+
+	python loadgen.py --modes thread,pool,async --keepalive both
+
+--conditional sends the ETag of the first response in If-None-Match, as a
+browser revalidating its copy (the server answers 304), and --gzip accepts
+the gzip encoding:
+
+	python loadgen.py --url http://localhost:8000/answers.txt --keepalive on --conditional
+
+"""
+
+import argparse
+import httplib
+import os.path
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+DEFAULT_URL = "http://localhost:8000/questions.html"
+FORM_DATA = "firstname=Load&lastname=Generator&email=load%40example.com"
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simpleHTTPServer.py")
+
+
+def percentile(sorted_values, p):
+	"""The 'p' percentile (0-100) of the values, which must be sorted."""
+	if not sorted_values:
+		return float('nan')
+	i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+	return sorted_values[i]
+
+
+class LoadGenerator(object):
+	"""'concurrency' clients, sending 'requests' requests in total."""
+
+	def __init__(self, url, concurrency, requests, post=None, timeout=10, keepalive=False,
+			headers=None):
+		self.url = urlparse.urlsplit(url)
+		self.keepalive = keepalive
+		self.headers = headers or {}
+		self.connections = 0
+		self.concurrency = concurrency
+		self.requests = requests
+		self.post = post
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.pending = requests
+		self.latencies = []
+		self.errors = 0
+
+	def request(self, conn):
+		"""Send a request on 'conn', which connects if it isn't connected.
+		Return True if it succeeded.
+
+		"""
+		for attempt in (1, 2):
+			reused = conn.sock is not None
+			if not reused:
+				with self.lock:
+					self.connections += 1
+			try:
+				path = self.url.path or '/'
+				if self.post is None:
+					conn.request('GET', path, headers=self.headers)
+				else:
+					conn.request('POST', path, self.post, dict(self.headers,
+							**{'Content-Type': 'application/x-www-form-urlencoded'}))
+				response = conn.getresponse()
+				response.read()
+			except (socket.error, httplib.HTTPException):
+				conn.close()
+				if reused:
+					# The server closed the idle connection: try a new one.
+					continue
+				return False
+			if not self.keepalive or response.will_close:
+				conn.close()
+			return response.status < 400
+		return False
+
+	def client(self):
+		conn = httplib.HTTPConnection(self.url.hostname, self.url.port or 80,
+				timeout=self.timeout)
+		while True:
+			with self.lock:
+				if self.pending == 0:
+					conn.close()
+					return
+				self.pending -= 1
+			start = time.time()
+			ok = self.request(conn)
+			elapsed = time.time() - start
+			with self.lock:
+				if ok:
+					self.latencies.append(elapsed)
+				else:
+					self.errors += 1
+
+	def run(self):
+		"""Send the requests. Return a dict with the results."""
+		clients = [threading.Thread(target=self.client) for i in range(self.concurrency)]
+		start = time.time()
+		for t in clients:
+			t.start()
+		for t in clients:
+			t.join()
+		elapsed = time.time() - start
+		latencies = sorted(self.latencies)
+		return {
+			'ok': len(latencies),
+			'errors': self.errors,
+			'conns': self.connections,
+			'rps': len(latencies) / elapsed,
+			'p50': percentile(latencies, 50) * 1000,
+			'p99': percentile(latencies, 99) * 1000,
+			}
+
+
+class SlowClient(threading.Thread):
+	"""Sends a POST to /save one byte per 'delay' seconds, until stopped."""
+
+	def __init__(self, host, port, delay=0.5):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.host, self.port, self.delay = host, port, delay
+		self.stopped = threading.Event()
+
+	def run(self):
+		body = FORM_DATA * 100
+		try:
+			s = socket.create_connection((self.host, self.port))
+			s.sendall("POST /save HTTP/1.0\r\n"
+					"Content-Type: application/x-www-form-urlencoded\r\n"
+					"Content-Length: %i\r\n\r\n" % len(body))
+			for c in body:
+				if self.stopped.wait(self.delay):
+					break
+				s.send(c)
+			s.close()
+		except socket.error:
+			pass
+
+	def stop(self):
+		self.stopped.set()
+
+
+def open_idle_connections(host, port, n):
+	"""Open 'n' connections that send nothing. Return their sockets."""
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ImportError, ValueError):
+		pass
+	sockets = []
+	for i in range(n):
+		try:
+			sockets.append(socket.create_connection((host, port), 5))
+		except socket.error, e:
+			print "Could open only %i idle connections: %s" % (i, e)
+			break
+	return sockets
+
+
+def get_etag(url, headers):
+	"""The ETag of the response to a GET of 'url'."""
+	url = urlparse.urlsplit(url)
+	conn = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+	try:
+		conn.request('GET', url.path or '/', headers=headers)
+		response = conn.getresponse()
+		response.read()
+	finally:
+		conn.close()
+	etag = response.getheader('ETag')
+	if etag is None:
+		raise SystemExit("The response to %s has no ETag." % url.geturl())
+	return etag
+
+
+def start_server(mode, port, workers, cwd=None):
+	"""Start simpleHTTPServer.py in 'mode' (serving the files of 'cwd', by
+	default its own directory), and wait until it accepts.
+
+	"""
+	server = subprocess.Popen(
+			[sys.executable, SERVER_PATH, '--mode', mode, '--port', str(port),
+			'--workers', str(workers), '--drain-timeout', '1'],
+			cwd=cwd or os.path.dirname(SERVER_PATH),
+			stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+	for i in range(50):
+		try:
+			socket.create_connection(('localhost', port)).close()
+			return server
+		except socket.error:
+			time.sleep(0.1)
+	server.terminate()
+	raise SystemExit("The server (mode %s) didn't start." % mode)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--url', default=DEFAULT_URL)
+	parser.add_argument('-c', '--concurrency', type=int, default=16)
+	parser.add_argument('-n', '--requests', type=int, default=2000)
+	parser.add_argument('--post', action='store_true',
+			help="POST the questions form (to --url, e.g. http://localhost:8000/save).")
+	parser.add_argument('--timeout', type=float, default=10,
+			help="Seconds to wait for each response.")
+	parser.add_argument('--slow-clients', type=int, default=0)
+	parser.add_argument('--idle-connections', type=int, default=0)
+	parser.add_argument('--keepalive', choices=['off', 'on', 'both'], default='off',
+			help="Reuse the connections for several requests.")
+	parser.add_argument('--conditional', action='store_true',
+			help="Send If-None-Match with the ETag of the first response.")
+	parser.add_argument('--gzip', action='store_true',
+			help="Send Accept-Encoding: gzip.")
+	parser.add_argument('--modes',
+			help="Comma separated modes to start the server in (on the --url's port).")
+	parser.add_argument('--workers', type=int, default=8,
+			help="Workers of the server, with --modes.")
+	args = parser.parse_args()
+
+	url = urlparse.urlsplit(args.url)
+	port = url.port or 80
+	modes = args.modes.split(',') if args.modes else [None]
+	keepalives = {'off': [False], 'on': [True], 'both': [False, True]}[args.keepalive]
+	print "%-14s %8s %8s %8s %10s %10s %10s" % (
+			"mode", "ok", "errors", "conns", "req/s", "p50 ms", "p99 ms")
+	for mode, keepalive in [(m, k) for m in modes for k in keepalives]:
+		server = start_server(mode, port, args.workers) if mode else None
+		slow = [SlowClient(url.hostname, port) for i in range(args.slow_clients)]
+		for s in slow:
+			s.start()
+		idle = open_idle_connections(url.hostname, port, args.idle_connections)
+		try:
+			headers = {'Accept-Encoding': 'gzip'} if args.gzip else {}
+			if args.conditional:
+				headers['If-None-Match'] = get_etag(args.url, headers)
+			results = LoadGenerator(args.url, args.concurrency, args.requests,
+					post=FORM_DATA if args.post else None, timeout=args.timeout,
+					keepalive=keepalive, headers=headers).run()
+		finally:
+			for s in slow:
+				s.stop()
+			for s in idle:
+				s.close()
+			if server is not None:
+				server.terminate()
+				server.wait()
+		results['mode'] = (mode or '-') + (' keepalive' if keepalive else '')
+		print "%(mode)-14s %(ok)8i %(errors)8i %(conns)8i %(rps)10.1f %(p50)10.2f %(p99)10.2f" % results
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,271 @@
+"""Metrics of simpleHTTPServer.py, and its logger
+
+Metrics counts the requests by route and status code, the bytes sent, the
+answers cache's hits, and the latencies, in HDR-style histograms: buckets
+of logarithmic size (32 per power of 2, so each one is at most 3% wide)
+from 1 microsecond to more than an hour. They are rendered for Prometheus,
+with coarser buckets and the quantiles of the fine ones.
+
+The counters are a flat array of uint64: in shared memory for the prefork
+workers, with a slot for each one (written only by it), added up when read.
+
+AsyncLogger writes the log lines from a thread of its own: the requests
+don't wait for the stream.
+
+"""
+
+import BaseHTTPServer
+import Queue
+import ctypes
+import mmap
+import os
+import threading
+import time
+
+SUB_BUCKET_BITS = 5 # 32 buckets per power of 2.
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_VALUE = 2 ** 32 - 1 # Microseconds (71 minutes): bigger ones count as it.
+ROUTES = ("/save", "/answers.txt", "/answers/{n}", "/metrics", "static")
+CODES = (200, 206, 301, 302, 304, 400, 404, 408, 409, 411, 413, 414, 415, 416,
+		500, 501, 505)
+COUNTERS = ("answers_cache_hits", "answers_cache_misses", "log_lines_dropped")
+# Upper bounds of the buckets rendered, in seconds.
+BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+		0.1, 0.2, 0.5, 1, 2, 5, 10)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+	"""The histogram bucket of 'value' (a non negative integer)."""
+	value = min(value, MAX_VALUE)
+	if value < SUB_BUCKETS:
+		return value
+	shift = value.bit_length() - SUB_BUCKET_BITS - 1
+	return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_bounds(index):
+	"""The [lower, upper) values of the bucket."""
+	shift = max((index >> SUB_BUCKET_BITS) - 1, 0)
+	lower = (index - (shift << SUB_BUCKET_BITS)) << shift
+	return lower, lower + (1 << shift)
+
+
+HISTOGRAM_SIZE = bucket_index(MAX_VALUE) + 1
+
+
+def quantiles(counts, qs=QUANTILES):
+	"""The values (the upper bounds of their buckets) at the quantiles of
+	the histogram.
+
+	"""
+	total = sum(counts)
+	values = []
+	if not total:
+		return [0 for q in qs]
+	for q in qs:
+		rank = max(int(q * total + 0.5), 1)
+		seen = 0
+		for i, n in enumerate(counts):
+			seen += n
+			if seen >= rank:
+				values.append(bucket_bounds(i)[1] - 1)
+				break
+	return values
+
+
+def shared_counters(n):
+	"""An array of 'n' uint64, in memory shared with the processes forked."""
+	return (ctypes.c_uint64 * n).from_buffer(mmap.mmap(-1, n * 8))
+
+
+class Metrics(object):
+	"""The metrics of 'slots' processes (see use_slot)."""
+
+	def __init__(self, slots=1):
+		self.route_index = dict((r, i) for i, r in enumerate(ROUTES))
+		self.code_index = dict((c, i) for i, c in enumerate(CODES))
+		ncodes = len(CODES) + 1 # And the rest.
+		self.requests_at = 0
+		self.bytes_at = self.requests_at + len(ROUTES) * ncodes
+		self.histograms_at = self.bytes_at + len(ROUTES)
+		self.sums_at = self.histograms_at + len(ROUTES) * HISTOGRAM_SIZE
+		self.counters_at = self.sums_at + len(ROUTES)
+		self.slot_size = self.counters_at + len(COUNTERS)
+		self.ncodes = ncodes
+		self.slots = slots
+		if slots > 1:
+			self.values = shared_counters(slots * self.slot_size)
+		else:
+			self.values = (ctypes.c_uint64 * self.slot_size)()
+		self.offset = 0
+		self.lock = threading.Lock()
+
+	def use_slot(self, slot):
+		"""Count in the slot (from 0) of this process, after a fork."""
+		self.offset = slot * self.slot_size
+		self.lock = threading.Lock()
+
+	def observe(self, route, code, nbytes, seconds):
+		"""Count a request to 'route', answered with 'code' and 'nbytes'
+		in 'seconds'.
+
+		"""
+		r = self.route_index[route]
+		c = self.code_index.get(code, self.ncodes - 1)
+		us = int(seconds * 1000000)
+		v = self.values
+		with self.lock:
+			v[self.offset + self.requests_at + r * self.ncodes + c] += 1
+			v[self.offset + self.bytes_at + r] += nbytes
+			v[self.offset + self.histograms_at + r * HISTOGRAM_SIZE + bucket_index(us)] += 1
+			v[self.offset + self.sums_at + r] += us
+
+	def count(self, counter, n=1):
+		"""Add 'n' to one of the COUNTERS."""
+		with self.lock:
+			self.values[self.offset + self.counters_at + COUNTERS.index(counter)] += n
+
+	def totals(self):
+		"""The values of all the slots, added up."""
+		size = self.slot_size
+		slots = [self.values[s * size:(s + 1) * size] for s in range(self.slots)]
+		return slots[0] if len(slots) == 1 else [sum(v) for v in zip(*slots)]
+
+	def render(self):
+		"""The metrics in the Prometheus text format (version 0.0.4)."""
+		t = self.totals()
+		codes = [str(c) for c in CODES] + ["other"]
+		lines = [
+				"# HELP http_requests_total Requests, by route and status code.",
+				"# TYPE http_requests_total counter",
+			]
+		for r, route in enumerate(ROUTES):
+			for c, code in enumerate(codes):
+				n = t[self.requests_at + r * self.ncodes + c]
+				if n:
+					lines.append('http_requests_total{route="%s",code="%s"} %i' % (route, code, n))
+		lines += [
+				"# HELP http_response_bytes_total Bytes of the responses' bodies, by route.",
+				"# TYPE http_response_bytes_total counter",
+			]
+		for r, route in enumerate(ROUTES):
+			lines.append('http_response_bytes_total{route="%s"} %i' % (route, t[self.bytes_at + r]))
+		histograms = []
+		for r, route in enumerate(ROUTES):
+			at = self.histograms_at + r * HISTOGRAM_SIZE
+			histograms.append((route, t[at:at + HISTOGRAM_SIZE], t[self.sums_at + r]))
+		lines += [
+				"# HELP http_request_duration_seconds Time to handle the requests, by route.",
+				"# TYPE http_request_duration_seconds histogram",
+			]
+		for route, counts, total_us in histograms:
+			cumulative, i = 0, 0
+			for le in BUCKETS:
+				# The fine buckets entirely below 'le'.
+				while i < HISTOGRAM_SIZE and bucket_bounds(i)[1] <= le * 1000000:
+					cumulative += counts[i]
+					i += 1
+				lines.append('http_request_duration_seconds_bucket{route="%s",le="%s"} %i'
+						% (route, le, cumulative))
+			lines += [
+					'http_request_duration_seconds_bucket{route="%s",le="+Inf"} %i' % (route, sum(counts)),
+					'http_request_duration_seconds_sum{route="%s"} %.6f' % (route, total_us / 1e6),
+					'http_request_duration_seconds_count{route="%s"} %i' % (route, sum(counts)),
+				]
+		lines += [
+				"# HELP http_request_duration_quantile_seconds Quantiles of the time to "
+				"handle the requests, from histograms of 3% precision.",
+				"# TYPE http_request_duration_quantile_seconds gauge",
+			]
+		for route, counts, total_us in histograms:
+			for q, value in zip(QUANTILES, quantiles(counts)):
+				lines.append('http_request_duration_quantile_seconds{route="%s",quantile="%s"} %.6f'
+						% (route, q, value / 1e6))
+		for i, name in enumerate(COUNTERS):
+			lines += [
+					"# TYPE %s_total counter" % name,
+					"%s_total %i" % (name, t[self.counters_at + i]),
+				]
+		# The answers file: how often it's served from the cache, or not
+		# sent at all (a 304).
+		hits = t[self.counters_at + COUNTERS.index("answers_cache_hits")]
+		misses = t[self.counters_at + COUNTERS.index("answers_cache_misses")]
+		r = self.route_index["/answers.txt"]
+		answers = t[self.requests_at + r * self.ncodes:self.requests_at + (r + 1) * self.ncodes]
+		not_modified = answers[self.code_index[304]]
+		lines += [
+				"# TYPE answers_cache_hit_ratio gauge",
+				"answers_cache_hit_ratio %.4f" % (float(hits) / (hits + misses) if hits + misses else 0),
+				"# TYPE answers_not_modified_ratio gauge",
+				"answers_not_modified_ratio %.4f" % (
+						float(not_modified) / sum(answers) if sum(answers) else 0),
+			]
+		return "\n".join(lines) + "\n"
+
+
+def log_time(t):
+	"""'t' as in the log of BaseHTTPRequestHandler."""
+	year, month, day, hh, mm, ss, x, y, z = time.localtime(t)
+	return "%02d/%3s/%04d %02d:%02d:%02d" % (
+			day, BaseHTTPServer.BaseHTTPRequestHandler.monthname[month], year, hh, mm, ss)
+
+
+class AsyncLogger(object):
+	"""Writes log lines to 'stream' in batches, from a thread of its own
+	(started in each process that logs). Logging costs a Queue.put(): if
+	'max_pending' lines are waiting, the stream can't keep up, and the line
+	is dropped (and counted with 'on_drop').
+
+	"""
+	def __init__(self, stream, max_pending=10000, on_drop=None):
+		self.stream = stream
+		self.max_pending = max_pending
+		self.on_drop = on_drop
+		self.pid = None
+		self.start_lock = threading.Lock()
+
+	def log(self, host, message):
+		"""Log the 'message' about a request from 'host'."""
+		if self.pid != os.getpid():
+			self.start()
+		try:
+			self.queue.put_nowait((time.time(), host, message))
+		except Queue.Full:
+			if self.on_drop is not None:
+				self.on_drop()
+
+	def start(self):
+		with self.start_lock:
+			if self.pid == os.getpid():
+				return
+			self.queue = Queue.Queue(self.max_pending)
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+			self.pid = os.getpid()
+
+	def run(self):
+		while True:
+			batch = [self.queue.get()]
+			try:
+				while len(batch) < 1000:
+					batch.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			lines = ["%s - - [%s] %s\n" % (host, log_time(t), message)
+					for t, host, message in batch if t is not None]
+			try:
+				self.stream.write("".join(lines))
+				self.stream.flush()
+			except (IOError, ValueError):
+				pass
+			if (None, None, None) in batch:
+				return
+
+	def close(self, timeout=1):
+		"""Write the lines logged by this process, and stop its thread."""
+		if self.pid == os.getpid():
+			self.queue.put((None, None, None))
+			self.thread.join(timeout)
+			self.pid = None
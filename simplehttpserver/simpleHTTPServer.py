@@ -6,24 +6,238 @@ Exercise given on the 21/01/2013
 
 import SimpleHTTPServer
 import SocketServer
-import cgi
+import Queue
+import argparse
+import os
 import os.path
+import signal
+import threading
 import time
-import datetime
+import email.utils
+import errno
+import gzip
+import re
+import select
+import socket
+import StringIO
+import sys
+
+from answersstore import AnswersStore
+from formparser import FormError, parse_form
+from metrics import AsyncLogger, Metrics
+
+try:
+	from os import sendfile # Python >= 3.3
+except ImportError:
+	try:
+		from sendfile import sendfile # The pysendfile package.
+	except ImportError:
+		sendfile = None # Copy the files in chunks.
 
 PORT_NUMBER = 8000
-ANSWERS_DATA_FILE = "answers.txt"
+ANSWERS_DATA_FILE = "answers.txt" # The latest answers.
+ANSWERS_DIR = "answers" # All of them (see answersstore.py).
+ANSWERS_RE = re.compile(r'^/answers/(\d+)$')
+METRICS_PATH = "/metrics"
 SUCCESS_PAGE_PATH = "success.html"
 FORM_FIELDS = ["firstname", "lastname", "email"]
 INVALID_DATA_ERROR_CODE = 409 # Conflict
 CANT_SAVE_ERROR_CODE = 500 # Internal Server Error
 NOT_MODIFIED_RESPONSE_CODE = 304 # Not Modified http://httpstatusdogs.com/
+DEFAULT_WORKERS = 8 # Threads of the pool, or processes of prefork.
+LISTEN_BACKLOG = 128 # Connections waiting to be accepted.
+DRAIN_TIMEOUT = 10 # Seconds to finish the requests in flight, when stopping.
+KEEPALIVE_TIMEOUT = 5 # Seconds an idle persistent connection is kept open.
+MAX_REQUESTS = 100 # Requests per persistent connection.
+FILE_CHUNK_SIZE = 64 * 1024 # Bytes per read (or sendfile) of a file sent.
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+ANSWERS_CACHE_CONTROL = "no-cache" # Keep it, but revalidate it on every use.
+MAX_CACHED_SIZE = 2 ** 20 # Bytes: bigger answers files are sent from the disk.
+MAX_BODY_SIZE = 64 * 1024 # Bytes of a form: bigger ones get a 413.
+BODY_TIMEOUT = 30 # Seconds to receive a form.
+
+
+def format_answers(record):
+	"""The answers as 'key = value' lines (the format of ANSWERS_DATA_FILE)."""
+	return (u"first name = %s\nlast name = %s\nemail = %s" % (
+			record["firstname"], record["lastname"], record["email"])).encode('utf-8')
+
+
+def parse_http_date(value):
+	"""The seconds since the epoch of an HTTP-date (RFC 7231, 7.1.1.1),
+	or None if it isn't one.
+
+	"""
+	parsed = email.utils.parsedate_tz(value or "")
+	if parsed is None:
+		return None
+	if parsed[9] is None:
+		# The asctime format has no zone, and it's GMT (not the local time).
+		parsed = parsed[:9] + (0,)
+	try:
+		return email.utils.mktime_tz(parsed)
+	except (OverflowError, ValueError):
+		return None
+
+
+def accepts_gzip(accept_encoding):
+	"""Whether the Accept-Encoding header value allows gzip."""
+	for coding in accept_encoding.lower().split(","):
+		name, _, params = coding.partition(";")
+		if name.strip() in ("gzip", "x-gzip"):
+			params = params.replace(" ", "")
+			if params.startswith("q="):
+				try:
+					return float(params[2:]) > 0
+				except ValueError:
+					return False
+			return True
+	return False
+
+
+class CachedFile(object):
+	"""The validators of a file, as of its stat 'st', and its contents
+	(and their gzip, if it's smaller) if given.
+
+	The ETags are strong: the inode changes when the file is replaced, and
+	a write changes its mtime (and usually its size).
+
+	"""
+	def __init__(self, st, body=None):
+		self.key = (st.st_ino, st.st_mtime, st.st_size)
+		self.size = st.st_size
+		self.mtime = st.st_mtime
+		self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+		tag = "%x-%x-%x" % (st.st_ino, int(st.st_mtime * 1000000), st.st_size)
+		self.etag = '"%s"' % tag
+		self.gzip_etag = '"%s-gzip"' % tag
+		self.body = body
+		self.gzip_body = None
+		if body is not None:
+			buf = StringIO.StringIO()
+			f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+			f.write(body)
+			f.close()
+			if len(buf.getvalue()) < len(body):
+				self.gzip_body = buf.getvalue()
+
+
+class FileCache(object):
+	"""The CachedFile of each path, reloaded when the file's inode, mtime
+	or size change: a request costs a stat, not a read (nor a gzip).
+
+	"""
+	def __init__(self, max_size=MAX_CACHED_SIZE):
+		self.max_size = max_size
+		self.files = {}
+
+	def get(self, path):
+		"""The CachedFile of 'path'. It has no body if the file is bigger
+		than max_size. May raise OSError.
+
+		"""
+		st = os.stat(path)
+		cached = self.files.get(path)
+		if cached is None or cached.key != (st.st_ino, st.st_mtime, st.st_size):
+			if st.st_size > self.max_size:
+				cached = CachedFile(st)
+			else:
+				try:
+					with open(path, 'rb') as f:
+						cached = CachedFile(os.fstat(f.fileno()), f.read())
+				except IOError, e:
+					raise OSError(e.errno, e.strerror, path)
+			self.files[path] = cached
+		return cached
+
 
 class MySimpleHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 	"""Custom simple HTTP request handler, which validates that 
 	some fields are not empty when a POST arrives.
 
+	Speaks HTTP/1.1: a connection serves up to 'max_requests' requests,
+	and is closed after 'timeout' seconds without one. Every response has a
+	Content-Length, or closes the connection.
+
 	"""
+	protocol_version = "HTTP/1.1"
+	# Write each response with as few sends as possible, and send them right
+	# away: otherwise Nagle's algorithm waits for the client's delayed ACK
+	# (40 ms) before answering the next request of the connection.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+	timeout = KEEPALIVE_TIMEOUT
+	max_requests = MAX_REQUESTS
+	requests_served = 0
+	answers_store = None # An AnswersStore, set by main().
+	answers_cache = FileCache()
+	max_body_size = MAX_BODY_SIZE
+	body_timeout = BODY_TIMEOUT
+	metrics = Metrics() # One with a slot per worker in prefork mode.
+	logger = AsyncLogger(sys.stderr, on_drop=lambda: MySimpleHTTPRequestHandler.metrics.count(
+			"log_lines_dropped"))
+
+	def handle(self):
+		"""Handle the requests of the connection."""
+		self.requests_served = 0
+		SimpleHTTPServer.SimpleHTTPRequestHandler.handle(self)
+
+	def handle_one_request(self):
+		"""Handle a request, and count it in the metrics."""
+		self.request_start = None
+		self.response_code = None
+		self.response_length = 0
+		SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+		if self.request_start is not None and self.response_code is not None:
+			self.metrics.observe(self.route(), self.response_code,
+					0 if self.command == 'HEAD' else self.response_length,
+					time.time() - self.request_start)
+
+	def parse_request(self):
+		# The request line has arrived: the time to handle it starts (not
+		# counting the wait for it, in a persistent connection).
+		self.request_start = time.time()
+		return SimpleHTTPServer.SimpleHTTPRequestHandler.parse_request(self)
+
+	def route(self):
+		"""The route of the request, for the metrics (see metrics.ROUTES)."""
+		if self.path in ("/save", "/" + ANSWERS_DATA_FILE, METRICS_PATH):
+			return self.path
+		if ANSWERS_RE.match(self.path):
+			return "/answers/{n}"
+		return "static"
+
+	def log_message(self, format, *args):
+		"""Log with the logger, out of the request's thread (and with the
+		client's address, not its name: getfqdn() may wait for the DNS).
+
+		"""
+		self.logger.log(self.client_address[0], format % args)
+
+	def send_response(self, code, message=None):
+		self.response_code = code
+		self.response_has_length = False
+		SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(self, code, message)
+
+	def send_header(self, keyword, value):
+		if keyword.lower() == 'content-length':
+			self.response_has_length = True
+			self.response_length = int(value)
+		SimpleHTTPServer.SimpleHTTPRequestHandler.send_header(self, keyword, value)
+
+	def end_headers(self):
+		"""End the headers, closing the connection after the response if it
+		is the last one allowed, or its length is unknown (e.g. the
+		redirects of SimpleHTTPRequestHandler).
+
+		"""
+		self.requests_served += 1
+		has_body = self.response_code >= 200 and self.response_code not in (204, 304)
+		if not self.close_connection and (self.requests_served >= self.max_requests
+				or (has_body and not self.response_has_length)):
+			self.send_header("Connection", "close")
+		SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
 	def do_GET(self):
 		"""If the GET is for the answers (data) file, implement caching control.
 
@@ -33,51 +247,69 @@ class MySimpleHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 		"""
 		if self.path == '/'+ANSWERS_DATA_FILE:
 			self.answers_data_caching_control()
+		elif ANSWERS_RE.match(self.path):
+			self.deliver_answers(int(ANSWERS_RE.match(self.path).group(1)))
+		elif self.path == METRICS_PATH:
+			self.deliver_metrics()
 		else:
 			SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
 
+	def do_HEAD(self):
+		"""As do_GET, but without the contents."""
+		if self.path == '/'+ANSWERS_DATA_FILE:
+			self.answers_data_caching_control()
+		else:
+			SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+
 	def do_POST(self):
 		"""If the POST is on the quetions form, validate the form's data
 		and save it to an answers (data) file.
 
 		"""
 		if self.path=="/save":
-			data = self.extract_form_data()
+			try:
+				data, unread = self.extract_form_data()
+			except FormError, e:
+				# The body is left unread: the connection can't go on.
+				self.send_error_response(e.status, str(e), close=True)
+				return
+			except socket.timeout:
+				self.send_error_response(408, "Timed out reading the form", close=True)
+				return
 			is_ok, msg = self.validate_form_data(data)
 			if is_ok:
 				try:
-					self.save_data_to_file(data, ANSWERS_DATA_FILE)
-					self.redirect_to_success_page()
-				except IOError:
+					self.save_answers(data)
+					self.redirect_to_success_page(close=unread > 0)
+				except (IOError, OSError):
 					self.send_error_response(
 							CANT_SAVE_ERROR_CODE,
-							"Couldn't save the file"
+							"Couldn't save the file",
+							close=unread > 0
 							)
 			else:
-				self.send_error_response(INVALID_DATA_ERROR_CODE, msg)
+				self.send_error_response(INVALID_DATA_ERROR_CODE, msg, close=unread > 0)
 			# Valid data. Continue with nominal.
+		else:
+			self.send_error(404)
 
 	def extract_form_data(self):
 		"""Extract the firstname, lastname and email from the questions form,
-		input by the user. Return a dict with such keys.
+		input by the user. Return (a dict with such keys, the bytes of the
+		body left unread).
+
+		The body is parsed as it's read, up to the three fields (see
+		formparser.py). May raise FormError, or socket.timeout.
 
 		"""
-		form = cgi.FieldStorage(
-			fp=self.rfile, 
-			headers=self.headers,
-			environ={'REQUEST_METHOD':'POST',
-	                 'CONTENT_TYPE':self.headers['Content-Type'],
-		})
+		found, unread = parse_form(self.rfile,
+				self.headers.get('Content-Type'), self.headers.get('Content-Length'),
+				FORM_FIELDS, self.max_body_size, self.body_timeout)
 		form_data = {}
 		for k in FORM_FIELDS:
-			value = ''
-			if form.has_key(k):
-				value = form[k].value
-			else:
-				print "no tiene",k
-			form_data[k] = value
+			form_data[k] = found.get(k, '')
 		# Other checks here, like email format, etc.
-		return form_data
+		return form_data, unread
 
 	def validate_form_data(self, data):
 		"""Validate the data. 'data' must be a dict.
@@ -93,30 +325,65 @@ class MySimpleHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 				break
 		return ret_val
 
-	def save_data_to_file(self, data, fname):
-		"""Save the 'data' in the 'fname' file, as 'key = value' pairs.
-
-		Overwrites the data file if already exists. May raise IOError.
+	def save_answers(self, data):
+		"""Append the 'data' to the answers store, and wait until it is on
+		disk (the store also replaces the answers data file with them).
+		Return their number. May raise IOError or OSError.
 
 		"""
-		data_file = open(fname, 'w')
-		data_file.write(
-				"first name = %s\nlast name = %s\nemail = %s"\
-				%(data["firstname"], data["lastname"], data["email"])
-				)
-		data_file.close()
+		record = dict((k, v.decode('utf-8', 'replace')) for k, v in data.items())
+		record["time"] = time.time()
+		return self.answers_store.append(record)
 
-	def redirect_to_success_page(self):
-		"""Send a 302 response (Found) and redirect to the success page."""
+	def deliver_answers(self, n):
+		"""Send the answers number 'n' (from 1), or a 404."""
+		record = self.answers_store.get(n)
+		if record is None:
+			self.send_error(404, "No such answers")
+			return
+		content = format_answers(record)
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; charset=utf-8")
+		self.send_header("Content-Length", len(content))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def deliver_metrics(self):
+		"""Send the metrics, for Prometheus."""
+		content = self.metrics.render()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", len(content))
+		self.send_header("Cache-Control", "no-store")
+		self.end_headers()
+		self.wfile.write(content)
+
+	def redirect_to_success_page(self, close=False):
+		"""Send a 302 response (Found) and redirect to the success page.
+		If 'close', close the connection after it.
+
+		"""
 		self.send_response(302, "Data saved.")
 		self.send_header("Location", SUCCESS_PAGE_PATH)
+		self.send_header("Content-Length", 0)
+		if close:
+			self.send_header("Connection", "close")
 		self.end_headers()
 
-	def send_error_response(self, error_code, message):
-		self.send_error(error_code)
+	def send_error_response(self, error_code, message, close=False):
+		"""Send an error response, with the message as its page. If 'close',
+		close the connection after it.
+
+		"""
+		content = self.render_error_message(message)
+		self.log_error("code %d, message %s", error_code, message)
+		self.send_response(error_code)
 		self.send_header("Content-Type", "text/html")
+		self.send_header("Content-Length", len(content))
+		if close:
+			self.send_header("Connection", "close")
 		self.end_headers()
-		self.wfile.write(self.render_error_message(message))
+		self.wfile.write(content)
 		
 	def render_error_message(self, msg):
 		""""""
@@ -125,58 +392,420 @@ class MySimpleHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 	def answers_data_caching_control(self):
 		"""Implement the cache control on the answer's data file.
 
-		If the request includes an If-Modified-Since header, the data file's
-		modification time is verified. If it hasn't been modified, a 
-		'Not modified' response is sent. Otherwise, the data is sent.
+		The file is sent from the answers_cache. If the client's copy is
+		current (its If-None-Match has the ETag, or else its
+		If-Modified-Since is not older than the file), a 'Not modified'
+		response is sent instead. The gzip variant is sent to the clients
+		that accept it.
 
 		"""
-		data_fname = os.path.abspath(ANSWERS_DATA_FILE)
-		last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(data_fname))
-		client_modif_time = None
-		if self.headers.has_key("If-Modified-Since"):
-			print self.headers
-			try:
-				client_modif_time = datetime.datetime.strptime(
-						self.headers["If-Modified-Since"], '%Y-%m-%d %H:%M:%S.%f'
-						)
-			except ValueError:
-				client_modif_time = None
-		
-		if client_modif_time is not None and\
-				last_modified <= client_modif_time:
-			# Not modified. Don't send.
-			print "Not modified. Code", NOT_MODIFIED_RESPONSE_CODE
+		previous = self.answers_cache.files.get(ANSWERS_DATA_FILE)
+		try:
+			cached = self.answers_cache.get(ANSWERS_DATA_FILE)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			self.send_error(404, "No answers yet")
+			return
+		self.metrics.count("answers_cache_hits" if cached is previous else "answers_cache_misses")
+		gzipped = (cached.gzip_body is not None and "Range" not in self.headers
+				and accepts_gzip(self.headers.get("Accept-Encoding", "")))
+		etag = cached.gzip_etag if gzipped else cached.etag
+		if self.not_modified(etag, cached.mtime):
 			self.send_response(NOT_MODIFIED_RESPONSE_CODE)
+			self.send_validators(cached, etag)
+			self.end_headers()
+		elif cached.body is None:
+			self.deliver_data_file(ANSWERS_DATA_FILE)
 		else:
-			# print "NEWER IN SERVER. Deliver the file."
-			print "Modified. Send the file."
-			self.deliver_data_file(last_modified, data_fname)
+			self.deliver_cached_file(cached, gzipped)
+
+	def not_modified(self, etag, mtime):
+		"""Whether the client's copy (per the request's If-None-Match, or
+		else If-Modified-Since) of a file with 'etag' and 'mtime' is current.
+
+		"""
+		if_none_match = self.headers.get("If-None-Match")
+		if if_none_match is not None:
+			# The weak comparison (RFC 7232, 3.2).
+			tags = [t.strip() for t in if_none_match.split(",")]
+			return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+		since = parse_http_date(self.headers.get("If-Modified-Since"))
+		return since is not None and int(mtime) <= since
+
+	def send_validators(self, cached, etag):
+		"""Send the headers to cache and revalidate the cached file."""
+		self.send_header("ETag", etag)
+		self.send_header("Last-Modified", cached.last_modified)
+		self.send_header("Cache-Control", ANSWERS_CACHE_CONTROL)
+		self.send_header("Vary", "Accept-Encoding")
 
-	def deliver_data_file(self, last_modified, data_fname):
-		"""Deliver the answer's data in a response contents.
+	def deliver_cached_file(self, cached, gzipped=False):
+		"""Deliver the contents of the CachedFile (gzipped, or the part of
+		them requested with a Range header).
+
+		"""
+		if gzipped:
+			self.send_file_headers(cached, len(cached.gzip_body), None, gzipped)
+			if self.command != 'HEAD':
+				self.wfile.write(cached.gzip_body)
+			return
+		byte_range = self.requested_range(cached.size, cached)
+		if self.send_file_headers(cached, cached.size, byte_range) and self.command != 'HEAD':
+			start, length = byte_range or (0, cached.size)
+			self.wfile.write(cached.body[start:start + length] if byte_range else cached.body)
+
+	def deliver_data_file(self, data_fname):
+		"""Deliver the answer's data in a response contents (or the part of
+		it requested with a Range header), from the file: it's too big to
+		keep in memory.
 
 		May rise IOError if the data file can't be read.
 
 		"""
-		self.send_response(200)
-		#self.send_header("Location", SUCCESS_PAGE_PATH)
-		size = os.path.getsize(data_fname)
+		data_file = open(data_fname, 'rb')
+		try:
+			self.deliver_open_data_file(data_file)
+		finally:
+			data_file.close()
+
+	def deliver_open_data_file(self, data_file):
+		"""Deliver the data file, already open (see deliver_data_file)."""
+		cached = CachedFile(os.fstat(data_file.fileno()))
+		byte_range = self.requested_range(cached.size, cached)
+		if self.send_file_headers(cached, cached.size, byte_range) and self.command != 'HEAD':
+			start, length = byte_range or (0, cached.size)
+			self.send_file(data_file, start, length)
+
+	def send_file_headers(self, cached, size, byte_range, gzipped=False):
+		"""Send the status and the headers of a response with the file (or
+		the byte_range of it). Return False if the range is unsatisfiable:
+		the response (a 416) is complete.
+
+		"""
+		if byte_range == 'unsatisfiable':
+			self.send_response(416)
+			self.send_header("Content-Range", "bytes */%i" % size)
+			self.send_header("Content-Length", 0)
+			self.end_headers()
+			return False
+		if byte_range is None:
+			length = size
+			self.send_response(200)
+		else:
+			start, length = byte_range
+			self.send_response(206)
 		self.send_header("Content-Type", "text/plain")
-		self.send_header("Content-Length", size)
-		self.send_header("Last-Modified", last_modified)
-		#self.send_header("Server", "localhost")
-		self.send_header("Date", self.date_time_string())
-		#self.send_header("Cache-Control", "public") # http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.9
-		#self.send_header("Content-Range", "") # http://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.16
+		if gzipped:
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", length)
+		self.send_validators(cached, cached.gzip_etag if gzipped else cached.etag)
+		self.send_header("Accept-Ranges", "bytes")
+		if byte_range is not None:
+			self.send_header("Content-Range", "bytes %i-%i/%i" % (start, start + length - 1, size))
 		self.end_headers()
-		self.wfile.write(open(data_fname).read())
+		return True
 
+	def requested_range(self, size, cached):
+		"""Return the (start, length) of the Range requested in a file of
+		'size' bytes, None to send the whole file, or 'unsatisfiable'.
+
+		Only single ranges are served: other Ranges get the whole file, as
+		an If-Range that doesn't match the CachedFile's ETag or Last-Modified.
+
+		"""
+		match = RANGE_RE.match(self.headers.get("Range", "").replace(" ", ""))
+		if_range = self.headers.get("If-Range")
+		if match is None or (if_range is not None
+				and if_range not in (cached.etag, cached.last_modified)):
+			return None
+		first, last = match.groups()
+		if first:
+			start = int(first)
+			end = min(int(last), size - 1) if last else size - 1
+		elif last:
+			start = max(size - int(last), 0)
+			end = size - 1
+		else:
+			return None
+		if start >= size or end < start:
+			return 'unsatisfiable'
+		return start, end - start + 1
+
+	def copyfile(self, source, outputfile):
+		"""Send the rest of a static file (with send_file)."""
+		try:
+			fd = source.fileno()
+		except AttributeError:
+			# A directory listing, in a StringIO.
+			return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+		offset = source.tell()
+		self.send_file(source, offset, os.fstat(fd).st_size - offset)
+
+	def send_file(self, data_file, offset, length):
+		"""Send 'length' bytes of the file from 'offset', with sendfile (the
+		kernel copies them) if available, or in chunks: the memory used
+		doesn't depend on the size of the file.
+
+		"""
+		if sendfile is None:
+			self.write_file(data_file, offset, length)
+			return
+		self.wfile.flush()
+		out = self.connection.fileno()
+		timeout = self.connection.gettimeout()
+		while length > 0:
+			try:
+				sent = sendfile(out, data_file.fileno(), offset, min(FILE_CHUNK_SIZE, length))
+			except (OSError, IOError), e:
+				if e.errno != errno.EAGAIN:
+					raise
+				# A socket with a timeout is non blocking.
+				if not select.select([], [out], [], timeout)[1]:
+					raise socket.timeout("timed out sending a file")
+				continue
+			if sent == 0:
+				break
+			offset += sent
+			length -= sent
+
+	def write_file(self, data_file, offset, length):
+		"""Write 'length' bytes of the file from 'offset' to wfile, in chunks."""
+		data_file.seek(offset)
+		while length > 0:
+			chunk = data_file.read(min(FILE_CHUNK_SIZE, length))
+			if not chunk:
+				break
+			self.wfile.write(chunk)
+			length -= len(chunk)
+
+
+class DrainingMixIn:
+	"""Count the requests in flight, so the server can wait for them
+	(drain) before exiting.
+
+	"""
+	def start_request(self):
+		with self.in_flight_lock:
+			self.in_flight += 1
+
+	def end_request(self):
+		with self.in_flight_lock:
+			self.in_flight -= 1
+			if self.in_flight == 0:
+				self.in_flight_lock.notify_all()
+
+	def drain(self, timeout):
+		"""Wait up to 'timeout' seconds for the requests in flight.
+		Return the number of requests still in flight.
+
+		"""
+		deadline = time.time() + timeout
+		with self.in_flight_lock:
+			while self.in_flight > 0 and time.time() < deadline:
+				self.in_flight_lock.wait(deadline - time.time())
+			return self.in_flight
+
+	def process_request(self, request, client_address):
+		self.start_request()
+		try:
+			SocketServer.TCPServer.process_request(self, request, client_address)
+		finally:
+			self.end_request()
+
+
+class SingleServer(DrainingMixIn, SocketServer.TCPServer):
+	"""One request at a time (the original server)."""
+	allow_reuse_address = True
+	request_queue_size = LISTEN_BACKLOG
+
+	def __init__(self, server_address, handler_class, workers=None):
+		self.in_flight = 0
+		self.in_flight_lock = threading.Condition()
+		SocketServer.TCPServer.__init__(self, server_address, handler_class)
+
+
+class ThreadingServer(SingleServer):
+	"""A new thread per request."""
+
+	def process_request(self, request, client_address):
+		self.start_request()
+		t = threading.Thread(target=self.process_request_thread,
+				args=(request, client_address))
+		t.daemon = True
+		t.start()
+
+	def process_request_thread(self, request, client_address):
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+			self.end_request()
+
+
+class ThreadPoolServer(ThreadingServer):
+	"""A fixed number of worker threads. When all of them are busy, at most
+	'workers' connections wait in a queue, and then the server stops
+	accepting (the rest wait in the listen backlog).
+
+	"""
+	def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS):
+		ThreadingServer.__init__(self, server_address, handler_class)
+		self.requests = Queue.Queue(workers)
+		self.workers = []
+		for i in range(workers):
+			t = threading.Thread(target=self.work)
+			t.daemon = True
+			t.start()
+			self.workers.append(t)
+
+	def process_request(self, request, client_address):
+		self.start_request()
+		self.requests.put((request, client_address))
+
+	def work(self):
+		while True:
+			item = self.requests.get()
+			if item is None:
+				break
+			self.process_request_thread(*item)
+
+	def server_close(self):
+		ThreadingServer.server_close(self)
+		for t in self.workers:
+			self.requests.put(None)
+		for t in self.workers:
+			t.join(1)
+
+
+class PreforkServer(SingleServer):
+	"""'workers' processes, forked after binding the socket, each one
+	accepting and serving one request at a time.
+
+	"""
+	def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS):
+		SingleServer.__init__(self, server_address, handler_class)
+		self.nworkers = workers
+		# All the workers wake up on a new connection but only one gets it:
+		# the rest must not block in accept().
+		self.socket.setblocking(0)
+
+	def serve(self, drain_timeout):
+		children = []
+		for i in range(self.nworkers):
+			pid = os.fork()
+			if pid == 0:
+				self.RequestHandlerClass.metrics.use_slot(i)
+				serve_until_signaled(self, drain_timeout)
+				self.RequestHandlerClass.logger.close()
+				os._exit(0)
+			children.append(pid)
+		stopping = wait_for_signal()
+		for pid in children:
+			try:
+				os.kill(pid, stopping)
+			except OSError:
+				pass
+		for pid in children:
+			os.waitpid(pid, 0)
+		self.server_close()
+
+
+SERVERS = {
+	'single': SingleServer,
+	'thread': ThreadingServer,
+	'pool': ThreadPoolServer,
+	'prefork': PreforkServer,
+	}
+
+
+def wait_for_signal():
+	"""Block until a SIGINT or SIGTERM arrives. Return it."""
+	received = []
+	def handler(signum, frame):
+		received.append(signum)
+	signal.signal(signal.SIGINT, handler)
+	signal.signal(signal.SIGTERM, handler)
+	while not received:
+		time.sleep(0.2)
+	return received[0]
+
+
+def serve_until_signaled(server, drain_timeout):
+	"""Serve until a SIGINT or SIGTERM, then stop accepting and wait up to
+	'drain_timeout' seconds for the requests in flight.
+
+	"""
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+	wait_for_signal()
+	print 'shutting down the web server (pid %i)' % os.getpid()
+	server.shutdown()
+	left = server.drain(drain_timeout)
+	if left:
+		print 'exiting with %i requests in flight' % left
+	server.server_close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--port', type=int, default=PORT_NUMBER)
+	parser.add_argument('--mode', choices=sorted(SERVERS) + ['async'], default='single',
+			help="single: one request at a time; thread: a thread per request; "
+			"pool: a pool of --workers threads; prefork: --workers processes; "
+			"async: an event loop, with --workers threads for the files.")
+	parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+	parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+			help="Seconds to wait for the requests in flight when shutting down.")
+	parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+			help="Seconds to keep an idle connection open.")
+	parser.add_argument('--max-requests', type=int, default=MAX_REQUESTS,
+			help="Requests per connection (1 disables the persistent connections). "
+			"In single mode, it's always 1: an idle connection would block the server.")
+	parser.add_argument('--max-body-size', type=int, default=MAX_BODY_SIZE,
+			help="Bytes of the biggest form accepted.")
+	parser.add_argument('--body-timeout', type=float, default=BODY_TIMEOUT,
+			help="Seconds to receive a form.")
+	parser.add_argument('--answers-dir', default=ANSWERS_DIR,
+			help="Directory of the answers store.")
+	parser.add_argument('--segment-size', type=int, default=64,
+			help="Megabytes per segment of the answers store.")
+	parser.add_argument('--commit-delay', type=float, default=0,
+			help="Milliseconds a commit of answers waits for others to join it.")
+	args = parser.parse_args()
+
+	MySimpleHTTPRequestHandler.timeout = args.keepalive_timeout
+	MySimpleHTTPRequestHandler.max_requests = 1 if args.mode == 'single' else args.max_requests
+	MySimpleHTTPRequestHandler.max_body_size = args.max_body_size
+	MySimpleHTTPRequestHandler.body_timeout = args.body_timeout
+	MySimpleHTTPRequestHandler.answers_store = AnswersStore(args.answers_dir,
+			segment_size=args.segment_size * 2 ** 20, commit_delay=args.commit_delay / 1000.,
+			latest_file=ANSWERS_DATA_FILE, format_record=format_answers)
+	if args.mode == 'prefork':
+		MySimpleHTTPRequestHandler.metrics = Metrics(slots=args.workers)
 
-if __name__ == "__main__":
 	try:
-		server = SocketServer.TCPServer(("", PORT_NUMBER), MySimpleHTTPRequestHandler)
-		print "serving at port", PORT_NUMBER
-		server.serve_forever()
-	except KeyboardInterrupt:
-		print ' shutting down the web server'
-		server.socket.close()
\ No newline at end of file
+		if args.mode == 'async':
+			import asyncserver
+			print "serving at port", args.port, "mode", args.mode
+			asyncserver.serve(("", args.port), args.workers, args.drain_timeout)
+			return
+		server = SERVERS[args.mode](("", args.port), MySimpleHTTPRequestHandler,
+				workers=args.workers)
+		print "serving at port", args.port, "mode", args.mode
+		if args.mode == 'prefork':
+			server.serve(args.drain_timeout)
+		else:
+			serve_until_signaled(server, args.drain_timeout)
+	finally:
+		MySimpleHTTPRequestHandler.logger.close()
+
+
+if __name__ == "__main__":
+	# The main() of the module (not of __main__), so its settings of the
+	# handler are seen by asyncserver, which imports the module.
+	import simpleHTTPServer
+	simpleHTTPServer.main()
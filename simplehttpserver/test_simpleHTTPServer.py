@@ -0,0 +1,719 @@
+"""Tests of simpleHTTPServer.py, against a server running in a thread.
+
+	python -m unittest discover -s simplehttpserver
+
+"""
+
+import gzip
+import httplib
+import json
+import os
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import answersstore
+import formparser
+import metrics
+import simpleHTTPServer
+
+PAGE = "<html><body>Questions</body></html>"
+
+
+class QuietHandler(simpleHTTPServer.MySimpleHTTPRequestHandler):
+	"""The handler, not logging the requests, with a cache of its own."""
+	answers_cache = simpleHTTPServer.FileCache()
+
+	def log_message(self, format, *args):
+		pass
+
+
+class ServerTestCase(unittest.TestCase):
+	"""Serve a temporary directory on an ephemeral port, with a thread per
+	connection, during each test.
+
+	"""
+	handler_class = QuietHandler
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+		# The files are served from the current directory.
+		os.chdir(self.directory)
+		self.server = simpleHTTPServer.ThreadingServer(("127.0.0.1", 0), self.handler_class)
+		self.port = self.server.server_address[1]
+		self.thread = threading.Thread(target=self.server.serve_forever,
+				kwargs={'poll_interval': 0.05})
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join(5)
+		os.chdir(self.cwd)
+		shutil.rmtree(self.directory)
+
+	def write(self, name, content):
+		with open(os.path.join(self.directory, name), 'wb') as f:
+			f.write(content)
+
+	def connection(self):
+		return httplib.HTTPConnection("127.0.0.1", self.port, timeout=10)
+
+
+class KeepAliveHandler(QuietHandler):
+	max_requests = 5
+
+
+class KeepAliveTest(ServerTestCase):
+	"""HTTP/1.1 persistent connections."""
+	handler_class = KeepAliveHandler
+	N = KeepAliveHandler.max_requests
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.write("questions.html", PAGE)
+		os.mkdir(os.path.join(self.directory, "folder"))
+
+	def request(self, sock, method, path):
+		"""Send a request over the socket, and read its response."""
+		sock.sendall("%s %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % (method, path))
+		response = httplib.HTTPResponse(sock, method=method)
+		response.begin()
+		return response, response.read()
+
+	def test_requests_over_one_connection(self):
+		"""Requests are served over one connection, the last one a response
+		without Content-Length (the redirect of a directory), delimited by
+		the end of the connection (before max_requests).
+
+		"""
+		conn = self.connection()
+		conn.connect()
+		sock = conn.sock
+		for i in range(self.N - 2):
+			conn.request("GET", "/questions.html")
+			response = conn.getresponse()
+			self.assertEqual((response.status, response.version), (200, 11))
+			self.assertEqual(response.getheader("Content-Length"), str(len(PAGE)))
+			self.assertEqual(response.read(), PAGE)
+			self.assertIs(conn.sock, sock, "request %i opened a new connection" % (i + 1))
+		conn.request("GET", "/folder")
+		response = conn.getresponse()
+		self.assertEqual(response.status, 301)
+		self.assertIsNone(response.getheader("Content-Length"))
+		self.assertEqual(response.getheader("Connection"), "close")
+		self.assertEqual(response.read(), "")
+		self.assertIsNone(conn.sock)
+		conn.close()
+
+	def test_response_without_content_length_closes(self):
+		"""The server closes the connection after a response without Content-Length."""
+		sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+		self.assertEqual(self.request(sock, "GET", "/questions.html")[1], PAGE)
+		response, body = self.request(sock, "GET", "/folder")
+		self.assertEqual((response.status, body), (301, ""))
+		self.assertEqual(response.getheader("Connection"), "close")
+		self.assertEqual(sock.recv(1), "")
+		sock.close()
+
+	def test_max_requests(self):
+		"""The connection is closed after max_requests."""
+		sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+		for i in range(self.N):
+			response, body = self.request(sock, "GET", "/questions.html")
+			self.assertEqual(body, PAGE)
+			closing = response.getheader("Connection") == "close"
+			self.assertEqual(closing, i == self.N - 1, "request %i" % (i + 1))
+		self.assertEqual(sock.recv(1), "")
+		sock.close()
+
+	def test_pipelined_requests(self):
+		"""Requests sent at once are answered in order, over the same connection."""
+		sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+		methods = ["GET", "GET", "HEAD"]
+		sock.sendall("".join("%s /questions.html HTTP/1.1\r\nHost: localhost\r\n\r\n" % m
+				for m in methods))
+		answers = []
+		for method in methods:
+			response = httplib.HTTPResponse(sock, method=method)
+			response.begin()
+			answers.append((response.status, response.read()))
+		self.assertEqual(answers, [(200, PAGE), (200, PAGE), (200, "")])
+		sock.close()
+
+	def test_errors_close_the_connection(self):
+		"""An error response closes the connection (Connection: close)."""
+		conn = self.connection()
+		conn.request("GET", "/missing.html")
+		response = conn.getresponse()
+		self.assertEqual(response.status, 404)
+		self.assertEqual(response.getheader("Connection"), "close")
+		response.read()
+		conn.close()
+
+
+class KeepAliveSpeedTest(ServerTestCase):
+	"""Reusing a connection is faster than a new connection per request.
+
+	The throughput of each serving mode, with and without persistent
+	connections, is measured by loadgen.py:
+
+		python loadgen.py --modes thread,pool,async --keepalive both
+
+	"""
+	N = simpleHTTPServer.MAX_REQUESTS # All of them over one connection.
+	RUNS = 3
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.write("questions.html", PAGE)
+
+	def new_connections(self):
+		for i in range(self.N):
+			conn = self.connection()
+			conn.request("GET", "/questions.html")
+			self.assertEqual(conn.getresponse().read(), PAGE)
+			conn.close()
+
+	def one_connection(self):
+		conn = self.connection()
+		for i in range(self.N):
+			conn.request("GET", "/questions.html")
+			self.assertEqual(conn.getresponse().read(), PAGE)
+		conn.close()
+
+	def best_time(self, run):
+		"""The shortest of RUNS runs, in seconds."""
+		times = []
+		for i in range(self.RUNS):
+			start = time.time()
+			run()
+			times.append(time.time() - start)
+		return min(times)
+
+	def test_reuse_is_faster(self):
+		new = self.best_time(self.new_connections)
+		reused = self.best_time(self.one_connection)
+		self.assertLess(reused, new, "%i requests: %.3fs over one connection, "
+				"%.3fs with a connection each" % (self.N, reused, new))
+
+
+class ConditionalGetTest(ServerTestCase):
+	"""The answers file: validators, 304s and gzip."""
+	ANSWERS = "first name = Ana\nlast name = Lopez\nemail = ana@example.com\n" * 20
+	MTIME = 1400000000 # Tue, 13 May 2014 16:53:20 GMT
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.write(simpleHTTPServer.ANSWERS_DATA_FILE, self.ANSWERS)
+		os.utime(simpleHTTPServer.ANSWERS_DATA_FILE, (self.MTIME, self.MTIME))
+
+	def get(self, headers={}, method="GET"):
+		conn = self.connection()
+		conn.request(method, "/answers.txt", headers=headers)
+		response = conn.getresponse()
+		body = response.read()
+		conn.close()
+		return response, body
+
+	def test_validators(self):
+		response, body = self.get()
+		self.assertEqual((response.status, body), (200, self.ANSWERS))
+		self.assertEqual(response.getheader("Last-Modified"), "Tue, 13 May 2014 16:53:20 GMT")
+		self.assertEqual(response.getheader("Cache-Control"), "no-cache")
+		self.assertTrue(response.getheader("ETag").startswith('"'))
+
+	def test_if_none_match(self):
+		etag = self.get()[0].getheader("ETag")
+		for value in (etag, "W/" + etag, '"other", %s' % etag, "*"):
+			response, body = self.get({'If-None-Match': value})
+			self.assertEqual((response.status, body), (304, ""), value)
+			self.assertEqual(response.getheader("ETag"), etag)
+		response, body = self.get({'If-None-Match': '"other"'})
+		self.assertEqual((response.status, body), (200, self.ANSWERS))
+
+	def test_replaced_file_is_modified(self):
+		etag = self.get()[0].getheader("ETag")
+		self.write(simpleHTTPServer.ANSWERS_DATA_FILE, "first name = Other\n")
+		os.utime(simpleHTTPServer.ANSWERS_DATA_FILE, (self.MTIME, self.MTIME))
+		response, body = self.get({'If-None-Match': etag})
+		self.assertEqual((response.status, body), (200, "first name = Other\n"))
+
+	def test_if_modified_since(self):
+		"""The three formats of HTTP-date (RFC 7231, 7.1.1.1)."""
+		for date in ("Tue, 13 May 2014 16:53:20 GMT", "Tuesday, 13-May-14 16:53:20 GMT",
+				"Tue May 13 16:53:20 2014", "Wed, 14 May 2014 00:00:00 GMT"):
+			response, body = self.get({'If-Modified-Since': date})
+			self.assertEqual((response.status, body), (304, ""), date)
+		for date in ("Tue, 13 May 2014 16:53:19 GMT", "yesterday"):
+			response, body = self.get({'If-Modified-Since': date})
+			self.assertEqual(response.status, 200, date)
+
+	def test_if_none_match_over_if_modified_since(self):
+		response, body = self.get({'If-None-Match': '"other"',
+				'If-Modified-Since': "Tue, 13 May 2014 16:53:20 GMT"})
+		self.assertEqual(response.status, 200)
+
+	def test_asctime_dates_are_gmt(self):
+		tz = os.environ.get('TZ')
+		os.environ['TZ'] = 'America/Argentina/Buenos_Aires'
+		time.tzset()
+		try:
+			self.assertEqual(simpleHTTPServer.parse_http_date("Tue May 13 16:53:20 2014"),
+					self.MTIME)
+		finally:
+			if tz is None:
+				del os.environ['TZ']
+			else:
+				os.environ['TZ'] = tz
+			time.tzset()
+
+	def test_gzip(self):
+		plain = self.get()[0]
+		response, body = self.get({'Accept-Encoding': "deflate, gzip"})
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+		self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+		self.assertEqual(response.getheader("Content-Length"), str(len(body)))
+		self.assertLess(len(body), len(self.ANSWERS))
+		self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(body)).read(), self.ANSWERS)
+		etag = response.getheader("ETag")
+		self.assertNotEqual(etag, plain.getheader("ETag"))
+		response, body = self.get({'Accept-Encoding': "gzip", 'If-None-Match': etag})
+		self.assertEqual(response.status, 304)
+		# The other variant's ETag doesn't match.
+		response, body = self.get({'Accept-Encoding': "gzip",
+				'If-None-Match': plain.getheader("ETag")})
+		self.assertEqual(response.status, 200)
+
+	def test_no_gzip(self):
+		for headers in ({}, {'Accept-Encoding': "gzip;q=0"}, {'Accept-Encoding': "identity"},
+				{'Accept-Encoding': "gzip", 'Range': "bytes=0-9"}):
+			response, body = self.get(headers)
+			self.assertIsNone(response.getheader("Content-Encoding"), headers)
+			self.assertEqual(body, self.ANSWERS[:len(body)], headers)
+
+
+class FormHandler(QuietHandler):
+	max_body_size = 1024
+	body_timeout = 5
+
+
+class FormTest(ServerTestCase):
+	"""The POSTs of the questions form to /save, parsed as they arrive."""
+	handler_class = FormHandler
+	FORM = "firstname=Ana&lastname=L%C3%B3pez&email=ana%40example.com"
+	ANSWERS = "first name = Ana\nlast name = L\xc3\xb3pez\nemail = ana@example.com"
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		FormHandler.answers_store = answersstore.AnswersStore(
+				os.path.join(self.directory, "answers"),
+				latest_file=simpleHTTPServer.ANSWERS_DATA_FILE,
+				format_record=simpleHTTPServer.format_answers)
+
+	def tearDown(self):
+		FormHandler.answers_store = None
+		ServerTestCase.tearDown(self)
+
+	def post(self, body, content_type="application/x-www-form-urlencoded", length=None,
+			end=False):
+		"""Send the headers and the body (maybe just part of it, per 'length')
+		of a POST to /save, over a new socket, shutting down its sending
+		side if 'end'. Return the response and its body.
+
+		"""
+		sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+		sock.sendall("POST /save HTTP/1.1\r\nHost: localhost\r\nContent-Type: %s\r\n"
+				"Content-Length: %i\r\n\r\n%s" % (content_type,
+				len(body) if length is None else length, body))
+		if end:
+			sock.shutdown(socket.SHUT_WR)
+		response = httplib.HTTPResponse(sock, method="POST")
+		response.begin()
+		content = response.read()
+		sock.close()
+		return response, content
+
+	def answers(self):
+		with open(simpleHTTPServer.ANSWERS_DATA_FILE) as f:
+			return f.read()
+
+	def test_urlencoded(self):
+		response, content = self.post(self.FORM)
+		self.assertEqual(response.status, 302)
+		self.assertEqual(response.getheader("Location"), simpleHTTPServer.SUCCESS_PAGE_PATH)
+		self.assertIsNone(response.getheader("Connection"))
+		self.assertEqual(self.answers(), self.ANSWERS)
+
+	def test_multipart(self):
+		body = "".join('--b0undary\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+				'%s\r\n' % field for field in [("firstname", "Ana"),
+				("lastname", "L\xc3\xb3pez"), ("email", "ana@example.com")]) + "--b0undary--\r\n"
+		response, content = self.post(body, "multipart/form-data; boundary=b0undary")
+		self.assertEqual(response.status, 302)
+		self.assertEqual(self.answers(), self.ANSWERS)
+
+	def test_oversize(self):
+		"""A form bigger than max_body_size is refused before reading it."""
+		response, content = self.post("", length=FormHandler.max_body_size + 1)
+		self.assertEqual(response.status, 413)
+		self.assertEqual(response.getheader("Connection"), "close")
+
+	def test_shorter_than_its_length(self):
+		response, content = self.post("firstname=Ana&last", length=100, end=True)
+		self.assertEqual(response.status, 400)
+		self.assertIn("shorter than its Content-Length", content)
+		self.assertEqual(response.getheader("Connection"), "close")
+
+	def test_multipart_without_boundary(self):
+		for content_type in ("multipart/form-data", "multipart/form-data; boundary=" + "b" * 71):
+			response, content = self.post(self.FORM, content_type)
+			self.assertEqual(response.status, 400, content_type)
+			self.assertIn("Bad multipart boundary", content)
+
+	def test_unsupported_encoding(self):
+		response, content = self.post(self.FORM, "text/plain")
+		self.assertEqual(response.status, 415)
+
+	def test_stops_after_the_fields(self):
+		"""The rest of the body isn't waited for once the three fields are
+		there: the answer comes right away, closing the connection.
+
+		"""
+		response, content = self.post(self.FORM + "&", length=1000)
+		self.assertEqual(response.status, 302)
+		self.assertEqual(response.getheader("Connection"), "close")
+		self.assertEqual(self.answers(), self.ANSWERS)
+
+
+class ReadSomeTest(unittest.TestCase):
+	"""formparser.read_some, on the file of a socket (socket._fileobject,
+	whose internals it uses).
+
+	"""
+	def setUp(self):
+		# The file of an accepted connection, as the handlers' rfile.
+		listener = socket.socket()
+		listener.bind(("127.0.0.1", 0))
+		listener.listen(1)
+		self.client = socket.create_connection(listener.getsockname(), timeout=5)
+		self.server = listener.accept()[0]
+		listener.close()
+		self.server.settimeout(5)
+		self.rfile = self.server.makefile('rb', -1)
+
+	def tearDown(self):
+		self.rfile.close()
+		self.server.close()
+		self.client.close()
+
+	def test_socket_file_internals(self):
+		self.assertIsInstance(self.rfile, socket._fileobject)
+		self.assertEqual(self.rfile._rbuf.getvalue(), "")
+		self.assertIs(self.rfile._sock, self.server._sock)
+
+	def test_returns_what_has_arrived(self):
+		"""Doesn't wait for the n bytes (rfile.read(n) would)."""
+		self.client.sendall("abc")
+		self.assertEqual(formparser.read_some(self.rfile, 100), "abc")
+		self.client.sendall("defg")
+		self.assertEqual(formparser.read_some(self.rfile, 100), "defg")
+
+	def test_buffered_bytes_first(self):
+		"""The bytes buffered by readline (e.g. with the headers) come first."""
+		self.client.sendall("Header: 1\r\n\r\nbody")
+		self.assertEqual(self.rfile.readline(), "Header: 1\r\n")
+		self.assertEqual(self.rfile.readline(), "\r\n")
+		self.assertEqual(formparser.read_some(self.rfile, 2), "bo")
+		self.assertEqual(formparser.read_some(self.rfile, 100), "dy")
+		self.client.sendall("more")
+		self.assertEqual(formparser.read_some(self.rfile, 100), "more")
+
+	def test_end_of_the_file(self):
+		self.client.shutdown(socket.SHUT_WR)
+		self.assertEqual(formparser.read_some(self.rfile, 100), "")
+
+	def test_other_files(self):
+		self.assertEqual(formparser.read_some(StringIO.StringIO("abc"), 2), "ab")
+
+
+class MetricsHandler(QuietHandler):
+	metrics = None # New ones for each test.
+
+
+class MetricsTest(ServerTestCase):
+	"""The /metrics of the requests served, in the Prometheus text format."""
+	handler_class = MetricsHandler
+	ANSWERS = "first name = Ana\nlast name = Lopez\nemail = ana@example.com"
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		MetricsHandler.metrics = metrics.Metrics()
+		self.write("questions.html", PAGE)
+		self.write(simpleHTTPServer.ANSWERS_DATA_FILE, self.ANSWERS)
+		# Requests in order: each one is counted before the next is read.
+		self.conn = self.connection()
+
+	def tearDown(self):
+		self.conn.close()
+		ServerTestCase.tearDown(self)
+
+	def get(self, path, headers={}, method="GET"):
+		self.conn.request(method, path, headers=headers)
+		response = self.conn.getresponse()
+		return response, response.read()
+
+	def samples(self):
+		"""The samples of /metrics, by name (with labels)."""
+		response, content = self.get("/metrics")
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.getheader("Content-Type"), "text/plain; version=0.0.4")
+		self.assertEqual(response.getheader("Cache-Control"), "no-store")
+		return dict((name, float(value)) for name, value in
+				(line.rsplit(" ", 1) for line in content.splitlines() if not line.startswith("#")))
+
+	def test_requests_by_route_and_code(self):
+		self.get("/questions.html")
+		self.get("/questions.html", method="HEAD")
+		self.get("/missing.html")
+		self.conn.close()
+		etag = self.get("/answers.txt")[0].getheader("ETag")
+		self.get("/answers.txt", {'If-None-Match': etag})
+		samples = self.samples()
+		self.assertEqual(samples['http_requests_total{route="static",code="200"}'], 2)
+		self.assertEqual(samples['http_requests_total{route="static",code="404"}'], 1)
+		self.assertEqual(samples['http_requests_total{route="/answers.txt",code="200"}'], 1)
+		self.assertEqual(samples['http_requests_total{route="/answers.txt",code="304"}'], 1)
+		self.assertNotIn('http_requests_total{route="/save",code="200"}', samples)
+		# The 304 has no body.
+		self.assertEqual(samples['http_response_bytes_total{route="/answers.txt"}'],
+				len(self.ANSWERS))
+		self.assertEqual(samples['http_response_bytes_total{route="/metrics"}'], 0)
+		self.assertEqual(samples['answers_cache_misses_total'], 1)
+		self.assertEqual(samples['answers_cache_hits_total'], 1)
+		self.assertEqual(samples['answers_cache_hit_ratio'], 0.5)
+		self.assertEqual(samples['answers_not_modified_ratio'], 0.5)
+
+	def test_latency_histograms(self):
+		for i in range(5):
+			self.get("/questions.html")
+		samples = self.samples()
+		prefix = 'http_request_duration_seconds'
+		self.assertEqual(samples[prefix + '_count{route="static"}'], 5)
+		self.assertEqual(samples[prefix + '_bucket{route="static",le="+Inf"}'], 5)
+		self.assertGreater(samples[prefix + '_sum{route="static"}'], 0)
+		buckets = [samples['%s_bucket{route="static",le="%s"}' % (prefix, le)]
+				for le in metrics.BUCKETS]
+		self.assertEqual(buckets, sorted(buckets))
+		quantiles = [samples['http_request_duration_quantile_seconds{route="static",'
+				'quantile="%s"}' % q] for q in metrics.QUANTILES]
+		self.assertEqual(quantiles, sorted(quantiles))
+		self.assertGreater(quantiles[0], 0)
+		self.assertEqual(samples[prefix + '_count{route="/save"}'], 0)
+
+	def test_metrics_requests_are_counted(self):
+		self.samples()
+		samples = self.samples()
+		self.assertEqual(samples['http_requests_total{route="/metrics",code="200"}'], 1)
+		self.assertGreater(samples['http_response_bytes_total{route="/metrics"}'], 0)
+
+	def test_buckets(self):
+		"""The histograms' buckets hold their values, and are at most 3% wide."""
+		for value in [0, 1, 31, 32, 33, 1000, 123456, metrics.MAX_VALUE]:
+			lower, upper = metrics.bucket_bounds(metrics.bucket_index(value))
+			self.assertTrue(lower <= value < upper, value)
+			self.assertLessEqual(upper - lower, max(1, lower * 0.032), value)
+
+
+class BigFileTest(ServerTestCase):
+	"""A sparse answers file bigger than 4 GB, served from the disk."""
+	SIZE = 2 ** 32 + 2 ** 20 + 7 # Offsets beyond 32 bits.
+	HEAD = "first name = Big"
+	TAIL = "email = big@example.com\n"
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		path = os.path.join(self.directory, simpleHTTPServer.ANSWERS_DATA_FILE)
+		try:
+			with open(path, 'wb') as f:
+				f.write(self.HEAD)
+				f.truncate(self.SIZE)
+				f.seek(self.SIZE - len(self.TAIL))
+				f.write(self.TAIL)
+		except (IOError, OverflowError), e:
+			self.tearDown()
+			self.skipTest("Can't make a file of %i bytes: %s" % (self.SIZE, e))
+		if os.stat(path).st_blocks * 512 >= self.SIZE:
+			self.tearDown()
+			self.skipTest("No sparse files here.")
+		os.link(path, os.path.join(self.directory, "big.bin"))
+
+	def get(self, path, headers={}, method="GET"):
+		"""Request the path. Return the response, the bytes of its body, and
+		the first and last bytes of it.
+
+		"""
+		conn = self.connection()
+		conn.request(method, path, headers=headers)
+		response = conn.getresponse()
+		received = 0
+		first = last = ""
+		while True:
+			chunk = response.read(1024 * 1024)
+			if not chunk:
+				break
+			if not received:
+				first = chunk[:64]
+			last = (last + chunk)[-64:]
+			received += len(chunk)
+		conn.close()
+		return response, received, first, last
+
+	def test_whole_file(self):
+		response, received, first, last = self.get("/answers.txt")
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.getheader("Content-Length"), str(self.SIZE))
+		self.assertEqual(received, self.SIZE)
+		self.assertTrue(first.startswith(self.HEAD))
+		self.assertTrue(last.endswith(self.TAIL))
+
+	def test_range_at_the_end(self):
+		response, received, first, last = self.get("/answers.txt", {'Range': 'bytes=-%i' % len(self.TAIL)})
+		self.assertEqual(response.status, 206)
+		self.assertEqual(response.getheader("Content-Range"), "bytes %i-%i/%i" % (
+				self.SIZE - len(self.TAIL), self.SIZE - 1, self.SIZE))
+		self.assertEqual(response.getheader("Content-Length"), str(len(self.TAIL)))
+		self.assertEqual(first, self.TAIL)
+
+	def test_range_across_4_gb(self):
+		start = 2 ** 32 - 8
+		response, received, first, last = self.get("/answers.txt",
+				{'Range': 'bytes=%i-%i' % (start, start + 15)})
+		self.assertEqual(response.status, 206)
+		self.assertEqual(response.getheader("Content-Range"), "bytes %i-%i/%i" % (
+				start, start + 15, self.SIZE))
+		self.assertEqual(first, "\0" * 16)
+
+	def test_range_past_the_end(self):
+		response, received, first, last = self.get("/answers.txt", {'Range': 'bytes=%i-' % self.SIZE})
+		self.assertEqual(response.status, 416)
+		self.assertEqual(response.getheader("Content-Range"), "bytes */%i" % self.SIZE)
+
+	def test_static_file_length(self):
+		response, received, first, last = self.get("/big.bin", method="HEAD")
+		self.assertEqual(response.status, 200)
+		self.assertEqual(response.getheader("Content-Length"), str(self.SIZE))
+
+
+class AnswersStoreTest(unittest.TestCase):
+	"""The append-only store of the answers, with small segments."""
+	SEGMENT_SIZE = 500 # Bytes: a few submissions per segment.
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.latest = os.path.join(self.directory, "latest.json")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def store(self, **kwargs):
+		return answersstore.AnswersStore(self.directory, self.SEGMENT_SIZE, **kwargs)
+
+	def record(self, i, writer="a"):
+		return {'firstname': "%s%i" % (writer, i), 'email': "%s%i@example.com" % (writer, i)}
+
+	def fill(self, store, n):
+		return [store.append(self.record(i)) for i in range(n)]
+
+	def assertRecords(self, store, n):
+		self.assertEqual(len(store), n)
+		for i in range(n):
+			self.assertEqual(store.get(i + 1), dict(self.record(i), n=i + 1))
+
+	def test_append_and_get_across_segments(self):
+		store = self.store()
+		self.assertEqual(self.fill(store, 30), range(1, 31))
+		self.assertGreater(len(store.segments), 2)
+		self.assertEqual(store.segment_files(), store.segments)
+		self.assertRecords(store, 30)
+		self.assertIsNone(store.get(0))
+		self.assertIsNone(store.get(31))
+
+	def test_reopen_rebuilds_the_index(self):
+		self.fill(self.store(), 30)
+		store = self.store()
+		self.assertRecords(store, 30)
+		self.assertEqual(store.append(self.record(30)), 31)
+		self.assertRecords(self.store(), 31)
+
+	def test_reopen_cuts_a_half_written_line(self):
+		store = self.store()
+		self.fill(store, 10)
+		with open(store.path(store.segments[-1]), 'ab') as f:
+			f.write('{"n": 11, "firstname": "cr') # A crash.
+		store = self.store()
+		self.assertRecords(store, 10)
+		self.assertEqual(store.append(self.record(10)), 11)
+		self.assertRecords(self.store(), 11)
+
+	def test_compaction_keeps_every_record(self):
+		self.fill(self.store(), 30)
+		stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+		try:
+			answersstore.compact(self.directory, segment_size=10 ** 6)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+		store = self.store()
+		self.assertEqual(store.segments, [1])
+		self.assertEqual(store.segment_files(), [1])
+		self.assertRecords(store, 30)
+
+	def test_two_writers_lose_nothing(self):
+		"""Two processes appending at once (as the prefork workers)."""
+		n = 50
+		pid = os.fork()
+		if not pid:
+			try:
+				store = self.store()
+				for i in range(n):
+					store.append(self.record(i, "child"))
+			finally:
+				os._exit(0)
+		store = self.store()
+		for i in range(n):
+			store.append(self.record(i, "parent"))
+		os.waitpid(pid, 0)
+		store = self.store()
+		self.assertEqual(len(store), 2 * n)
+		records = [store.get(i) for i in range(1, 2 * n + 1)]
+		self.assertEqual([r['n'] for r in records], range(1, 2 * n + 1))
+		for writer in ("child", "parent"):
+			self.assertEqual(
+					[r['firstname'] for r in records if r['firstname'].startswith(writer)],
+					["%s%i" % (writer, i) for i in range(n)])
+
+	def test_latest_file_is_the_last_submission(self):
+		"""An earlier submission of another process doesn't replace the
+		latest_file.
+
+		"""
+		first = self.store(latest_file=self.latest)
+		second = self.store(latest_file=self.latest)
+		first.append(self.record(0))
+		second.append(self.record(1))
+		first.write_latest(self.record(0), 1) # Late.
+		with open(self.latest) as f:
+			self.assertEqual(json.load(f), self.record(1))
+
+
+if __name__ == "__main__":
+	unittest.main()